@@ -0,0 +1,244 @@
+# Benchmarks for the tokenizer and parser
+#
+# Run with 'python -m bench' from the top level directory.  See
+# bench/__main__.py for the options.
+
+import gc
+import os
+import platform
+import sys
+import tempfile
+import time
+
+from varas import Parser
+
+from bench import inputs
+from test import calc_example, expr_example, json_example
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+"""Example grammars, as (tokenizer, expression spec) tuples"""
+grammars = {
+    "calc": (calc_example.tokenizer, calc_example.expr_spec),
+    "expr": (expr_example.tokenizer, expr_example.expr_spec),
+    "json": (json_example.tokenizer, json_example.json)
+}
+
+"""Benchmark inputs, as (grammar, input name, generator, size)"""
+cases = [
+    ("calc", "random", inputs.arith_random, 2000),
+    ("calc", "flat_list", inputs.arith_flat_list, 50000),
+    ("calc", "nested", inputs.arith_nested, 100),
+    ("calc", "right_assoc", inputs.arith_right_assoc, 200),
+    ("calc", "operator_dense", inputs.arith_operator_dense, 2000),
+    ("expr", "random", inputs.arith_random, 2000),
+    ("expr", "operator_dense", inputs.arith_operator_dense, 2000),
+    ("json", "random", inputs.json_random, 500),
+    ("json", "flat_list", inputs.json_flat_list, 50000),
+    ("json", "nested", inputs.json_nested, 100),
+    ("json", "large", inputs.json_large, 5000)
+]
+
+"""Operations measured for each input"""
+operations = ["tokenize", "tokenize_file", "parse_all"]
+
+class Operation(object):
+    """
+    Describes how to run one operation over an input.  Calling start()
+    returns a generator of results, i.e. tokens or expressions.
+    """
+
+    def __init__(self, grammar, operation, text, filename):
+        self.tokenizer, self.expr_spec = grammars[grammar]
+        self.operation = operation
+        self.text = text
+        self.filename = filename
+
+    def start(self):
+        if self.operation == "tokenize":
+            return self.tokenizer.tokenize(self.text)
+        if self.operation == "tokenize_file":
+            return self._tokenize_file()
+        assert self.operation == "parse_all"
+        tokens = self.tokenizer.tokenize(self.text)
+        return Parser(self.expr_spec, tokens).parse_all()
+
+    def _tokenize_file(self):
+        with open(self.filename) as f:
+            for token in self.tokenizer.tokenize_file(f):
+                yield token
+
+def _time_run(operation):
+    """
+    Run an operation to completion, returning the number of results, the
+    time to the first result and the total time.
+    """
+    gc.disable()
+    try:
+        start = time.time()
+        results = operation.start()
+        count = 0
+        first = None
+        for result in results:
+            if count == 0:
+                first = time.time() - start
+            count += 1
+        total = time.time() - start
+    finally:
+        gc.enable()
+    return count, first, total
+
+def _peak_memory(operation):
+    """
+    Return the peak memory allocated in bytes while running an operation
+    and keeping its results, or None if this can't be measured.
+    """
+    if tracemalloc is not None:
+        tracemalloc.start()
+        try:
+            results = list(operation.start())
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return _peak_memory_in_child(operation)
+
+def _peak_memory_in_child(operation):
+    """
+    Measure the increase in maximum resident set size of a child process
+    while it runs an operation.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    if not hasattr(os, "fork"):
+        return None
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        results = list(operation.start())
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in kilobytes on Linux and bytes on Mac OS
+        scale = 1 if sys.platform == "darwin" else 1024
+        os.write(write_fd, str((after - before) * scale).encode("ascii"))
+        os._exit(0)
+    os.close(write_fd)
+    data = b""
+    while True:
+        chunk = os.read(read_fd, 64)
+        if not chunk:
+            break
+        data += chunk
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    return int(data) if data else None
+
+def run_case(grammar, name, generator, size, operation_name, repeat = 3,
+             scale = 1.0):
+    """
+    Run one benchmark and return a dict of its results.  Times are the
+    best of repeat runs.
+    """
+    text = generator(max(1, int(size * scale)))
+    fd, filename = tempfile.mkstemp(suffix = ".txt")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+        operation = Operation(grammar, operation_name, text, filename)
+        token_count = sum(1 for token in
+                          grammars[grammar][0].tokenize(text))
+        best_first = best_total = None
+        for i in range(repeat):
+            count, first, total = _time_run(operation)
+            if best_total is None or total < best_total:
+                best_total = total
+            if first is not None and (best_first is None or first < best_first):
+                best_first = first
+        result = {
+            "input_bytes": len(text),
+            "tokens": token_count,
+            "results": count,
+            "seconds": best_total,
+            "first_result_seconds": best_first,
+            "tokens_per_second": token_count / best_total if best_total else None,
+            "peak_memory_bytes": _peak_memory(operation)
+        }
+        if operation_name == "parse_all":
+            result["expressions_per_second"] = \
+                count / best_total if best_total else None
+        return result
+    finally:
+        os.remove(filename)
+
+def run(repeat = 3, scale = 1.0, selected = None, progress = None):
+    """
+    Run the benchmarks and return the results as a dict suitable for saving
+    as JSON.
+
+    selected -- optional, a function taking a benchmark name and returning
+    whether to run it
+
+    progress -- optional, a function called with each benchmark name and
+    its results
+    """
+    results = {}
+    for grammar, name, generator, size in cases:
+        for operation in operations:
+            key = "%s/%s/%s" % (grammar, name, operation)
+            if selected is not None and not selected(key):
+                continue
+            result = run_case(grammar, name, generator, size, operation,
+                              repeat, scale)
+            results[key] = result
+            if progress is not None:
+                progress(key, result)
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "repeat": repeat,
+        "scale": scale,
+        "benchmarks": results
+    }
+
+"""
+Measures compared between runs, for all of which lower is better, and the
+smallest absolute increase in each that counts as a regression, to avoid
+flagging noise in very small values
+"""
+compared_measures = {"seconds": 0.001,
+                     "first_result_seconds": 0.001,
+                     "peak_memory_bytes": 1 << 20}
+
+def compare(baseline, current, threshold = 0.1):
+    """
+    Compare two sets of results as returned by run().  Returns a list of
+    (benchmark, measure, baseline value, current value, change) tuples,
+    where change is the relative increase, and a list of those which are
+    regressions by more than threshold.
+    """
+    changes = []
+    regressions = []
+    for key in sorted(current["benchmarks"]):
+        if key not in baseline["benchmarks"]:
+            continue
+        old = baseline["benchmarks"][key]
+        new = current["benchmarks"][key]
+        for measure in sorted(compared_measures):
+            old_value = old.get(measure)
+            new_value = new.get(measure)
+            if not old_value or new_value is None:
+                continue
+            change = (new_value - old_value) / float(old_value)
+            entry = (key, measure, old_value, new_value, change)
+            changes.append(entry)
+            if change > threshold and \
+               new_value - old_value > compared_measures[measure]:
+                regressions.append(entry)
+    return changes, regressions
@@ -0,0 +1,65 @@
+# Command line interface for the benchmarks
+#
+# Usage: python -m bench [options]
+#
+# Results are printed and optionally saved as JSON with --output.  Passing
+# --compare with a previously saved file reports the change for each
+# benchmark and exits with status 1 if any is slower or uses more memory
+# than the baseline by more than the threshold.
+
+import json
+import optparse
+import sys
+
+import bench
+
+def main(argv):
+    option_parser = optparse.OptionParser(usage = "python -m bench [options]")
+    option_parser.add_option("-o", "--output", metavar = "FILE",
+                             help = "save results as JSON to FILE")
+    option_parser.add_option("-c", "--compare", metavar = "FILE",
+                             help = "compare results with those saved in FILE")
+    option_parser.add_option("-t", "--threshold", type = "float", default = 0.1,
+                             help = "relative change reported as a regression "
+                                    "(default 0.1)")
+    option_parser.add_option("-r", "--repeat", type = "int", default = 3,
+                             help = "number of timed runs (default 3)")
+    option_parser.add_option("-s", "--scale", type = "float", default = 1.0,
+                             help = "multiply input sizes by this (default 1)")
+    option_parser.add_option("-f", "--filter", metavar = "TEXT",
+                             help = "only run benchmarks containing TEXT")
+    options, args = option_parser.parse_args(argv)
+
+    def selected(key):
+        return options.filter is None or options.filter in key
+
+    def progress(key, result):
+        memory = result["peak_memory_bytes"]
+        print("%-32s %9d tokens %9.0f tokens/s %9.4fs first %8.4fs %s" % (
+            key, result["tokens"], result["tokens_per_second"] or 0,
+            result["seconds"], result["first_result_seconds"] or 0,
+            "%8.1fMB" % (memory / 1048576.0) if memory is not None else "-"))
+        sys.stdout.flush()
+
+    results = bench.run(options.repeat, options.scale, selected, progress)
+
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(results, f, indent = 2, sort_keys = True)
+
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+        changes, regressions = bench.compare(baseline, results, options.threshold)
+        print("")
+        for key, measure, old, new, change in changes:
+            flag = " REGRESSION" if (key, measure, old, new, change) in regressions else ""
+            print("%-32s %-22s %+7.1f%%%s" % (key, measure, change * 100, flag))
+        if regressions:
+            print("\n%d regressions over %.0f%%" % (len(regressions),
+                                                     options.threshold * 100))
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,63 @@
+# Memory and build time of arena ASTs compared with tuple trees
+#
+# Usage: python -m bench.arena [lines]
+#
+# Parses generated arithmetic expressions with the expression example,
+# building tuples such as ("add", l, r), and with an ASTArena holding
+# the same trees in flat arrays.  The input is tokenized up front so
+# that only building the trees is timed.  Memory is the size of the
+# retained results, measured with tracemalloc, so this requires
+# Python 3.
+
+import gc
+import sys
+import time
+import tracemalloc
+
+from varas import ASTArena, Parser
+
+from bench import inputs
+from test.expr_example import tokenizer, expr_spec
+
+def build_tuples(tokens):
+    return list(Parser(expr_spec, iter(tokens)).parse_all())
+
+def build_arena(tokens):
+    arena = ASTArena()
+    spec = arena.spec(expr_spec)
+    roots = list(Parser(spec, iter(tokens)).parse_all())
+    return arena, roots
+
+def measure(func, tokens, repeat = 5):
+    best = None
+    gc.disable()
+    try:
+        for i in range(repeat):
+            start = time.time()
+            func(tokens)
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+    finally:
+        gc.enable()
+    tracemalloc.start()
+    try:
+        result = func(tokens)
+        gc.collect()
+        size = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return best, size
+
+def main(argv):
+    lines = int(argv[0]) if argv else 5000
+    text = inputs.arith_random(lines)
+    tokens = list(tokenizer.tokenize(text))
+    print("%d lines, %d bytes, %d tokens" % (lines, len(text), len(tokens)))
+    for name, func in (("tuples", build_tuples), ("arena", build_arena)):
+        elapsed, size = measure(func, tokens)
+        print("%-8s %8.3fs  %8.2fMB retained  %6.1f bytes per token" % (
+            name, elapsed, size / 1048576.0, size / float(len(tokens))))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
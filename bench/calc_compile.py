@@ -0,0 +1,51 @@
+# Evaluating a formula repeatedly with compile_expr() or by parsing it
+#
+# Usage: python -m bench.calc_compile [evaluations]
+#
+# Evaluates the same formula with different variable values, either by
+# substituting the values into the text and parsing it with the calc
+# example each time, or by calling the function returned by
+# compile_expr(), which is cached by source text so the formula is only
+# tokenized and parsed once.
+
+import random
+import sys
+import time
+
+from varas import Parser
+
+from test.calc_example import tokenizer, expr_spec, compile_expr, \
+    compiled_exprs
+
+FORMULA = "a * (b + 3) - c ^ 2 / (a + 1) + -b * (c - a * 2)"
+
+def main(argv):
+    count = int(argv[0]) if argv else 20000
+    rand = random.Random(1)
+    bindings = [dict(a = rand.randint(1, 99), b = rand.randint(1, 99),
+                     c = rand.randint(1, 99)) for i in range(count)]
+
+    start = time.time()
+    parsed = []
+    for variables in bindings:
+        text = FORMULA
+        for name, value in variables.items():
+            text = text.replace(name, str(value))
+        parsed.append(Parser(expr_spec, tokenizer.tokenize(text)).parse())
+    parse_time = time.time() - start
+
+    compiled_exprs.clear()
+    start = time.time()
+    compiled = [compile_expr(FORMULA)(**variables) for variables in bindings]
+    compile_time = time.time() - start
+    assert compiled == parsed
+
+    print("%d evaluations" % count)
+    print("parse each time   %7.3fs %9.0f/s" % (parse_time, count / parse_time))
+    print("compile_expr()    %7.3fs %9.0f/s  %d hits %d misses" % (
+        compile_time, count / compile_time, compiled_exprs.hits,
+        compiled_exprs.misses))
+    print("speedup %.1fx" % (parse_time / compile_time))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,47 @@
+# Evaluating a formula over many rows with NumPy or one row at a time
+#
+# Usage: python -m bench.calc_numpy [rows]
+#
+# Evaluates the same formula for every row of randomly generated variable
+# values, calling the function returned by the calc example's
+# compile_expr() once per row, and with evaluate_columns(), which applies
+# each operator to whole NumPy arrays a chunk of rows at a time.
+# Requires NumPy.
+
+import sys
+import time
+
+from test.calc_example import compile_expr, evaluate_columns, numpy
+
+FORMULA = "a * (b + 3) - c ^ 2 / (a + 1) + -b * (c - a * 2)"
+
+def main(argv):
+    if numpy is None:
+        print("NumPy is not installed")
+        return
+    rows = int(argv[0]) if argv else 1000000
+    rand = numpy.random.RandomState(1)
+    columns = dict((name, rand.randint(1, 100, rows)) for name in "abc")
+
+    func = compile_expr(FORMULA)
+    scalar_rows = min(rows, 100000)
+    values = dict((name, column[:scalar_rows].tolist())
+                  for name, column in columns.items())
+    start = time.time()
+    expected = [func(a = a, b = b, c = c)
+                for a, b, c in zip(values["a"], values["b"], values["c"])]
+    scalar_time = (time.time() - start) * rows / scalar_rows
+
+    print("%d rows" % rows)
+    print("one row at a time       %8.3fs %11.0f rows/s (estimated from %d rows)" % (
+        scalar_time, rows / scalar_time, scalar_rows))
+    for chunk_size in (4096, 65536, 1048576):
+        start = time.time()
+        results = evaluate_columns(FORMULA, columns, chunk_size = chunk_size)
+        elapsed = time.time() - start
+        assert results[:scalar_rows].tolist() == expected
+        print("chunk_size %-8d      %8.3fs %11.0f rows/s  speedup %.0fx" % (
+            chunk_size, elapsed, rows / elapsed, scalar_time / elapsed))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,131 @@
+# Input generators for the benchmarks
+#
+# Each generator takes a size and returns a string containing one or more
+# expressions in the grammar of one of the example parsers.  Inputs are
+# generated from a fixed seed so that runs can be compared.
+
+import json
+import random
+
+def _random(seed):
+    return random.Random(seed)
+
+##################################################################
+# Arithmetic inputs, parsed by the calc and expr examples
+##################################################################
+
+def arith_random(size, seed = 1):
+    """
+    Realistic input - size lines each containing a randomly generated
+    expression of moderate depth.
+    """
+    rand = _random(seed)
+    def expr(depth):
+        if depth == 0 or rand.random() < 0.3:
+            return str(rand.randint(1, 999))
+        kind = rand.random()
+        if kind < 0.15:
+            return "-" + expr(depth - 1)
+        if kind < 0.3:
+            return "(%s)" % expr(depth - 1)
+        return "%s %s %s" % (expr(depth - 1), rand.choice("+-*"),
+                             expr(depth - 1))
+    return "".join(expr(6) + "\n" for i in range(size))
+
+def arith_flat_list(size, seed = 1):
+    """
+    A single list literal with size elements.
+    """
+    rand = _random(seed)
+    return "[%s]\n" % ", ".join(str(rand.randint(0, 999)) for i in range(size))
+
+def arith_nested(size, seed = 1):
+    """
+    Adversarial input - a single expression nested size levels deep,
+    alternating parens and list brackets.
+    """
+    return "([" * size + "1" + "])" * size + "\n"
+
+def arith_right_assoc(size, seed = 1):
+    """
+    Adversarial input - a chain of right associative operators, which
+    recurses once per operator.
+    """
+    return " ^ ".join("1" for i in range(size)) + "\n"
+
+def arith_operator_dense(size, seed = 1):
+    """
+    Operator dense lines with no whitespace, e.g. '1+-2*3/+4'.
+    """
+    rand = _random(seed)
+    lines = []
+    for i in range(size):
+        terms = [str(rand.randint(1, 9)) for j in range(40)]
+        line = terms[0]
+        for term in terms[1:]:
+            line += rand.choice("+-*/") + rand.choice(("", "-", "+")) + term
+        lines.append(line)
+    return "\n".join(lines) + "\n"
+
+def arith_redundant(size, seed = 1):
+    """
+    Generated formulas that repeat the same sub-expressions, size lines
+    each combining a few of a small set of terms.
+    """
+    rand = _random(seed)
+    terms = [str(rand.randint(1, 99)) for i in range(8)]
+    for level in range(3):
+        terms = ["(%s %s %s)" % (rand.choice(terms), rand.choice("+-*"),
+                                 rand.choice(terms))
+                 for i in range(12)]
+    return "".join("%s * %s\n" % (rand.choice(terms), rand.choice(terms))
+                   for i in range(size))
+
+##################################################################
+# JSON inputs, parsed by the json example
+##################################################################
+
+def _json_value(rand, depth):
+    kind = rand.random()
+    if depth == 0 or kind < 0.4:
+        return rand.choice([rand.randint(-1000, 1000), rand.random() * 100,
+                            "text %d" % rand.randint(0, 99), True, False,
+                            None])
+    if kind < 0.7:
+        return [_json_value(rand, depth - 1) for i in range(rand.randint(0, 6))]
+    return dict(("key%d" % i, _json_value(rand, depth - 1))
+                for i in range(rand.randint(0, 6)))
+
+def json_random(size, seed = 1):
+    """
+    Realistic input - size randomly generated JSON documents, one per line.
+    """
+    rand = _random(seed)
+    return "".join(json.dumps(_json_value(rand, 5)) + "\n"
+                   for i in range(size))
+
+def json_flat_list(size, seed = 1):
+    """
+    A single array with size numbers in it.
+    """
+    rand = _random(seed)
+    return json.dumps([rand.randint(0, 1000000) for i in range(size)]) + "\n"
+
+def json_nested(size, seed = 1):
+    """
+    Adversarial input - arrays and objects nested size levels deep.
+    """
+    return '[{"a": ' * size + "null" + "}]" * size + "\n"
+
+def json_large(size, seed = 1):
+    """
+    A large pretty printed document, split over many lines.
+    """
+    rand = _random(seed)
+    records = [{"id": i,
+                "name": "record %d" % i,
+                "score": rand.random(),
+                "tags": ["tag%d" % rand.randint(0, 20) for j in range(3)],
+                "active": rand.random() < 0.5}
+               for i in range(size)]
+    return json.dumps({"records": records}, indent = 2) + "\n"
@@ -0,0 +1,66 @@
+# Shared sub-expressions with InternTable compared with plain tuple trees
+#
+# Usage: python -m bench.intern [lines]
+#
+# Parses generated formulas that repeat the same sub-expressions with the
+# expression example, building plain tuples and interned nodes from an
+# InternTable.  Reports the time to build the trees, the memory they
+# retain, measured with tracemalloc so this requires Python 3, and the
+# time to compare the results of two parses of the same input.
+
+import gc
+import sys
+import time
+import tracemalloc
+
+from varas import InternTable, Parser
+
+from bench import inputs
+from test.expr_example import tokenizer, expr_spec
+
+def best_time(func, repeat = 5):
+    best = None
+    gc.disable()
+    try:
+        for i in range(repeat):
+            start = time.time()
+            result = func()
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+    finally:
+        gc.enable()
+    return result, best
+
+def retained(func):
+    tracemalloc.start()
+    try:
+        result = func()
+        gc.collect()
+        return tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+def main(argv):
+    lines = int(argv[0]) if argv else 20000
+    text = inputs.arith_redundant(lines)
+    tokens = list(tokenizer.tokenize(text))
+    print("%d lines, %d tokens" % (lines, len(tokens)))
+    table = InternTable()
+    interned_spec = table.spec(expr_spec)
+    for name, spec in (("tuples", expr_spec), ("interned", interned_spec)):
+        def parse():
+            return list(Parser(spec, iter(tokens)).parse_all())
+        table.clear()
+        first, build_time = best_time(parse)
+        second = parse()
+        table.clear()
+        size = retained(parse)
+        result, compare_time = best_time(lambda: first == second)
+        assert result
+        print("%-8s build %7.3fs  %8.2fMB retained  compare %8.4fs" % (
+            name, build_time, size / 1048576.0, compare_time))
+    print("intern table: %d hits, %d misses" % (table.hits, table.misses))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
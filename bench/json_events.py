@@ -0,0 +1,61 @@
+# Memory use of the JSON event API compared with building whole documents
+#
+# Usage: python -m bench.json_events [records]
+#
+# Reads a large pretty printed JSON document from a file with
+# tokenize_file() and reports the time and peak memory of building the
+# whole document, of consuming the events from parse_events(), and of
+# extracting one field of each record with extract().  Peak memory is
+# measured with tracemalloc, so this requires Python 3.
+
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from bench import inputs
+from test.json_example import tokenizer, json, parse_events, extract
+from varas import Parser
+
+def full_parse(f):
+    return len(list(Parser(json, tokenizer.tokenize_file(f)).parse_all()))
+
+def events(f):
+    return sum(1 for event in parse_events(tokenizer.tokenize_file(f)))
+
+def extract_names(f):
+    path = ("records", "*", "name")
+    return sum(1 for name in extract(parse_events(tokenizer.tokenize_file(f)),
+                                     path))
+
+def measure(filename, func):
+    with open(filename) as f:
+        start = time.time()
+        tracemalloc.start()
+        try:
+            count = func(f)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        return count, time.time() - start, peak
+
+def main(argv):
+    sizes = [int(argv[0])] if argv else [1000, 2000, 4000, 8000]
+    for size in sizes:
+        fd, filename = tempfile.mkstemp(suffix = ".json")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(inputs.json_large(size))
+            print("%d records, %d bytes" % (size, os.path.getsize(filename)))
+            for name, func in (("parse_all", full_parse),
+                               ("parse_events", events),
+                               ("extract", extract_names)):
+                count, elapsed, peak = measure(filename, func)
+                print("  %-14s %8d results %8.3fs %8.2fMB peak" % (
+                    name, count, elapsed, peak / 1048576.0))
+        finally:
+            os.remove(filename)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
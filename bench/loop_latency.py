@@ -0,0 +1,77 @@
+# Event loop latency while parsing a large input with asyncio
+#
+# Usage: python -m bench.loop_latency [size]
+#
+# Parses a large JSON input read from an asyncio stream while a ticker
+# task measures how late its wakeups are, which is how long the event
+# loop was blocked.  This is compared with running Parser.parse_all()
+# directly in a coroutine.  Requires Python 3.6 or later.
+
+import asyncio
+import sys
+import time
+
+from varas import Parser
+from varas_async import parse_stream
+
+from bench import inputs
+from test.json_example import tokenizer, json
+
+TICK = 0.001
+
+async def ticker(delays, stop):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(TICK)
+        delays.append(time.perf_counter() - start - TICK)
+
+async def parse_blocking(data):
+    return len(list(Parser(json, tokenizer.tokenize(data.decode("utf-8")))
+                    .parse_all()))
+
+async def parse_async(data, chunk_size):
+    reader = asyncio.StreamReader()
+    reader.feed_data(data)
+    reader.feed_eof()
+    count = 0
+    async for document in parse_stream(json, tokenizer, reader,
+                                       chunk_size = chunk_size):
+        count += 1
+    return count
+
+async def measure(parse):
+    delays = []
+    stop = asyncio.Event()
+    tick_task = asyncio.ensure_future(ticker(delays, stop))
+    await asyncio.sleep(TICK * 5)
+    start = time.perf_counter()
+    count = await parse
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await tick_task
+    delays.sort()
+    return count, elapsed, delays[-1], delays[len(delays) * 99 // 100]
+
+def run(coroutine):
+    # asyncio.run() needs Python 3.7
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+def main(argv):
+    size = int(argv[0]) if argv else 2000
+    data = inputs.json_random(size).encode("utf-8")
+    print("%d bytes of JSON" % len(data))
+    runs = [("parse_all", lambda: parse_blocking(data))]
+    for chunk_size in (1024, 4096, 16384):
+        runs.append(("parse_stream chunk_size=%d" % chunk_size,
+                     lambda chunk_size = chunk_size: parse_async(data, chunk_size)))
+    for name, parse in runs:
+        count, elapsed, worst, p99 = run(measure(parse()))
+        print("%-30s %6d documents %7.3fs   max loop delay %8.2fms   "
+              "p99 %8.2fms" % (name, count, elapsed, worst * 1000, p99 * 1000))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
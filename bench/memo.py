@@ -0,0 +1,57 @@
+# Speculative parsing of an ambiguous grammar with and without the memo
+#
+# Usage: python -m bench.memo [max depth]
+#
+# '(' starts either a pair '(a, b)' or a parenthesised expression, and the
+# parser tries the pair first and rewinds if it doesn't match.  Each level
+# of nesting parses its contents twice, so without a memo the time doubles
+# with each level.  With Parser(..., memo_size) the second attempt reuses
+# the first one's results and the time is linear in the depth.
+
+import sys
+import time
+
+from varas import Assoc, ExprSpec, ParseError, Parser
+
+from test.expr_example import tokenizer, LITERAL_TOKEN
+
+def pair_or_parens(parser, expr_spec, token):
+    try:
+        with parser.mark():
+            first = parser.expression(expr_spec)
+            parser.match(",")
+            second = parser.expression(expr_spec)
+            parser.match(")")
+            return ("pair", first, second)
+    except ParseError:
+        value = parser.expression(expr_spec)
+        parser.match(")")
+        return value
+
+expr_spec = ExprSpec("pair")
+expr_spec.add_word(LITERAL_TOKEN, lambda t: int(t.content))
+expr_spec.add_binary_op("+", 10, Assoc.LEFT, lambda t, l, r: ("add", l, r))
+expr_spec.add_prefix_handler("(", pair_or_parens)
+
+def parse(text, memo_size):
+    start = time.time()
+    parser = Parser(expr_spec, tokenizer.tokenize(text), memo_size)
+    list(parser.parse_all())
+    return time.time() - start, parser
+
+def main(argv):
+    max_depth = int(argv[0]) if argv else 18
+    for depth in range(2, max_depth + 1, 2):
+        text = "(" * depth + "1 + 2, 3" + ")" * depth
+        plain, parser = parse(text, None)
+        memo, parser = parse(text, 10000)
+        print("depth %3d  no memo %9.4fs  memo %8.4fs  %6d hits %6d misses" % (
+            depth, plain, memo, parser.memo.hits, parser.memo.misses))
+    # the memo on its own, at depths that can't be parsed without it
+    for depth in (50, 100, 150):
+        text = "(" * depth + "1 + 2, 3" + ")" * depth
+        memo, parser = parse(text, 10000)
+        print("depth %3d  memo %8.4fs" % (depth, memo))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
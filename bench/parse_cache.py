@@ -0,0 +1,50 @@
+# Parsing a stream of repeated short inputs with and without ParseCache
+#
+# Usage: python -m bench.parse_cache [inputs]
+#
+# Parses a stream of short arithmetic expressions with the calc example,
+# where a few distinct inputs account for most of the stream, as they do
+# in traffic that parses the same strings over and over.  Each input is
+# parsed directly and through ParseCaches of several sizes, and the time
+# and hit rate of each are reported.
+
+import bisect
+import random
+import sys
+import time
+
+from varas import ParseCache
+
+from bench import inputs
+from test.calc_example import tokenizer, expr_spec, parse_expr
+
+def main(argv):
+    count = int(argv[0]) if argv else 50000
+    rand = random.Random(1)
+    distinct = [inputs.arith_random(1, seed).strip() for seed in range(5000)]
+    # the input of rank n is drawn with probability proportional to 1 / n
+    cumulative = []
+    total = 0.0
+    for rank in range(len(distinct)):
+        total += 1.0 / (rank + 1)
+        cumulative.append(total)
+    stream = [distinct[bisect.bisect(cumulative, rand.random() * total)]
+              for i in range(count)]
+
+    start = time.time()
+    expected = [parse_expr(text) for text in stream]
+    direct_time = time.time() - start
+    print("%d inputs, %d distinct" % (count, len(set(stream))))
+    print("no cache           %8.3fs" % direct_time)
+    for max_size in (50, 500, 5000):
+        cache = ParseCache(tokenizer, expr_spec, max_size)
+        start = time.time()
+        results = [cache.parse_list(text) for text in stream]
+        elapsed = time.time() - start
+        assert results == expected
+        print("max_size %-5d      %8.3fs  hit rate %5.1f%%  speedup %5.1fx" % (
+            max_size, elapsed, cache.stats()["hit_rate"] * 100,
+            direct_time / elapsed))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,47 @@
+# Scaling of parse_file_parallel() with the number of worker processes
+#
+# Usage: python -m bench.parse_file [documents]
+#
+# Writes a file of newline delimited JSON documents and parses it with
+# Parser.parse_all() and with parse_file_parallel() using 1, 2, 4 and 8
+# workers.
+
+import os
+import sys
+import tempfile
+import time
+
+from varas import Parser, parse_file_parallel
+
+from bench import inputs
+from test.json_example import tokenizer, json
+
+def main(argv):
+    count = int(argv[0]) if argv else 20000
+    fd, filename = tempfile.mkstemp(suffix = ".json")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(inputs.json_random(count))
+        print("%d documents, %d bytes" % (count, os.path.getsize(filename)))
+
+        start = time.time()
+        with open(filename) as f:
+            for result in Parser(json, tokenizer.tokenize_file(f)).parse_all():
+                pass
+        baseline = time.time() - start
+        print("parse_all  %7.3fs" % baseline)
+
+        for workers in (1, 2, 4, 8):
+            start = time.time()
+            for result in parse_file_parallel(json, tokenizer, filename,
+                                              workers = workers,
+                                              chunk_size = 1 << 20):
+                pass
+            elapsed = time.time() - start
+            print("%d workers %7.3fs  speedup %.2fx" % (workers, elapsed,
+                                                       baseline / elapsed))
+    finally:
+        os.remove(filename)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,33 @@
+# Scaling of parse_many() with the number of worker processes
+#
+# Usage: python -m bench.parse_many [documents]
+#
+# Parses many small JSON documents with 1, 2, 4 and 8 workers and reports
+# the throughput of each relative to parsing in a single process.
+
+import sys
+import time
+
+from varas import parse_many
+
+from bench import inputs
+from test.json_example import tokenizer, json
+
+def main(argv):
+    count = int(argv[0]) if argv else 20000
+    documents = inputs.json_random(count).splitlines()
+    print("%d documents, %d bytes" % (len(documents),
+                                      sum(len(d) for d in documents)))
+    baseline = None
+    for workers in (1, 2, 4, 8):
+        start = time.time()
+        for result in parse_many(json, tokenizer, documents, workers = workers):
+            pass
+        elapsed = time.time() - start
+        if baseline is None:
+            baseline = elapsed
+        print("%d workers %7.3fs %9.0f documents/s  speedup %.2fx" % (
+            workers, elapsed, len(documents) / elapsed, baseline / elapsed))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
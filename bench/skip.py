@@ -0,0 +1,51 @@
+# Selective extraction with Parser.skip_expression() against a full parse
+#
+# Usage: python -m bench.skip [records]
+#
+# Looks up one field of a large JSON document with the JSON example's
+# lookup(), which skips the values it doesn't need, and compares this
+# with building the whole document and indexing it.  The input is
+# tokenized up front so that only parsing is timed.
+
+import sys
+import time
+
+from varas import Parser
+
+from bench import inputs
+from test.json_example import tokenizer, json, lookup
+
+def best_time(func, repeat = 5):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        result = func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return result, best
+
+def main(argv):
+    size = int(argv[0]) if argv else 5000
+    tokens = list(tokenizer.tokenize(inputs.json_large(size)))
+    print("%d records, %d tokens" % (size, len(tokens)))
+    paths = [("records", 0, "name"),
+             ("records", size // 2, "name"),
+             ("records", size - 1, "tags", 2)]
+    for path in paths:
+        def full():
+            value = Parser(json, iter(tokens)).parse()
+            for key in path:
+                value = value[key]
+            return value
+        def selective():
+            return lookup(Parser(json, iter(tokens)), path)
+        full_value, full_time = best_time(full)
+        value, selective_time = best_time(selective)
+        assert value == full_value
+        print("%-28s full parse %7.4fs  skipping %7.4fs  speedup %5.1fx" % (
+            "/".join(str(key) for key in path), full_time, selective_time,
+            full_time / selective_time))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
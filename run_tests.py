@@ -5,6 +5,7 @@ import doctest
 import os
 import os.path
 import glob
+import sys
 
 from test.calc_example import TestCalc
 from test.expr_example import TestExpr
@@ -14,6 +15,10 @@ tests = [ TestCalc,
           TestExpr,
           TestJson ]
 
+if sys.version_info >= (3, 6):
+    from test.async_example import TestAsync
+    tests.append(TestAsync)
+
 doc_dirs = [ "",
              "doc/" ]
 
@@ -5,7 +5,7 @@ setup(name = 'Varas',
       description = 'Pratt parser framework',
       author = 'Jon Coppeard',
       author_email = 'jon@coppeard.net',
-      py_modules = [ 'varas' ],
+      py_modules = [ 'varas', 'varas_async' ],
       url = "https://github.com/JonCoppeard/varas",
       classifiers = [
           "Programming Language :: Python",
@@ -0,0 +1,83 @@
+# Example of parsing JSON documents read from an asyncio stream
+#
+# Requires Python 3.6 or later.
+
+from varas import *
+from varas_async import tokenize_stream, parse_stream
+from test.json_example import tokenizer, json, NUMBER_TOKEN, STRING_TOKEN
+import asyncio
+import sys
+
+async def parse_documents(reader):
+    """Parse a stream of JSON documents and return a list of them"""
+    return [document async for document in parse_stream(json, tokenizer, reader)]
+
+def reader_for(data, eof = True):
+    # must be called with the event loop running
+    reader = asyncio.StreamReader()
+    reader.feed_data(data)
+    if eof:
+        reader.feed_eof()
+    return reader
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+import unittest
+
+class TestAsync(unittest.TestCase):
+
+    def test_parse(self):
+        source = '{"a": [1, 2.5, "é"]}\n[true, null] "x"'.encode("utf-8")
+        expected = [{"a": [1, 2.5, "é"]}, [True, None], "x"]
+        async def parse():
+            return await parse_documents(reader_for(source))
+        self.assertEqual(expected, run(parse()))
+        async def parse_in_chunks():
+            reader = reader_for(source)
+            return [document async for document in
+                    parse_stream(json, tokenizer, reader, chunk_size = 3)]
+        self.assertEqual(expected, run(parse_in_chunks()))
+
+    def test_tokenize(self):
+        async def tokenize():
+            reader = reader_for(b'[1,\n"a"]')
+            return [(token.type, token.line_pos, token.column_pos)
+                    async for token in tokenize_stream(tokenizer, reader)]
+        self.assertEqual([("[", 1, 1), (NUMBER_TOKEN, 1, 2), (",", 1, 3),
+                          (STRING_TOKEN, 2, 3), ("]", 2, 4),
+                          (Token.END_TOKEN, 3, 0)], run(tokenize()))
+
+    def test_error(self):
+        async def parse():
+            return await parse_documents(reader_for(b'[1, 2] [3'))
+        self.assertRaises(ParseError, run, parse())
+
+    def test_incremental(self):
+        # results are produced before the end of the stream, and the
+        # parser is stopped when the generator is closed
+        async def first_document():
+            reader = reader_for(b'[1] [2, 3', eof = False)
+            documents = parse_stream(json, tokenizer, reader)
+            document = await documents.__anext__()
+            await documents.aclose()
+            return document
+        self.assertEqual([1], run(first_document()))
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "-t":
+        sys.argv.pop(1)
+        unittest.main()
+    else:
+        async def main():
+            loop = asyncio.get_event_loop()
+            reader = asyncio.StreamReader()
+            protocol = asyncio.StreamReaderProtocol(reader)
+            await loop.connect_read_pipe(lambda: protocol, sys.stdin)
+            async for document in parse_stream(json, tokenizer, reader):
+                print(repr(document))
+        run(main())
@@ -1,27 +1,22 @@
 # Example parser that calculates the result of an expression
 
 from varas import *
+import operator
 import sys
+import gc
 import re
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 LITERAL_TOKEN = 1
+NAME_TOKEN = 2
 
 tokenizer = Tokenizer(("\d+", LITERAL_TOKEN),
+                      ("[A-Za-z_]\w*", NAME_TOKEN),
                       (".",   None))
 
-def handle_lparen(parser, actions, token):
-    expr = parser.expression(actions)
-    parser.match(")")
-    return expr
-
-def handle_lsquare(parser, actions, token):
-    result = []
-    while not parser.opt("]"):
-        if result:
-            parser.match(",")
-        result.append(parser.expression(actions))
-    return result
-
 expr_spec = ExprSpec()
 expr_spec.add_word(LITERAL_TOKEN, lambda token: int(token.content))
 expr_spec.add_unary_op("+", lambda token, right: right)
@@ -31,12 +26,128 @@ expr_spec.add_binary_op("-", 10, Assoc.LEFT, lambda t, l, r: l - r)
 expr_spec.add_binary_op("*", 20, Assoc.LEFT, lambda t, l, r: l * r)
 expr_spec.add_binary_op("/", 20, Assoc.LEFT, lambda t, l, r: l / r)
 expr_spec.add_binary_op("^", 30, Assoc.RIGHT, lambda t, l, r: l ** r)
-expr_spec.add_prefix_handler("(", handle_lparen)
-expr_spec.add_prefix_handler("[", handle_lsquare)
+expr_spec.add_parens("(", ")")
+expr_spec.add_list("[", "]", ",", lambda t, items: items)
 
 def parse_expr(input):
     return list(Parser(expr_spec, tokenizer.tokenize(input)).parse_all())
 
+# Expressions that are evaluated many times can instead be compiled to a
+# tree of closures, each of which takes a dict of variable values
+
+def compile_constant(value):
+    return lambda variables: value
+
+def compile_variable(name):
+    return lambda variables: variables[name]
+
+def compile_unary(func):
+    def compile(token, right):
+        return lambda variables: func(right(variables))
+    return compile
+
+def compile_binary(func):
+    def compile(token, left, right):
+        return lambda variables: func(left(variables), right(variables))
+    return compile
+
+def compile_list(token, items):
+    return lambda variables: [item(variables) for item in items]
+
+# Division and powers of NumPy arrays, as used by evaluate_columns(), don't
+# behave like they do for Python numbers, so these check for the cases that
+# differ
+
+def is_array(value):
+    return numpy is not None and isinstance(value, numpy.ndarray)
+
+def divide(left, right):
+    # NumPy returns inf or nan rather than raising
+    if (is_array(left) or is_array(right)) and numpy.any(numpy.equal(right, 0)):
+        raise ZeroDivisionError("division by zero")
+    return left / right
+
+def power(left, right):
+    if is_array(left) or is_array(right):
+        negative = numpy.less(right, 0)
+        if numpy.any(negative & numpy.equal(left, 0)):
+            # NumPy returns inf rather than raising
+            raise ZeroDivisionError("0.0 cannot be raised to a negative power")
+        if numpy.any(negative):
+            # NumPy doesn't allow negative integer powers of integers, which
+            # give a float in Python
+            left = numpy.asarray(left, float)
+    return left ** right
+
+compile_spec = ExprSpec("compile")
+compile_spec.add_word(LITERAL_TOKEN,
+                      lambda token: compile_constant(int(token.content)))
+compile_spec.add_word(NAME_TOKEN, lambda token: compile_variable(token.content))
+compile_spec.add_unary_op("+", lambda token, right: right)
+compile_spec.add_unary_op("-", compile_unary(operator.neg))
+compile_spec.add_binary_op("+", 10, Assoc.LEFT, compile_binary(operator.add))
+compile_spec.add_binary_op("-", 10, Assoc.LEFT, compile_binary(operator.sub))
+compile_spec.add_binary_op("*", 20, Assoc.LEFT, compile_binary(operator.mul))
+compile_spec.add_binary_op("/", 20, Assoc.LEFT, compile_binary(divide))
+compile_spec.add_binary_op("^", 30, Assoc.RIGHT, compile_binary(power))
+compile_spec.add_parens("(", ")")
+compile_spec.add_list("[", "]", ",", compile_list)
+compile_spec.freeze()
+
+"""Compiled expressions by source text, see compile_expr()"""
+compiled_exprs = LRUCache(256)
+
+def compile_expr(source):
+    # Return a function that evaluates the single expression in source,
+    # taking the values of its variables as keyword arguments.  Functions
+    # are cached, so compiling the same source again doesn't tokenize or
+    # parse it.
+    func = compiled_exprs.get(source)
+    if func is None:
+        parser = Parser(compile_spec, tokenizer.tokenize(source))
+        body = parser.parse()
+        if not parser.at_end():
+            raise ParseError(parser.token, "Expected end of input")
+        def func(**variables):
+            return body(variables)
+        compiled_exprs.put(source, func)
+    return func
+
+def evaluate_columns(source, columns, rows = None, chunk_size = 65536):
+    # Evaluate the expression in source for many rows of variable values
+    # at once using NumPy, given a dict mapping variable names to arrays
+    # of values with one element per row.  The compiled closures apply
+    # each operator to whole arrays, which NumPy does with a single ufunc
+    # call.  Rows are evaluated in chunks of chunk_size so that the
+    # temporary arrays stay small.  The results are returned as an array,
+    # and are the same as evaluating each row with compile_expr() as long
+    # as the values fit in the arrays' types, except that a row that
+    # raises an error, such as division by zero, raises it for the whole
+    # evaluation.  rows is only needed if there are no variables.
+    assert numpy is not None, "evaluate_columns() requires NumPy"
+    func = compile_expr(source)
+    columns = dict((name, numpy.asarray(values))
+                   for name, values in columns.items())
+    lengths = set(len(values) for values in columns.values())
+    if rows is not None:
+        lengths.add(rows)
+    if len(lengths) > 1:
+        raise ValueError("Columns have different numbers of rows")
+    if rows is None:
+        assert lengths, "rows must be given if there are no columns"
+        rows = lengths.pop()
+    # chunks can have different types, e.g. if a negative power only
+    # occurs in some of them
+    chunks = []
+    for start in range(0, rows, chunk_size):
+        end = min(start + chunk_size, rows)
+        chunk = func(**dict((name, values[start:end])
+                            for name, values in columns.items()))
+        chunks.append(numpy.broadcast_to(chunk, (end - start,)))
+    if not chunks:
+        return numpy.empty(0)
+    return numpy.concatenate(chunks)
+
 import unittest
 
 class TestCalc(unittest.TestCase):
@@ -101,6 +212,143 @@ class TestCalc(unittest.TestCase):
         self.checkCount(1, "1")
         self.checkCount(2, "1 2 * 3")
 
+    def test_frozen(self):
+        frozen_spec = ExprSpec(expr_spec.name, expr_spec)
+        frozen_spec.freeze()
+        compiled_spec = ExprSpec(expr_spec.name, expr_spec)
+        compiled_spec.compile()
+        iterative_spec = ExprSpec(expr_spec.name, expr_spec)
+        iterative_spec.freeze(iterative = True)
+        table_spec = ExprSpec(expr_spec.name, expr_spec)
+        table_spec.max_compared_types = 0
+        table_spec.compile()
+        def parse(spec, input):
+            try:
+                return list(Parser(spec, tokenizer.tokenize(input)).parse_all())
+            except ParseError as e:
+                return str(e)
+        for input in ("2 + 3 * 4", "(2 + (3 - 1)) * 4", "2 ^ 1 ^ 2", "-2 ^ 2",
+                      "[1 + 1, [4, 5, (6)]]", "1 2 * 3", "1 * * 2", "1 )",
+                      "1 +", "[1,", ")", "[]", "[1 2]", "[1,]", "(1", "(1 2)",
+                      "- - 3 * 2 ^ 2", "1 - 2 - 3\n4"):
+            expected = parse(expr_spec, input)
+            self.assertEqual(expected, parse(frozen_spec, input))
+            self.assertEqual(expected, parse(compiled_spec, input))
+            self.assertEqual(expected, parse(iterative_spec, input))
+            self.assertEqual(expected, parse(table_spec, input))
+        self.assertRaises(AssertionError, frozen_spec.add_word, "x", int)
+        self.assertRaises(AssertionError, compiled_spec.add_word, "x", int)
+
+    def test_compile(self):
+        for input in ("2 + 3 * 4", "(2 + (3 - 1)) * 4", "2 ^ 1 ^ 2", "-2 ^ 2",
+                      "[1 + 1, [4, 5, (6)]]", "- - 3 * 2 ^ 2", "15 / 3 - +4"):
+            self.assertEqual(parse_expr(input), [compile_expr(input)()])
+        func = compile_expr("x * (y + 2) - -x")
+        self.assertEqual(21, func(x = 3, y = 4))
+        self.assertEqual(-6, func(x = -1, y = 3))
+        self.assertRaises(KeyError, func, x = 1)
+        for input in ("1 +", "1 2", "x y", "(x"):
+            self.assertRaises(ParseError, compile_expr, input)
+
+    def test_compile_cache(self):
+        compiled_exprs.clear()
+        hits, misses = compiled_exprs.hits, compiled_exprs.misses
+        func = compile_expr("a + b")
+        self.assertTrue(func is compile_expr("a + b"))
+        self.assertEqual((hits + 1, misses + 1),
+                         (compiled_exprs.hits, compiled_exprs.misses))
+        for i in range(compiled_exprs.max_size + 1):
+            compile_expr("a + %d" % i)
+        self.assertEqual(compiled_exprs.max_size, len(compiled_exprs))
+        self.assertFalse("a + b" in compiled_exprs)
+        self.assertTrue("a + %d" % compiled_exprs.max_size in compiled_exprs)
+        self.assertTrue(compiled_exprs.evictions > 0)
+
+    @unittest.skipIf(numpy is None, "requires NumPy")
+    def test_evaluate_columns(self):
+        a = numpy.arange(1, 101)
+        b = numpy.arange(100, 0, -1) % 7
+        source = "a * (b + 3) - -b ^ 2 + a / (b + 1)"
+        results = evaluate_columns(source, {"a": a, "b": b}, chunk_size = 7)
+        func = compile_expr(source)
+        self.assertEqual([func(a = int(x), b = int(y)) for x, y in zip(a, b)],
+                         results.tolist())
+        self.assertEqual([3, 3], evaluate_columns("1 + 2", {}, 2).tolist())
+        self.assertEqual(0, len(evaluate_columns("a", {"a": []})))
+        a = numpy.array([-3, -2, -1, 1, 2, 3, 4])
+        b = numpy.arange(1, 8)
+        for source in ("a ^ -1 + b", "2 ^ -a", "b ^ a", "a / b", "-b ^ -2"):
+            results = evaluate_columns(source, {"a": a, "b": b}, chunk_size = 4)
+            func = compile_expr(source)
+            self.assertEqual([func(a = int(x), b = int(y)) for x, y in zip(a, b)],
+                             results.tolist())
+        a = numpy.arange(-3, 4)
+        for source in ("b / a", "a ^ -1", "b / (a - a)"):
+            self.assertRaises(ZeroDivisionError, compile_expr(source), a = 0, b = 1)
+            self.assertRaises(ZeroDivisionError, evaluate_columns, source,
+                              {"a": a, "b": b})
+        self.assertRaises(ValueError, evaluate_columns, "a + b",
+                          {"a": a, "b": b[1:]})
+        self.assertRaises(ValueError, evaluate_columns, "a", {"a": a}, 3)
+
+    def test_deep(self):
+        iterative_spec = ExprSpec(expr_spec.name, expr_spec)
+        iterative_spec.freeze(iterative = True)
+        def parse(input):
+            return list(Parser(iterative_spec, tokenizer.tokenize(input)).parse_all())
+        depth = sys.getrecursionlimit() * 2
+        self.assertEqual([5], parse("(" * depth + "2 + 3" + ")" * depth))
+        self.assertEqual([1], parse(" ^ ".join(["1"] * depth)))
+        self.assertEqual([-1], parse("-" * (depth + 1) + "1"))
+        result = parse("[" * depth + "]" * depth)[0]
+        for i in range(depth - 1):
+            self.assertEqual(1, len(result))
+            result = result[0]
+        self.assertEqual([], result)
+        self.assertRaises(ParseError, parse, "(" * depth + "1" + ")" * (depth - 1))
+
+    def test_profile(self):
+        parser = ProfilingParser(expr_spec, tokenizer.tokenize("1 + 2 * (3 - 4) - -5\n7"))
+        self.assertEqual([4, 7], list(parser.parse_all()))
+        report = parser.report()
+        self.assertEqual({LITERAL_TOKEN: 6, "+": 1, "*": 1, "-": 3, "(": 1,
+                          ")": 1, Token.END_TOKEN: 1}, report["token_counts"])
+        calls = dict(((h["position"], h["token_type"]), h["calls"])
+                     for h in report["handlers"])
+        self.assertEqual({("prefix", LITERAL_TOKEN): 6, ("prefix", "("): 1,
+                          ("prefix", "-"): 1, ("infix", "+"): 1,
+                          ("infix", "*"): 1, ("infix", "-"): 2}, calls)
+        self.assertEqual(5, report["max_depth"])
+        for handler in report["handlers"]:
+            self.assertTrue(0 <= handler["self_time"] <= handler["total_time"])
+        parser = ProfilingParser(expr_spec, tokenizer.tokenize("1 * * 2"))
+        self.assertRaises(ParseError, parser.parse)
+
+    def test_push(self):
+        parser = PushParser(expr_spec, tokenizer)
+        self.assertEqual([], parser.feed("1 + 2"))
+        self.assertEqual([21], parser.feed("0 [3,"))
+        self.assertEqual([], parser.feed(" 4]\n5"))
+        self.assertEqual([[3, 4]], parser.feed(" * 6"))
+        self.assertEqual([30], parser.close())
+        parser = PushParser(expr_spec, tokenizer)
+        self.assertEqual([1], parser.feed("1 ( 2 "))
+        self.assertRaises(ParseError, parser.close)
+        def abandon():
+            with PushParser(expr_spec, tokenizer) as parser:
+                parser.feed("1 +")
+                raise KeyError()
+        self.assertRaises(KeyError, abandon)
+        # the thread is stopped when a parser is dropped without closing it
+        parser = PushParser(expr_spec, tokenizer)
+        parser.feed("1 +\n")
+        thread = parser.state.thread
+        self.assertTrue(thread.is_alive())
+        del parser
+        gc.collect()
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+
 if __name__ == '__main__':
     if len(sys.argv) > 1 and sys.argv[1] == "-t":
         sys.argv.pop(1)
@@ -3,25 +3,13 @@
 from varas import *
 import sys
 import re
+import gc
 
 LITERAL_TOKEN = 1
 
 tokenizer = Tokenizer(("\d+", LITERAL_TOKEN),
                       (".",   None))
 
-def handle_lparen(parser, actions, token):
-    expr = parser.expression(actions)
-    parser.match(")")
-    return expr
-
-def handle_lsquare(parser, actions, token):
-    result = []
-    while not parser.opt("]"):
-        if result:
-            parser.match(",")
-        result.append(parser.expression(actions))
-    return ("list", result)
-
 def parse_expr(input):
     return list(Parser(expr_spec, tokenizer.tokenize(input)).parse_all())
 
@@ -34,8 +22,30 @@ expr_spec.add_binary_op("-", 10, Assoc.LEFT, lambda t, l, r: ("sub", l, r))
 expr_spec.add_binary_op("*", 20, Assoc.LEFT, lambda t, l, r: ("mul", l, r))
 expr_spec.add_binary_op("/", 20, Assoc.LEFT, lambda t, l, r: ("div", l, r))
 expr_spec.add_binary_op("^", 30, Assoc.RIGHT, lambda t, l, r: ("pow", l, r))
-expr_spec.add_prefix_handler("(", handle_lparen)
-expr_spec.add_prefix_handler("[", handle_lsquare)
+expr_spec.add_parens("(", ")")
+expr_spec.add_list("[", "]", ",", lambda t, items: ("list", items))
+
+# Alternatively the AST can be stored in an arena
+arena = ASTArena()
+arena_spec = arena.spec(expr_spec)
+
+def parse_arena(input):
+    arena.clear()
+    return list(Parser(arena_spec, tokenizer.tokenize(input)).parse_all())
+
+op_names = {"+": "add", "-": "sub", "*": "mul", "/": "div", "^": "pow"}
+
+def node_tuple(node):
+    # convert an arena node to the same tuples as expr_spec produces
+    kind = node.kind
+    if kind == "word":
+        return node.value
+    children = [node_tuple(child) for child in node.children]
+    if kind == "unary":
+        return ("neg", children[0]) if node.type == "-" else children[0]
+    if kind == "binary":
+        return (op_names[node.type], children[0], children[1])
+    return ("list", children)
 
 import unittest
 
@@ -55,6 +65,233 @@ class TestExpr(unittest.TestCase):
         self.check(("mul", 1, ("add", 2, 3)), "1*(2+3)")
         self.check(("list", [1, 2, 3]), "[1, 2, 3]")
 
+    def test_compiled(self):
+        compiled_spec = ExprSpec(expr_spec.name, expr_spec)
+        compiled_spec.compile()
+        input = "-1 + 2 * (3 - 4) / 5 ^ 6 ^ 7 [1, +2, [3]]"
+        self.assertEqual(parse_expr(input),
+                         list(Parser(compiled_spec,
+                                     tokenizer.tokenize(input)).parse_all()))
+
+    def test_arena(self):
+        input = "-1 + 2 * (3 - 4) / 5 ^ 6 ^ 7 [1, +2, [3]] 8"
+        roots = parse_arena(input)
+        self.assertEqual(parse_expr(input),
+                         [node_tuple(arena.node(root)) for root in roots])
+        node = arena.node(roots[0])
+        self.assertEqual(("binary", "+"), (node.kind, node.type))
+        self.assertEqual(("unary", "-"), (node.children[0].kind,
+                                          node.children[0].type))
+        self.assertEqual(1, node.children[0].children[0].value)
+        self.assertEqual(None, node.value)
+        self.assertEqual(21, len(arena))
+        # offsets are recorded for tokens that have them
+        arena.clear()
+        compiled_spec = arena.spec(expr_spec)
+        compiled_spec.compile()
+        root = Parser(compiled_spec,
+                      tokenizer.tokenize("1 +\n 23", positions = "lazy")).parse()
+        node = arena.node(root)
+        self.assertEqual([1, 7], [child.offset for child in node.children])
+        self.assertEqual(("add", 1, 23), node_tuple(node))
+
+    def test_intern(self):
+        table = InternTable()
+        interned_spec = table.spec(expr_spec)
+        def parse_interned(input):
+            return list(Parser(interned_spec,
+                               tokenizer.tokenize(input)).parse_all())
+        input = "(1 + 2 * -3) ^ (1 + 2 * -3) [1 + 2, -(1 + 2)] 1 + 2 * -3"
+        results = parse_interned(input)
+        self.assertEqual(parse_expr(input), results)
+        self.assertTrue(results[0][1] is results[0][2])
+        self.assertTrue(results[1][1][0] is results[1][1][1][1])
+        self.assertTrue(results[0][1] is results[2])
+        self.assertTrue(isinstance(results[2], InternedNode))
+        self.assertEqual(7, table.hits)
+        # results are shared between parses until the table is cleared
+        self.assertTrue(parse_interned("1 + 2")[0] is results[1][1][0])
+        table.clear()
+        self.assertFalse(parse_interned("1 + 2")[0] is results[1][1][0])
+        # entries are dropped with the results
+        del results
+        gc.collect()
+        self.assertEqual(0, len(table))
+        compiled_spec = table.spec(expr_spec)
+        compiled_spec.compile()
+        result = Parser(compiled_spec, tokenizer.tokenize("2^2 * 2^2")).parse()
+        self.assertTrue(result[1] is result[2])
+        # operands that compare equal but have different types are distinct
+        number_tokenizer = Tokenizer(("\d+\.\d*", "FLOAT"),
+                                     ("\d+", LITERAL_TOKEN),
+                                     (".", None))
+        number_spec = ExprSpec("number", expr_spec)
+        number_spec.add_word("FLOAT", lambda t: float(t.content))
+        number_spec = InternTable().spec(number_spec)
+        def parse_number(input):
+            return Parser(number_spec, number_tokenizer.tokenize(input)).parse()
+        self.assertEqual(float, type(parse_number("1.0 + 2")[1]))
+        self.assertEqual(int, type(parse_number("1 + 2")[1]))
+        self.assertEqual(int, type(parse_number("-(1.0 + 2) + -(1 + 2)")[2][1][1]))
+
+    def test_lookahead(self):
+        parser = Parser(expr_spec, tokenizer.tokenize("1 + 2 * 3"))
+        self.assertEqual("1", parser.peek(0).content)
+        self.assertEqual("+", parser.peek().type)
+        self.assertEqual("3", parser.peek(4).content)
+        self.assertEqual(Token.END_TOKEN, parser.peek(10).type)
+        self.assertEqual(None, parser.opt2(LITERAL_TOKEN, "*"))
+        with parser.mark() as outer:
+            self.assertTrue(parser.opt2(LITERAL_TOKEN, "+"))
+            inner = parser.mark()
+            self.assertEqual(("mul", 2, 3), parser.parse())
+            parser.rewind(inner)
+            self.assertEqual("2", parser.token.content)
+            outer.rewind()
+        self.assertEqual([], parser.marks)
+        self.assertEqual(None, parser.history)
+        self.assertEqual([("add", 1, ("mul", 2, 3))], list(parser.parse_all()))
+
+    def test_speculative(self):
+        # parse a pair of numbers if possible, otherwise an expression
+        compiled_spec = ExprSpec(expr_spec.name, expr_spec)
+        compiled_spec.compile()
+        def parse_items(input):
+            parser = Parser(compiled_spec, tokenizer.tokenize(input))
+            results = []
+            while not parser.at_end():
+                try:
+                    with parser.mark():
+                        first = int(parser.match(LITERAL_TOKEN).content)
+                        second = int(parser.match(LITERAL_TOKEN).content)
+                        results.append(("pair", first, second))
+                except ParseError:
+                    results.append(parser.parse())
+            self.assertEqual(0, len(parser.lookahead))
+            return results
+        self.assertEqual([("add", 1, 2), ("pair", 3, 4), ("list", [5])],
+                         parse_items("1 + 2 3 4 [5]"))
+        self.assertRaises(ParseError, parse_items, "1 2 * 3")
+        # tokens can still be pushed back onto the token stack
+        parser = Parser(expr_spec, tokenizer.tokenize("1 + 2 * 3"))
+        first = parser.token
+        parser.next_token()
+        self.assertEqual("3", parser.peek(3).content)
+        parser.token_stack.append(parser.token)
+        parser.token = first
+        self.assertEqual(["+", "2", "*", "3"],
+                         [t.content for t in reversed(list(parser.token_stack))])
+        self.assertEqual(("add", 1, ("mul", 2, 3)), parser.parse())
+        self.assertEqual(0, len(parser.token_stack))
+
+    def test_skip(self):
+        parser = Parser(expr_spec,
+                        tokenizer.tokenize("1 + -(2 * [3, [4]]) - 5 6 * 7 + 8"))
+        parser.skip_expression(expr_spec)
+        self.assertEqual("6", parser.token.content)
+        parser.skip_expression(expr_spec, 10)
+        self.assertEqual("+", parser.token.type)
+        parser = Parser(expr_spec, tokenizer.tokenize("[1, (2], 3) 4"))
+        self.assertRaises(ParseError, parser.skip_expression, expr_spec)
+        parser = Parser(expr_spec, tokenizer.tokenize("[1, (2], 3) 4"))
+        parser.skip_balanced("[", "]")
+        self.assertEqual(",", parser.token.type)
+        self.assertRaises(ParseError, parser.skip_balanced, "[", "]")
+        for input in ("(1 + 2", "1 +", ")"):
+            parser = Parser(expr_spec, tokenizer.tokenize(input))
+            self.assertRaises(ParseError, parser.skip_expression, expr_spec)
+
+    def test_memo(self):
+        # '(' starts either a pair or a parenthesised expression, which
+        # takes exponential time in the nesting depth without the memo
+        pair_spec = ExprSpec("pair")
+        pair_spec.add_word(LITERAL_TOKEN, lambda t: int(t.content))
+        pair_spec.add_binary_op("+", 10, Assoc.LEFT,
+                                lambda t, l, r: ("add", l, r))
+        calls = [0]
+        def pair_or_parens(parser, spec, token):
+            calls[0] += 1
+            try:
+                with parser.mark():
+                    first = parser.expression(spec)
+                    parser.match(",")
+                    second = parser.expression(spec)
+                    parser.match(")")
+                    return ("pair", first, second)
+            except ParseError:
+                value = parser.expression(spec)
+                parser.match(")")
+                return value
+        pair_spec.add_prefix_handler("(", pair_or_parens)
+        def parse(input, memo_size = None):
+            calls[0] = 0
+            parser = Parser(pair_spec, tokenizer.tokenize(input), memo_size)
+            return list(parser.parse_all()), calls[0], parser
+        input = "(" * 12 + "1, 2" + ")" * 12 + " (3 + 4)"
+        expected = [("pair", 1, 2), ("add", 3, 4)]
+        result, slow_calls, parser = parse(input)
+        self.assertEqual(expected, result)
+        result, memo_calls, parser = parse(input, 100)
+        self.assertEqual(expected, result)
+        self.assertEqual(13, memo_calls)
+        self.assertTrue(slow_calls > 1000)
+        self.assertTrue(parser.memo.hits > 0)
+        self.assertTrue(len(parser.history) < 10)
+        result, calls_small, parser = parse(input, 4)
+        self.assertEqual(expected, result)
+        self.assertTrue(parser.memo.evictions > 0)
+        for input in ("((1, 2)", "((1 2))", "(1, 2))"):
+            self.assertRaises(ParseError, parse, input, 100)
+        # a cached error is replayed as a new exception
+        parser = Parser(expr_spec, tokenizer.tokenize("1 + )"), 100)
+        errors = []
+        for i in range(2):
+            try:
+                with parser.mark():
+                    parser.expression(expr_spec)
+            except ParseError as e:
+                errors.append(e)
+        self.assertEqual(1, parser.memo.hits)
+        self.assertTrue(errors[0] is not errors[1])
+        self.assertEqual(str(errors[0]), str(errors[1]))
+
+    def test_parse_cache(self):
+        cache = ParseCache(tokenizer, expr_spec, max_size = 3, max_bytes = 20)
+        result = cache.parse_list("1 + 2 * 3")
+        self.assertEqual(parse_expr("1 + 2 * 3"), result)
+        self.assertTrue(cache.parse_list("1 + 2 * 3") is result)
+        errors = []
+        for i in range(2):
+            try:
+                cache.parse_list("1 +")
+            except ParseError as e:
+                errors.append(e)
+        self.assertTrue(errors[0] is not errors[1])
+        self.assertEqual(str(errors[0]), str(errors[1]))
+        stats = cache.stats()
+        self.assertEqual((2, 12, 2, 2), (stats["size"], stats["cost"],
+                                          stats["hits"], stats["misses"]))
+        self.assertEqual(0.5, stats["hit_rate"])
+        # the total length of the inputs is limited
+        cache.parse_list("1 + 2 + 3 + 4 + 5")
+        self.assertEqual((2, 20, 1), (len(cache.cache), cache.cache.cost,
+                                      cache.cache.evictions))
+        cache.parse_list("(1 + 2) * (3 + 4) * (5 + 6)")
+        self.assertEqual((0, 0), (len(cache.cache), cache.cache.cost))
+        # and so is the number of inputs
+        for input in ("1", "2", "3", "4"):
+            cache.parse_list(input)
+        self.assertEqual(["2", "3", "4"],
+                         [key[0] for key in cache.cache.entries])
+        # another spec doesn't share results
+        other_spec = ExprSpec()
+        other_spec.add_word(LITERAL_TOKEN, lambda t: -int(t.content))
+        self.assertEqual([-4], cache.parse_list("4", other_spec))
+        self.assertEqual([4], cache.parse_list("4"))
+        copying = ParseCache(tokenizer, expr_spec, copy_results = True)
+        copying.parse_list("1 + 2").append(None)
+        self.assertEqual(parse_expr("1 + 2"), copying.parse_list("1 + 2"))
+
 if __name__ == '__main__':
     if len(sys.argv) > 1 and sys.argv[1] == "-t":
         sys.argv.pop(1)
@@ -4,6 +4,9 @@
 from varas import *
 import sys
 import re
+import os
+import tempfile
+import multiprocessing
 
 STRING_TOKEN = 1
 NUMBER_TOKEN = 2
@@ -52,26 +55,149 @@ def handle_object(parser, expr_spec, token):
         result[key] = value
     return result
 
-def handle_array(parser, expr_spec, token):
-    result = []
-    while not parser.opt("]"):
-        if result:
-            parser.match(",")
-        result.append(parser.expression(expr_spec))
-    return result
-
 json = ExprSpec()
 json.add_word(STRING_TOKEN, handle_string)
 json.add_word(NUMBER_TOKEN, handle_number)
 json.add_prefix_handler("{", handle_object)
-json.add_prefix_handler("[", handle_array)
+json.add_list("[", "]", ",", lambda t, items: items)
 json.add_word("true", lambda t: True)
 json.add_word("false", lambda t: False)
 json.add_word("null", lambda t: None)
+json.add_brackets("{", "}")
 
 def parse_expr(input):
     return list(Parser(json, tokenizer.tokenize(input)).parse_all())
 
+def setup_worker():
+    # used by parse_many() workers that are not forked
+    return json, tokenizer
+
+def parse_key(parser):
+    key = handle_string(parser.match(STRING_TOKEN))
+    parser.match(":")
+    return key
+
+def parse_events(tokens):
+    # Parse JSON documents without building them, yielding (event, value)
+    # tuples: ("start_object", None), ("key", key), ("end_object", None),
+    # ("start_array", None), ("end_array", None) and ("value", value) for
+    # strings, numbers, true, false and null.  Only the closing bracket
+    # of each open object and array is kept, so memory use depends on the
+    # depth of nesting rather than the size of the input.
+    parser = Parser(json, tokens)
+    closers = []
+    while closers or not parser.at_end():
+        token = parser.token
+        if token.type == "{" or token.type == "[":
+            parser.next_token()
+            if token.type == "{":
+                yield ("start_object", None)
+                closers.append("}")
+            else:
+                yield ("start_array", None)
+                closers.append("]")
+            if parser.not_followed_by(closers[-1]):
+                if closers[-1] == "}":
+                    yield ("key", parse_key(parser))
+                continue
+        else:
+            yield ("value", parser.expression(json))
+        # close the objects and arrays that end after this value
+        while closers:
+            closer = closers[-1]
+            if parser.opt(closer):
+                closers.pop()
+                yield ("end_object" if closer == "}" else "end_array", None)
+                continue
+            parser.match(",")
+            if closer == "}":
+                yield ("key", parse_key(parser))
+            break
+
+def lookup(parser, path, default = None):
+    # Parse the next document and return the value at a path of object
+    # keys and array indexes in it, or default if there is none.  Only
+    # that value is built, and the rest of the document is skipped.
+    if not path:
+        return parser.expression(json)
+    key = path[0]
+    value = default
+    if parser.opt("{"):
+        first = True
+        while not parser.opt("}"):
+            if not first:
+                parser.match(",")
+            first = False
+            if parse_key(parser) == key:
+                value = lookup(parser, path[1:], default)
+            else:
+                parser.skip_expression(json)
+    elif parser.opt("["):
+        index = 0
+        while not parser.opt("]"):
+            if index:
+                parser.match(",")
+            if index == key:
+                value = lookup(parser, path[1:], default)
+            else:
+                parser.skip_expression(json)
+            index += 1
+    else:
+        parser.skip_expression(json)
+    return value
+
+def extract(events, path):
+    # Yield the values found at a path in the documents described by the
+    # events from parse_events().  The path is a sequence of object keys
+    # and array indexes, in which "*" matches any key or index.  Only the
+    # values that match are built.
+    path = tuple(path)
+    location = []   # the key or index of the current value in each
+                    # open object or array outside the matched value
+    in_array = []
+    building = []   # [container, key] for each object or array of the
+                    # matched value that is being built
+    for event, value in events:
+        if event == "key":
+            if building:
+                building[-1][1] = value
+            else:
+                location[-1] = value
+            continue
+        if event == "end_object" or event == "end_array":
+            if not building:
+                location.pop()
+                in_array.pop()
+                continue
+            value = building.pop()[0]
+            if not building:
+                yield value
+                continue
+        elif building:
+            if event != "value":
+                building.append([{} if event == "start_object" else [], None])
+                continue
+        else:
+            if in_array and in_array[-1]:
+                location[-1] += 1
+            if len(location) == len(path) and \
+               all(p == "*" or p == l for p, l in zip(path, location)):
+                if event == "value":
+                    yield value
+                else:
+                    building.append([{} if event == "start_object" else [],
+                                     None])
+                continue
+            if event != "value":
+                location.append(-1 if event == "start_array" else None)
+                in_array.append(event == "start_array")
+            continue
+        container, key = building[-1]
+        if isinstance(container, list):
+            container.append(value)
+        else:
+            container[key] = value
+
 import unittest
 
 class TestJson(unittest.TestCase):
@@ -121,6 +247,193 @@ class TestJson(unittest.TestCase):
             }
         self.check(expected, source)
 
+    def test_columns(self):
+        columns = tokenizer.tokenize_columns('[1, {"a": true}]\n"b" ]')
+        parser = Parser(json, columns.cursor())
+        self.assertEqual([1, {"a": True}], parser.parse())
+        self.assertEqual("b", parser.parse())
+        self.assertRaises(ParseError, parser.parse)
+        parser = Parser(json, columns.cursor())
+        self.assertEqual([1, {"a": True}], parser.parse())
+        columns = tokenizer.tokenize_columns(b'["\xc3\xa9",\n 2]')
+        self.assertEqual(parse_expr(columns.buffer if bytes is str else
+                                    columns.buffer.decode("utf-8")),
+                         list(Parser(json, columns.cursor()).parse_all()))
+        self.assertEqual(b"2", columns.view(3).tobytes())
+        self.assertEqual((2, 2), columns.position(3))
+
+    def test_compiled(self):
+        compiled_json = ExprSpec(json.name, json)
+        compiled_json.compile()
+        source = '{"a": [1, 2.5, "x", {}], "b": {"c": null, "d": [true, false]}}'
+        parser = Parser(compiled_json, tokenizer.tokenize(source))
+        self.assertEqual(parse_expr(source), list(parser.parse_all()))
+        parser = Parser(compiled_json, tokenizer.tokenize('{"a": }'))
+        self.assertRaises(ParseError, parser.parse)
+
+    def test_mapped_file(self):
+        data = b'{"a": [1, "\xc3\xa9"]}\n  [true, "x"]'
+        text = data if bytes is str else data.decode("utf-8")
+        fd, filename = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            with open(filename, "rb") as f:
+                tokens = list(tokenizer.tokenize_mapped_file(f))
+            self.assertEqual(parse_expr(text),
+                             list(Parser(json, iter(tokens)).parse_all()))
+            self.assertEqual((2, 12), (tokens[-3].line_pos, tokens[-3].column_pos))
+        finally:
+            os.remove(filename)
+        tokens = tokenizer.tokenize_buffer(b'[1,\n2 !')
+        self.assertRaises(ParseError, list, tokens)
+
+    def test_lazy_positions(self):
+        # errors are reported in the same way whether positions are
+        # stored on tokens or worked out from their offsets
+        def error(tokens):
+            try:
+                list(Parser(json, tokens).parse_all())
+            except ParseError as e:
+                return str(e)
+        for input in ('[1,\n 2 3]', '{"a":\n\n  1,\n "b" 2}', '[1,\n',
+                      '\n[1] ]', '[1,\n2 !]'):
+            expected = error(tokenizer.tokenize(input))
+            self.assertTrue(expected)
+            self.assertEqual(expected,
+                             error(tokenizer.tokenize(input,
+                                                      positions = "lazy")))
+            for buffer in (input, input.encode("ascii")):
+                self.assertEqual(expected,
+                                 error(tokenizer.tokenize_buffer(
+                                     buffer, positions = "lazy")))
+        self.assertEqual(parse_expr('[1, {"a": 2}]'),
+                         list(Parser(json, tokenizer.tokenize(
+                             '[1, {"a": 2}]', positions = None)).parse_all()))
+
+    def test_dfa(self):
+        dfa_tokenizer = Tokenizer(*tokenizer.token_defs, dfa = True)
+        self.assertEqual([], dfa_tokenizer.dfa.fallback_indices)
+        # digits outside ASCII are matched by \d in Unicode mode, which
+        # is the default on Python 3
+        source = u'[1\u0660, "\u00e9\u0100", -20]'
+        def tokens(t):
+            try:
+                return [(token.type, token.content, token.column_pos)
+                        for token in t.tokenize_buffer(source)]
+            except ParseError as e:
+                return str(e)
+        self.assertEqual(tokens(tokenizer), tokens(dfa_tokenizer))
+
+    def test_deep(self):
+        iterative_json = ExprSpec(json.name, json)
+        iterative_json.freeze(iterative = True)
+        depth = 10000
+        source = "[" * depth + '1, {"a": [2]}' + "]" * depth
+        result = Parser(iterative_json, tokenizer.tokenize(source)).parse()
+        for i in range(depth - 1):
+            result = result[0]
+        self.assertEqual([1, {"a": [2]}], result)
+        parser = Parser(iterative_json, tokenizer.tokenize("[" * depth))
+        self.assertRaises(ParseError, parser.parse)
+
+    def test_events(self):
+        def events(input):
+            return list(parse_events(tokenizer.tokenize(input)))
+        self.assertEqual([("start_object", None), ("key", "a"),
+                          ("start_array", None), ("value", 1),
+                          ("start_object", None), ("end_object", None),
+                          ("end_array", None), ("key", "b"), ("value", None),
+                          ("end_object", None), ("value", "x")],
+                         events('{"a": [1, {}], "b": null} "x"'))
+        for input in ('[1,', '[1 2]', '{"a" 1}', '{"a": 1,}', ']', '[}'):
+            self.assertRaises(ParseError, events, input)
+
+    def test_extract(self):
+        source = '{"a": [1, {"b": [2, 3]}, {"b": {"c": 4}}], "d": {"b": 5}} [6]'
+        def extract_path(*path):
+            return list(extract(parse_events(tokenizer.tokenize(source)), path))
+        self.assertEqual(parse_expr(source), extract_path())
+        self.assertEqual([[1, {"b": [2, 3]}, {"b": {"c": 4}}]],
+                         extract_path("a"))
+        self.assertEqual([[2, 3], {"c": 4}], extract_path("a", "*", "b"))
+        self.assertEqual([3], extract_path("a", 1, "b", 1))
+        self.assertEqual([[2, 3], {"c": 4}], extract_path("*", "*", "b"))
+        self.assertEqual([5], extract_path("*", "b"))
+        self.assertEqual([6], extract_path(0))
+        self.assertEqual([], extract_path("x"))
+
+    def test_lookup(self):
+        source = '{"a": [1, {"b": [2, 3]}], "c": {"d": "x"}} [true, {}]'
+        def lookup_path(*path):
+            parser = Parser(json, tokenizer.tokenize(source))
+            results = [lookup(parser, path, "missing")]
+            while not parser.at_end():
+                results.append(lookup(parser, path, "missing"))
+            return results
+        self.assertEqual(parse_expr(source), lookup_path())
+        self.assertEqual([[1, {"b": [2, 3]}], "missing"], lookup_path("a"))
+        self.assertEqual([3, "missing"], lookup_path("a", 1, "b", 1))
+        self.assertEqual(["x", "missing"], lookup_path("c", "d"))
+        self.assertEqual(["missing", {}], lookup_path(1))
+        # brackets in skipped values must still match
+        parser = Parser(json, tokenizer.tokenize('{"a": [1, {"b": 2]}, "c": 3}'))
+        self.assertRaises(ParseError, lookup, parser, ("c",))
+
+    def test_parse_many(self):
+        inputs = ['[1, 2]', '{"a": true} null', '[1,', '"x"'] * 10
+        for workers in (1, 2):
+            results = list(parse_many(json, tokenizer, inputs, workers,
+                                      batch_size = 3))
+            self.assertEqual(40, len(results))
+            self.assertEqual([[[1, 2]], [{"a": True}, None]], results[:2])
+            self.assertTrue(isinstance(results[2], ParseError))
+            self.assertEqual("Unexpected end of input at line 2 column 0",
+                             str(results[2]))
+            self.assertEqual(["x"], results[39])
+        unordered = parse_many(json, tokenizer, inputs, 2, ordered = False)
+        self.assertEqual(list(range(40)), sorted(i for i, result in unordered))
+        # workers that are not forked need a setup function
+        if hasattr(multiprocessing, "get_context"):
+            spawn = multiprocessing.get_context("spawn")
+            self.assertRaises(AssertionError, list,
+                              parse_many(json, tokenizer, inputs, 2,
+                                         context = spawn))
+            results = list(parse_many(json, tokenizer, inputs, 2,
+                                      setup = setup_worker, context = spawn))
+            self.assertEqual(["x"], results[39])
+
+    def test_parse_file_parallel(self):
+        lines = ['{"a": [1, 2]}', '[true]', '"x"', '{"b": {}}'] * 25
+        fd, filename = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write("\n".join(lines))
+            expected = parse_expr("\n".join(lines))
+            for workers in (1, 2):
+                results = parse_file_parallel(json, tokenizer, filename,
+                                              workers, chunk_size = 50)
+                self.assertEqual(expected, list(results))
+            if hasattr(multiprocessing, "get_context"):
+                spawn = multiprocessing.get_context("spawn")
+                results = parse_file_parallel(None, None, filename, 2,
+                                              chunk_size = 50,
+                                              setup = setup_worker,
+                                              context = spawn)
+                self.assertEqual(expected, list(results))
+            lines[70] = '{"a" 1}'
+            with open(filename, "w") as f:
+                f.write("\n".join(lines))
+            results = parse_file_parallel(json, tokenizer, filename, 2,
+                                          chunk_size = 50)
+            try:
+                list(results)
+                self.fail("Expected ParseError")
+            except ParseError as e:
+                self.assertEqual(71, e.token.line_pos)
+        finally:
+            os.remove(filename)
+
 if __name__ == '__main__':
     if len(sys.argv) > 1 and sys.argv[1] == "-t":
         sys.argv.pop(1)
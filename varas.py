@@ -20,8 +20,38 @@ Concepts:
    functions called when the token is encountered.
 """
 
+import array
+import bisect
+from collections import OrderedDict, deque
+import copy
+import hashlib
+import marshal
+import mmap
+import multiprocessing
+import os
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 import re
-from StringIO import StringIO
+import string
+import sys
+import threading
+from timeit import default_timer as _timer
+import weakref
+try:
+    from re import _constants as sre_constants, _parser as sre_parse
+except ImportError:
+    import sre_constants
+    import sre_parse
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+try:
+    _unichr = unichr
+except NameError:
+    _unichr = chr
 
 class Assoc:
     """
@@ -71,6 +101,133 @@ class Token:
             tt = repr(self.type)
         return "Token(%s, %s)" % (tt, repr(self.content))
 
+class CompactToken(object):
+    """
+    A memory efficient alternative to Token, produced by the tokenizer
+    in compact mode.  It has the same attributes as Token but no
+    per-instance dictionary.
+
+    The filename is not stored on each token.  Instead it is a class
+    attribute of a subclass shared by all the tokens read from the same
+    input, created by for_file().
+    """
+
+    __slots__ = ("type", "content", "line_pos", "column_pos")
+
+    filename = None
+
+    # subclasses created by for_file(), by class and filename
+    file_classes = {}
+    max_file_classes = 256
+
+    def __init__(self, type, content, line_pos = None, column_pos = None):
+        self.type = type
+        self.content = content
+        self.line_pos = line_pos
+        self.column_pos = column_pos
+
+    @classmethod
+    def for_file(cls, filename):
+        """
+        Return a subclass whose instances all report the given filename.
+        Subclasses are cached, so tokenizing many inputs with the same
+        filename doesn't create a class for each one.
+        """
+        if filename == cls.filename:
+            return cls
+        key = (cls, filename)
+        file_classes = CompactToken.file_classes
+        subclass = file_classes.get(key)
+        if subclass is None:
+            if len(file_classes) >= CompactToken.max_file_classes:
+                file_classes.clear()
+            subclass = type(cls.__name__, (cls,), { "__slots__": (),
+                                                    "filename": filename })
+            file_classes[key] = subclass
+        return subclass
+
+    def __repr__(self):
+        if self.type == Token.END_TOKEN:
+            tt = "Token.END_TOKEN"
+        else:
+            tt = repr(self.type)
+        return "CompactToken(%s, %s)" % (tt, repr(self.content))
+
+class LineIndex(object):
+    """
+    The offsets of the start of each line of an input, used to find the
+    line and column of an offset into it by binary search.
+
+    filename -- the name of the input, or None
+
+    buffer -- optional, the input, from which the index is built the
+    first time a position is looked up.  Otherwise the offset of each
+    line is appended to line_starts as the input is read.
+
+    first_line -- optional, the line number of the start of the input
+    """
+
+    def __init__(self, filename = None, buffer = None, first_line = 1):
+        self.filename = filename
+        self.buffer = buffer
+        self.first_line = first_line
+        self.line_starts = None if buffer is not None else array.array("l")
+
+    def position(self, offset):
+        """
+        Return the (line, column) position of an offset into the input.
+        """
+        line_starts = self.line_starts
+        if line_starts is None:
+            line_starts = array.array("l", [0])
+            buffer = self.buffer
+            newline_char = b"\n" if _is_bytes_buffer(buffer) else "\n"
+            newline = buffer.find(newline_char)
+            while newline >= 0:
+                line_starts.append(newline + 1)
+                newline = buffer.find(newline_char, newline + 1)
+            self.line_starts = line_starts
+            self.buffer = None
+        line = bisect.bisect_right(line_starts, offset) - 1
+        return self.first_line + line, offset - line_starts[line]
+
+class OffsetToken(object):
+    """
+    A token that records only the offset of its end in the input,
+    produced by the tokenizer when positions are computed lazily.  It
+    has the same attributes as Token, but line_pos and column_pos are
+    looked up in a LineIndex shared by all the tokens from the same
+    input when they are accessed, which is usually only when a
+    ParseError is reported.
+    """
+
+    __slots__ = ("type", "content", "offset", "lines")
+
+    def __init__(self, type, content, offset, lines):
+        self.type = type
+        self.content = content
+        self.offset = offset
+        self.lines = lines
+
+    @property
+    def filename(self):
+        return self.lines.filename
+
+    @property
+    def line_pos(self):
+        return self.lines.position(self.offset)[0]
+
+    @property
+    def column_pos(self):
+        return self.lines.position(self.offset)[1]
+
+    def __repr__(self):
+        if self.type == Token.END_TOKEN:
+            tt = "Token.END_TOKEN"
+        else:
+            tt = repr(self.type)
+        return "OffsetToken(%s, %s)" % (tt, repr(self.content))
+
 class ParseError(Exception):
     """
     Raised when an error occurs in tokenizing or parsing.  The exception has two
@@ -84,6 +241,20 @@ class ParseError(Exception):
         self.token = token
         self.value = message
 
+    def copy(self):
+        """
+        Return a new ParseError with the same token and message.  Errors
+        that are kept and raised again are copied first, as raising the
+        same exception object adds to its traceback each time.
+        """
+        return ParseError(self.token, self.value)
+
+    def __reduce__(self):
+        # Tokens may refer to their tokenizer's state, so send a plain copy
+        t = self.token
+        token = Token(t.type, t.content, t.filename, t.line_pos, t.column_pos)
+        return (ParseError, (token, self.value))
+
     def __str__(self):
         m = self.value
         t = self.token
@@ -95,6 +266,180 @@ class ParseError(Exception):
                 m += " column " + str(t.column_pos)
         return m
 
+def _literal_strings(items, limit = 256, char = chr):
+    """
+    Internal - given a parsed regexp, return a list of the strings it
+    matches in the order the regexp tries them, or None if it doesn't
+    match a small fixed set of strings.
+
+    char -- the function used to make a character from its code, which is
+    unichr for unicode patterns on Python 2
+    """
+    results = [""]
+    for op, av in items:
+        if op == sre_constants.LITERAL and av < 256:
+            choices = [char(av)]
+        elif op == sre_constants.IN:
+            choices = []
+            for class_op, class_av in av:
+                if class_op == sre_constants.LITERAL:
+                    choices.append(char(class_av))
+                elif class_op == sre_constants.RANGE and \
+                     class_av[1] - class_av[0] < limit:
+                    choices.extend(char(c) for c in
+                                   range(class_av[0], class_av[1] + 1))
+                else:
+                    return None
+        elif op == sre_constants.BRANCH:
+            choices = []
+            for branch in av[1]:
+                branch_choices = _literal_strings(list(branch), limit, char)
+                if branch_choices is None:
+                    return None
+                choices.extend(branch_choices)
+        elif op == sre_constants.SUBPATTERN and av[0] is None:
+            choices = _literal_strings(list(av[-1]), limit, char)
+            if choices is None:
+                return None
+        else:
+            return None
+        if len(results) * len(choices) > limit:
+            return None
+        results = [r + c for r in results for c in choices]
+    return results
+
+def _first_chars(items, unicode, char = chr):
+    """
+    Internal - given a parsed regexp, return the set of characters a
+    match can start with, or None if this can't be determined or the
+    regexp can match the empty string.
+
+    unicode -- whether the regexp was compiled with the UNICODE flag,
+    which extends the character categories such as \\w
+
+    char -- the function used to make a character from its code, as for
+    _literal_strings()
+    """
+    first = _first_chars_and_nullable(items, unicode, char)
+    if first is None or first[1]:
+        return None
+    return first[0]
+
+def _first_chars_and_nullable(items, unicode, char = chr):
+    """
+    Internal - helper for _first_chars() which returns a tuple of the
+    set of possible first characters and whether the regexp can match
+    the empty string, or None if this can't be determined.
+    """
+    result = set()
+    for op, av in items:
+        if op == sre_constants.LITERAL and av < 256:
+            first = (set(char(av)), False)
+        elif op == sre_constants.IN:
+            chars = set()
+            for class_op, class_av in av:
+                if class_op == sre_constants.LITERAL:
+                    chars.add(char(class_av))
+                elif class_op == sre_constants.RANGE and \
+                     class_av[1] - class_av[0] < 256:
+                    chars.update(char(c) for c in
+                                 range(class_av[0], class_av[1] + 1))
+                elif class_op == sre_constants.CATEGORY and \
+                     class_av in _category_chars and not unicode:
+                    chars.update(_category_chars[class_av])
+                else:
+                    return None
+            first = (chars, False)
+        elif op == sre_constants.BRANCH:
+            chars = set()
+            nullable = False
+            for branch in av[1]:
+                branch_first = _first_chars_and_nullable(list(branch),
+                                                         unicode, char)
+                if branch_first is None:
+                    return None
+                chars.update(branch_first[0])
+                nullable = nullable or branch_first[1]
+            first = (chars, nullable)
+        elif op == sre_constants.SUBPATTERN:
+            first = _first_chars_and_nullable(list(av[-1]), unicode, char)
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            first = _first_chars_and_nullable(list(av[2]), unicode, char)
+            if first is not None and av[0] == 0:
+                first = (first[0], True)
+        else:
+            return None
+        if first is None:
+            return None
+        result.update(first[0])
+        if not first[1]:
+            return result, False
+    return result, True
+
+def _nullable(items):
+    """
+    Internal - given a parsed regexp, return whether it may match the
+    empty string.  Returns True if this can't be determined.
+    """
+    for op, av in items:
+        if op in (sre_constants.LITERAL, sre_constants.NOT_LITERAL,
+                  sre_constants.ANY, sre_constants.IN):
+            return False
+        elif op == sre_constants.BRANCH:
+            if not any(_nullable(list(branch)) for branch in av[1]):
+                return False
+        elif op == sre_constants.SUBPATTERN:
+            if not _nullable(list(av[-1])):
+                return False
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            if av[0] > 0 and not _nullable(list(av[2])):
+                return False
+        else:
+            return True
+    return True
+
+def _is_bytes_buffer(buffer):
+    """
+    Internal - return whether a buffer must be matched with bytes regexps,
+    which is the case for anything other than a str on Python 3.
+    """
+    return bytes is not str and not isinstance(buffer, str)
+
+_category_chars = {
+    sre_constants.CATEGORY_DIGIT: "0123456789",
+    sre_constants.CATEGORY_SPACE: " \t\n\r\f\v",
+    sre_constants.CATEGORY_WORD: "0123456789_" + string.ascii_letters }
+
+_negated_categories = {
+    sre_constants.CATEGORY_NOT_DIGIT: sre_constants.CATEGORY_DIGIT,
+    sre_constants.CATEGORY_NOT_SPACE: sre_constants.CATEGORY_SPACE,
+    sre_constants.CATEGORY_NOT_WORD: sre_constants.CATEGORY_WORD }
+
+_category_patterns = {
+    sre_constants.CATEGORY_DIGIT: r"\d",
+    sre_constants.CATEGORY_NOT_DIGIT: r"\D",
+    sre_constants.CATEGORY_SPACE: r"\s",
+    sre_constants.CATEGORY_NOT_SPACE: r"\S",
+    sre_constants.CATEGORY_WORD: r"\w",
+    sre_constants.CATEGORY_NOT_WORD: r"\W" }
+
+_unicode_category_codes = {}
+
+"""Matches inline global flags at the start of a regexp"""
+_leading_flags_regexp = re.compile(r"\(\?([aiLmsux]+)\)")
+
+def _unicode_codes(category):
+    """
+    Internal - return the character codes below 256 matched by a category
+    such as \\d in a regexp compiled with the UNICODE flag.
+    """
+    codes = _unicode_category_codes.get(category)
+    if codes is None:
+        match = re.compile(_category_patterns[category], re.UNICODE).match
+        codes = frozenset(code for code in range(256) if match(_unichr(code)))
+        _unicode_category_codes[category] = codes
+    return codes
+
 class Tokenizer:
     """
     A customisable tokenizer class which uses regular expressions to match
@@ -103,7 +448,10 @@ class Tokenizer:
 
     whitespace_pattern = "\s*"
 
-    def __init__(self, *token_defs):
+    """Number of tokens matched at a time by tokenize_buffer()"""
+    scan_batch_size = 256
+
+    def __init__(self, *token_defs, **options):
         """
         Create a tokenizer object passing a list of (regexp_pattern,
         token_type) tuples.
@@ -120,35 +468,167 @@ class Tokenizer:
 
         If token_type is None, the matched string is passed as the token
         type - this is useful for operators.
+
+        The following keyword options are supported:
+
+        fast_literals -- if true then tokens that can only be one of a
+        fixed set of strings, such as operators and keywords, are matched
+        by looking up their first character rather than with the regexp
+        when scanning whole buffers.  This gives the same result and is
+        faster for input where most tokens are not separated by
+        whitespace, but slower otherwise.
+
+        dfa -- if true then token definitions that only use a regular
+        subset of regexp syntax are compiled into a TokenDFA, which is
+        used in place of the regexp when scanning whole buffers.  This
+        gives the same result, and the cost of matching a token doesn't
+        depend on the number of token definitions.  This takes
+        precedence over fast_literals.
+
+        lazy -- if true then the regexps are not compiled until the
+        tokenizer is first used.
+
+        Tokenizers can be pickled.  The compiled regexps are not saved and
+        are compiled again when first used after loading.
         """
 
         assert len(token_defs) > 0, "No token definitions supplied"
-        token_patterns = ["(%s)" % token_def[0] for token_def in token_defs]
-        pattern = "(%s)(?:%s)?" % (Tokenizer.whitespace_pattern,
-                                   "|".join(token_patterns))
-        self.token_regexp = re.compile(pattern)
-        assert self.token_regexp.groups == len(token_defs) + 1
-        self.blank_line_regexp = re.compile("^%s$" % Tokenizer.whitespace_pattern)
+        for option in options:
+            assert option in ("fast_literals", "dfa", "lazy"), \
+                "Unknown tokenizer option: " + option
+        self.token_defs = token_defs
         self.token_types = [token_def[1] for token_def in token_defs]
+        if not options.get("lazy"):
+            self._compile()
+        self.single_literals = {}
+        self.literal_table = {}
+        if options.get("fast_literals"):
+            self._build_literal_tables(token_defs)
+        self.dfa = None
+        if options.get("dfa"):
+            self.dfa = TokenDFA(token_defs)
+
+    """Attributes set by _compile(), which are not pickled"""
+    _compiled_attributes = ("token_regexp", "blank_line_regexp",
+                            "whitespace_regexp")
+
+    """Attributes set by _compile_bytes(), which are not pickled"""
+    _bytes_compiled_attributes = ("bytes_token_regexp",)
+
+    def _token_pattern(self):
+        """
+        Internal - return the pattern of the regexp used to match tokens.
+        Inline flags at the start of a token definition, such as (?u),
+        are moved to the start of the pattern, as Python 3.11 doesn't
+        allow them anywhere else.  They apply to all the definitions.
+        """
+        flags = ""
+        token_patterns = []
+        for token_def in self.token_defs:
+            pattern = token_def[0]
+            m = _leading_flags_regexp.match(pattern)
+            if m is not None:
+                flags += m.group(1)
+                pattern = pattern[m.end():]
+            token_patterns.append("(%s)" % pattern)
+        if flags:
+            flags = "(?%s)" % flags
+        return "%s(%s)(?:%s)?" % (flags, Tokenizer.whitespace_pattern,
+                                  "|".join(token_patterns))
+
+    def _compile(self):
+        """
+        Internal - compile the regexps used to match tokens.
+        """
+        self.token_regexp = re.compile(self._token_pattern())
+        assert self.token_regexp.groups == len(self.token_defs) + 1
+        self.blank_line_regexp = re.compile("^%s$" % Tokenizer.whitespace_pattern)
+        self.whitespace_regexp = re.compile(Tokenizer.whitespace_pattern)
 
-    def tokenize(self, text):
+    def _compile_bytes(self):
+        """
+        Internal - compile the regexp used to match tokens in bytes
+        buffers on Python 3, with the token patterns encoded as UTF-8.
+        This happens the first time such a buffer is tokenized.
+        """
+        self.bytes_token_regexp = re.compile(self._token_pattern().encode("utf-8"))
+
+    def __getattr__(self, name):
+        # Only called for attributes that are not set, i.e. the regexps of
+        # a lazy or unpickled tokenizer before its first use.
+        if "token_defs" in self.__dict__:
+            if name in Tokenizer._compiled_attributes:
+                self._compile()
+                return self.__dict__[name]
+            if name in Tokenizer._bytes_compiled_attributes:
+                self._compile_bytes()
+                return self.__dict__[name]
+        raise AttributeError(name)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        for name in Tokenizer._compiled_attributes + \
+                    Tokenizer._bytes_compiled_attributes:
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def tokenize(self, text, compact = False, positions = "eager"):
         """
         Takes an input string and returns a generator which yields a
         sequence of Token objects.
+
+        compact -- optional, if true then yield CompactToken objects
+        instead of Token objects
+
+        positions -- optional, how token positions are recorded, as for
+        tokenize_file()
         """
 
-        return self.tokenize_file(StringIO(text))
+        return self.tokenize_file(StringIO(text), compact, positions)
 
-    def tokenize_file(self, file_object):
+    def tokenize_file(self, file_object, compact = False, positions = "eager"):
         """
         Takes an open file object and returns a generator which yields a
         sequence of Token objects.
+
+        The file is read one line at a time, so tokens may not span
+        lines.
+
+        compact -- optional, if true then yield CompactToken objects
+        instead of Token objects
+
+        positions -- optional, "eager" to store the line and column of
+        each token on it, "lazy" to yield OffsetToken objects which store
+        only an offset and work out the line and column when they are
+        accessed, or None to not record positions, in which case errors
+        are reported without them.  The final Token.END_TOKEN and tokens
+        passed to ParseError by the tokenizer always have positions.
         """
 
+        assert positions in ("eager", "lazy", None), \
+            "Bad positions option: %s" % repr(positions)
+        eager = positions == "eager"
+        lazy = positions == "lazy"
         filename = getattr(file_object, 'name', None)
+        if compact:
+            compact_token = CompactToken.for_file(filename)
+        if lazy:
+            lines = LineIndex(filename)
+            add_line = lines.line_starts.append
+            offset = 0
+        line_pos = column_pos = None
         line_number = 0
         for line in file_object:
             line_number += 1
+            if lazy:
+                line_start = offset
+                add_line(offset)
+                offset += len(line)
+            elif eager:
+                line_pos = line_number
 
             if self.blank_line_regexp.match(line):
                 continue
@@ -175,9 +655,1164 @@ class Tokenizer:
                 token_type = self.token_types[group - 2]
                 if token_type == None:
                     token_type = match
-                yield Token(token_type, match, filename, line_number, pos)
+                if lazy:
+                    yield OffsetToken(token_type, match, line_start + pos,
+                                      lines)
+                    continue
+                if eager:
+                    column_pos = pos
+                if compact:
+                    yield compact_token(token_type, match, line_pos,
+                                        column_pos)
+                else:
+                    yield Token(token_type, match, filename, line_pos,
+                                column_pos)
+
+        if compact:
+            yield compact_token(Token.END_TOKEN, "", line_number + 1, 0)
+        else:
+            yield Token(Token.END_TOKEN, "", filename, line_number + 1, 0)
+
+    def tokenize_buffer(self, buffer, filename = None, compact = False,
+                        first_line = 1, encoding = "utf-8",
+                        positions = "eager"):
+        """
+        Takes a string or other buffer object such as an mmap and returns
+        a generator which yields a sequence of Token objects.
+
+        The whole buffer is scanned in one pass rather than line by line,
+        so tokens may span lines.  The position of a token is that of its
+        end, as for tokenize_file().
+
+        On Python 3 a buffer that is not a str, such as bytes or an mmap,
+        is matched with the token patterns encoded as UTF-8 and token
+        content is decoded.  Columns then count bytes rather than
+        characters, and character classes in the patterns should only
+        contain ASCII characters.  The fast_literals and dfa options only
+        apply to str buffers.
+
+        filename -- optional, the name reported by the tokens
+
+        compact -- optional, if true then yield CompactToken objects
+        instead of Token objects
+
+        first_line -- optional, the line number of the start of the
+        buffer, if it is part of a larger file
+
+        encoding -- optional, the encoding used to decode token content
+        from a bytes buffer on Python 3, by default UTF-8
+
+        positions -- optional, how token positions are recorded, as for
+        tokenize_file().  When they are computed lazily the index of line
+        offsets is built from the buffer the first time a position is
+        looked up, so the buffer is kept until then.
+        """
+
+        assert positions in ("eager", "lazy", None), \
+            "Bad positions option: %s" % repr(positions)
+        eager = positions == "eager"
+        lazy = positions == "lazy"
+        if compact:
+            compact_token = CompactToken.for_file(filename)
+        if not eager:
+            lines = LineIndex(filename, buffer, first_line)
+        token_types = self.token_types
+        length = len(buffer)
+        line_number = first_line
+        line_start = 0
+        line_pos = column_pos = None
+        is_bytes = _is_bytes_buffer(buffer)
+        if is_bytes:
+            newline = b"\n"
+            token_regexp = self.bytes_token_regexp
+        else:
+            newline = "\n"
+            token_regexp = self.token_regexp
+        next_newline = buffer.find(newline)
+        if next_newline < 0:
+            next_newline = length
+
+        types = []
+        starts = []
+        ends = []
+        pos = 0
+        while True:
+            count = self._scan(buffer, pos, length, types, starts, ends,
+                               self.scan_batch_size)
+            if count:
+                pos = ends[-1]
+            for index, start, end in zip(types, starts, ends):
+                match = buffer[start:end]
+                if is_bytes:
+                    match = match.decode(encoding)
+                token_type = token_types[index]
+                if token_type == None:
+                    token_type = match
+                if lazy:
+                    yield OffsetToken(token_type, match, end, lines)
+                    continue
+                if eager:
+                    # advance the line count past any newlines before
+                    # the token's end without looking at every character
+                    while next_newline < end:
+                        line_number += 1
+                        line_start = next_newline + 1
+                        next_newline = buffer.find(newline, line_start)
+                        if next_newline < 0:
+                            next_newline = length
+                    line_pos = line_number
+                    column_pos = end - line_start
+                if compact:
+                    yield compact_token(token_type, match, line_pos,
+                                        column_pos)
+                else:
+                    yield Token(token_type, match, filename, line_pos,
+                                column_pos)
+            if count < self.scan_batch_size:
+                break
+            del types[:], starts[:], ends[:]
+
+        pos = token_regexp.match(buffer, pos).end(1)
+        if eager:
+            while next_newline < pos:
+                line_number += 1
+                line_start = next_newline + 1
+                next_newline = buffer.find(newline, line_start)
+                if next_newline < 0:
+                    next_newline = length
+            column_pos = pos - line_start
+        else:
+            line_number, column_pos = lines.position(pos)
+        if pos < length:
+            dummy_token = Token(None, None, filename, line_number, column_pos)
+            raise ParseError(dummy_token, "Can't tokenize input")
+
+        # the end token follows the last line, which may be unterminated
+        if column_pos > 0:
+            line_number += 1
+        if compact:
+            yield compact_token(Token.END_TOKEN, "", line_number, 0)
+        else:
+            yield Token(Token.END_TOKEN, "", filename, line_number, 0)
+
+    def tokenize_mapped_file(self, file_object, compact = False,
+                             encoding = "utf-8", positions = "eager"):
+        """
+        Takes an open file object, maps it into memory and returns a
+        generator which yields a sequence of Token objects as for
+        tokenize_buffer().
 
-        yield Token(Token.END_TOKEN, "", filename, line_number + 1, 0)
+        compact -- optional, if true then yield CompactToken objects
+        instead of Token objects
+
+        encoding -- optional, the encoding of the file, used to decode
+        token content on Python 3, by default UTF-8
+
+        positions -- optional, how token positions are recorded, as for
+        tokenize_file()
+        """
+
+        filename = getattr(file_object, 'name', None)
+        if os.fstat(file_object.fileno()).st_size == 0:
+            # empty files can't be mapped
+            return self.tokenize_buffer("", filename, compact,
+                                        positions = positions)
+        buffer = mmap.mmap(file_object.fileno(), 0, access = mmap.ACCESS_READ)
+        return self.tokenize_buffer(buffer, filename, compact,
+                                    encoding = encoding, positions = positions)
+
+    def tokenize_columns(self, buffer, filename = None, encoding = "utf-8"):
+        """
+        Takes a string or other buffer object such as an mmap, tokenizes
+        the whole of it and returns a TokenColumns object.
+
+        No token objects are created.  Instead the token types and
+        offsets are stored in compact arrays and token content is taken
+        from the buffer when it is needed, which makes this suitable for
+        large inputs that are tokenized once and parsed many times.
+
+        Buffers that are not a str are handled on Python 3 as described
+        for tokenize_buffer().
+
+        filename -- optional, the name reported by the tokens
+
+        encoding -- optional, the encoding used to decode token content
+        from a bytes buffer on Python 3, by default UTF-8
+        """
+
+        types = array.array("h")
+        starts = array.array("l")
+        ends = array.array("l")
+        columns = TokenColumns(buffer, filename, self.token_types,
+                               types, starts, ends, encoding)
+        length = len(buffer)
+
+        self._scan(buffer, 0, length, types, starts, ends, length + 1)
+        pos = ends[-1] if ends else 0
+        if _is_bytes_buffer(buffer):
+            pos = self.bytes_token_regexp.match(buffer, pos).end(1)
+        else:
+            pos = self.token_regexp.match(buffer, pos).end(1)
+        if pos < length:
+            line_pos, column_pos = columns.position_at(pos)
+            dummy_token = Token(None, None, filename, line_pos, column_pos)
+            raise ParseError(dummy_token, "Can't tokenize input")
+
+        types.append(-1)
+        starts.append(length)
+        ends.append(length)
+        return columns
+
+    ##################################################################
+    # Internal implementation
+    ##################################################################
+
+    def _build_literal_tables(self, token_defs):
+        """
+        Internal - build tables used to match tokens that can only be one
+        of a fixed set of strings (such as operators and keywords)
+        without using the regexp.
+
+        single_literals maps a character to the index of the token
+        definition that matches it on its own, for characters where this
+        is always the first match.  literal_table maps a character to a
+        list of (string, token definition index) tuples for the strings
+        starting with that character, in the order the regexp would try
+        them.
+
+        Characters that could also start a token from an earlier
+        non-literal definition are left out, so that the result is always
+        the same as matching with the regexp.
+        """
+        parsed = sre_parse.parse(Tokenizer.whitespace_pattern)
+        whitespace = _first_chars_and_nullable(list(parsed), False)
+        if whitespace is None:
+            return
+        self.whitespace_chars = "".join(sorted(whitespace[0]))
+        # not self.whitespace_regexp, which would compile a lazy tokenizer
+        whitespace_match = re.compile(Tokenizer.whitespace_pattern).match
+
+        table = {}
+        blocked = set()
+        for index, token_def in enumerate(token_defs):
+            parsed = sre_parse.parse(token_def[0])
+            flags = getattr(parsed, "state", None) or parsed.pattern
+            flags = flags.flags
+            if flags & (re.IGNORECASE | re.LOCALE):
+                break
+            # characters above 127 must have the same type as the input
+            # on Python 2 to be found in the tables
+            char = chr
+            if isinstance(token_def[0], type(u"")):
+                char = _unichr
+            literals = _literal_strings(list(parsed), char = char)
+            if literals is None:
+                first_chars = _first_chars(list(parsed), flags & re.UNICODE,
+                                           char)
+                if first_chars is None:
+                    break
+                blocked.update(first_chars)
+                continue
+            if "" in literals:
+                # this matches anywhere, so later definitions never do
+                break
+            for literal in literals:
+                c = literal[0]
+                if c in blocked or whitespace_match(c).end():
+                    continue
+                table.setdefault(c, []).append((literal, index))
+                if len(literal) == 1:
+                    # this always matches, so nothing after it can
+                    blocked.add(c)
+
+        for c, entry in table.items():
+            if entry[0][0] == c:
+                self.single_literals[c] = entry[0][1]
+            else:
+                self.literal_table[c] = entry
+
+    def _scan(self, buffer, pos, endpos, types, starts, ends, limit):
+        """
+        Internal - match up to limit tokens in buffer from offset pos,
+        appending the token definition index and the start and end
+        offsets of each one to types, starts and ends.  Whitespace
+        between tokens is skipped.
+
+        Returns the number of tokens matched.  Scanning stops early at
+        endpos or at input that can't be tokenized, which the caller can
+        tell apart by skipping whitespace after the last token.
+        """
+        if _is_bytes_buffer(buffer):
+            return self._scan_regexp(self.bytes_token_regexp, buffer, pos,
+                                     endpos, types, starts, ends, limit)
+        if self.dfa is not None:
+            return self._scan_dfa(buffer, pos, endpos, types, starts, ends,
+                                  limit)
+        if not self.single_literals and not self.literal_table:
+            return self._scan_regexp(self.token_regexp, buffer, pos, endpos,
+                                     types, starts, ends, limit)
+
+        add_type = types.append
+        add_start = starts.append
+        add_end = ends.append
+        count = 0
+
+        # literal tokens are found by looking up their first character,
+        # only falling back to the regexp if that fails
+        match = self.token_regexp.match
+        single_lookup = self.single_literals.get
+        literal_lookup = self.literal_table.get
+        whitespace_match = self.whitespace_regexp.match
+        whitespace_chars = self.whitespace_chars
+        while count < limit:
+            c = buffer[pos:pos + 1]
+            whitespace_start = pos
+            if c in whitespace_chars:
+                pos = whitespace_match(buffer, pos, endpos).end()
+                c = buffer[pos:pos + 1]
+            index = single_lookup(c)
+            if index is not None and pos < endpos:
+                end = pos + 1
+            else:
+                end = -1
+                entry = literal_lookup(c)
+                if entry is not None:
+                    for literal, index in entry:
+                        literal_end = pos + len(literal)
+                        if literal_end <= endpos and \
+                           buffer[pos:literal_end] == literal:
+                            end = literal_end
+                            break
+                if end < 0:
+                    m = match(buffer, whitespace_start, endpos)
+                    group = m.lastindex
+                    if group < 2:
+                        break
+                    index = group - 2
+                    pos = m.end(1)
+                    end = m.end()
+            add_type(index)
+            add_start(pos)
+            add_end(end)
+            pos = end
+            count += 1
+        return count
+
+    def _scan_regexp(self, token_regexp, buffer, pos, endpos, types, starts,
+                     ends, limit):
+        """
+        Internal - implementation of _scan() using only the regexp.
+        """
+        add_type = types.append
+        add_start = starts.append
+        add_end = ends.append
+        count = 0
+        if limit <= 0:
+            return 0
+        for m in token_regexp.finditer(buffer, pos, endpos):
+            group = m.lastindex
+            if group < 2:
+                break
+            add_type(group - 2)
+            start, end = m.span(group)
+            add_start(start)
+            add_end(end)
+            count += 1
+            if count == limit:
+                break
+        return count
+
+    def _scan_dfa(self, buffer, pos, endpos, types, starts, ends, limit):
+        """
+        Internal - implementation of _scan() using the TokenDFA.
+        """
+        dfa = self.dfa
+        transitions = dfa.transitions
+        accepts = dfa.accepts
+        skips = dfa.skips
+        start_state = dfa.start_state
+        add_transition = dfa.add_transition
+        whitespace_match = self.whitespace_regexp.match
+        fallback_match = None
+        if dfa.fallback_regexp is not None:
+            fallback_match = dfa.fallback_regexp.match
+            fallback_indices = dfa.fallback_indices
+            first_fallback = fallback_indices[0]
+        add_type = types.append
+        add_start = starts.append
+        add_end = ends.append
+        count = 0
+
+        while count < limit:
+            whitespace_start = pos
+            pos = whitespace_match(buffer, pos, endpos).end()
+
+            # run the automaton until no further match is possible,
+            # remembering the last match found
+            index = -1
+            unknown = False
+            state = start_state
+            i = pos
+            while True:
+                skip = skips[state]
+                if skip is not None:
+                    i = skip(buffer, i, endpos).end()
+                if accepts[state] >= 0:
+                    index = accepts[state]
+                    end = i
+                if i >= endpos:
+                    break
+                c = buffer[i]
+                next_state = transitions[state].get(c)
+                if next_state is None:
+                    next_state = add_transition(state, c)
+                if next_state <= 0:
+                    unknown = next_state < 0
+                    break
+                state = next_state
+                i += 1
+
+            # definitions that couldn't be compiled take priority if they
+            # come first and match, and the regexp is used if the
+            # automaton couldn't tell what matched
+            if unknown:
+                index = -1
+            elif fallback_match is not None and \
+                 (index < 0 or index > first_fallback):
+                m = fallback_match(buffer, pos, endpos)
+                if m is not None:
+                    fallback_index = fallback_indices[m.lastindex - 1]
+                    if index < 0 or fallback_index < index:
+                        index = fallback_index
+                        end = m.end()
+
+            if index < 0:
+                # leave it to the regexp to decide whether anything can
+                # be matched here
+                m = self.token_regexp.match(buffer, whitespace_start, endpos)
+                group = m.lastindex
+                if group < 2:
+                    break
+                index = group - 2
+                pos = m.end(1)
+                end = m.end()
+
+            add_type(index)
+            add_start(pos)
+            add_end(end)
+            pos = end
+            count += 1
+        return count
+
+class TokenizerCache(object):
+    """
+    A cache of Tokenizer objects keyed by their token definitions and
+    options, which can be saved to a file and loaded by another process.
+    This saves building the tokenizer's literal tables and automaton again,
+    and its regexps are compiled when it is first used.
+
+    filename -- optional, a file to load the cache from if it exists, and
+    to save it to by default
+    """
+
+    def __init__(self, filename = None):
+        self.filename = filename
+        self.tokenizers = {}
+        if filename is not None and os.path.exists(filename):
+            self.load(filename)
+
+    def tokenizer(self, *token_defs, **options):
+        """
+        Return a tokenizer for the token definitions and options, as
+        accepted by Tokenizer(), creating it if it is not already cached.
+        """
+        key = (tuple(token_defs), tuple(sorted(options.items())))
+        tokenizer = self.tokenizers.get(key)
+        if tokenizer is None:
+            tokenizer = Tokenizer(*token_defs, **options)
+            self.tokenizers[key] = tokenizer
+        return tokenizer
+
+    def load(self, filename):
+        """
+        Add the tokenizers saved in a file to the cache.
+        """
+        with open(filename, "rb") as f:
+            self.tokenizers.update(pickle.load(f))
+
+    def save(self, filename = None):
+        """
+        Save the cached tokenizers to a file, by default the one the cache
+        was created with.
+        """
+        if filename is None:
+            filename = self.filename
+        assert filename is not None, "No filename supplied"
+        temp_filename = "%s.%d" % (filename, os.getpid())
+        with open(temp_filename, "wb") as f:
+            pickle.dump(self.tokenizers, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_filename, filename)
+
+class IncrementalTokenizer(object):
+    """
+    Tokenizes input that arrives in chunks, for example from a socket or
+    pipe.  Tokens are returned from feed() as soon as they are complete,
+    and are the same as tokenize_file() would produce for the whole input.
+
+    Tokens may not span lines.  Within an unfinished line, a token is
+    only returned once the token after it has been matched and is
+    followed by more input, because more input could change where the
+    token ends.  For example, with a definition for numbers like '1.5',
+    the '1' of '1.' isn't returned until the next chunk shows whether a
+    digit follows the '.'.  The held back text is tokenized again when
+    more input arrives.  Token definitions whose match depends on input
+    more than one token further on may be split differently at a chunk
+    boundary than by tokenize_file().
+
+    tokenizer -- the Tokenizer whose token definitions are used
+
+    filename -- optional, the name reported by the tokens
+
+    compact -- optional, if true then return CompactToken objects
+    instead of Token objects
+    """
+
+    def __init__(self, tokenizer, filename = None, compact = False):
+        self.tokenizer = tokenizer
+        self.filename = filename
+        self.compact_token = None
+        if compact:
+            self.compact_token = CompactToken.for_file(filename)
+        self.text = ""
+        self.line_number = 1
+        self.column = 0
+        self.closed = False
+
+    def feed(self, chunk):
+        """
+        Add a chunk of input and return a list of the tokens completed.
+        """
+        assert not self.closed, "Input has already been closed"
+        self.text += chunk
+        return self._tokenize(False)
+
+    def close(self):
+        """
+        Mark the end of the input and return a list of the remaining
+        tokens, ending with an END_TOKEN.
+        """
+        assert not self.closed, "Input has already been closed"
+        self.closed = True
+        tokens = self._tokenize(True)
+        line_number = self.line_number
+        if self.column:
+            line_number += 1
+        tokens.append(self._token(Token.END_TOKEN, "", line_number, 0))
+        return tokens
+
+    def _token(self, token_type, content, line_number, column):
+        if self.compact_token is not None:
+            return self.compact_token(token_type, content, line_number, column)
+        return Token(token_type, content, self.filename, line_number, column)
+
+    def _tokenize(self, final):
+        """
+        Internal - tokenize as much of the input held as possible.
+        """
+        token_regexp = self.tokenizer.token_regexp
+        token_types = self.tokenizer.token_types
+        text = self.text
+        length = len(text)
+        tokens = []
+        pos = 0
+        # index in text of the start of the current line, which is
+        # negative if part of the line has already been tokenized
+        line_start = -self.column
+        while True:
+            newline = text.find("\n", pos)
+            complete = final or newline != -1
+            end = newline + 1 if newline != -1 else length
+            # the last token matched in an unfinished line and the offset
+            # it was matched from, held until the next token is complete
+            held = None
+            while pos < end:
+                m = token_regexp.match(text, pos, end)
+                whitespace_end = m.end(1)
+                if whitespace_end == end:
+                    pos = end
+                    break
+                group = m.lastindex
+                if not complete and (group < 2 or m.end() == end):
+                    pos = whitespace_end
+                    break
+                if group < 2:
+                    dummy_token = Token(None, None, self.filename,
+                                        self.line_number,
+                                        whitespace_end - line_start)
+                    raise ParseError(dummy_token, "Can't tokenize input")
+                content = m.group(group)
+                start = pos
+                pos = m.end()
+                token_type = token_types[group - 2]
+                if token_type == None:
+                    token_type = content
+                token = self._token(token_type, content, self.line_number,
+                                    pos - line_start)
+                if complete:
+                    tokens.append(token)
+                else:
+                    if held is not None:
+                        tokens.append(held[1])
+                    held = (start, token)
+            if held is not None:
+                pos = held[0]
+            if newline == -1 or pos < end:
+                break
+            self.line_number += 1
+            line_start = end
+        self.text = text[pos:]
+        self.column = pos - line_start
+        return tokens
+
+class TokenDFA(object):
+    """
+    A deterministic finite automaton that matches the same tokens as a
+    Tokenizer's regexp, used when the Tokenizer is created with the dfa
+    option.
+
+    Token definitions that only use a regular subset of regexp syntax
+    (literals, character classes, alternation, groups and repetition)
+    are compiled into a single automaton.  Characters from 256 upwards
+    are all treated alike, so where a Unicode category such as \\w could
+    match one of them the automaton gives up and leaves the token to the
+    regexp.  Each state holds the possible
+    matches in the order the regexp would try them and drops those that
+    come after a completed match, so the automaton finds the same match
+    as the regexp in one pass over the input.
+
+    The other token definitions are matched with fallback_regexp, and
+    their indices are listed in fallback_indices.
+
+    States are built when they are first reached and stored in table
+    form:
+
+    transitions -- for each state, a dictionary mapping the next input
+    character to the next state, where state 0 means no further match is
+    possible and UNKNOWN means the automaton can't tell, so the regexp
+    must be used instead
+
+    accepts -- for each state, the index of the token definition matched
+    on reaching it, or -1
+
+    skips -- for each state, None or the match method of a regexp that
+    matches a run of characters that lead back to the same state
+    """
+
+    CHAR = 0
+    SPLIT = 1
+    MATCH = 2
+
+    UNKNOWN = -1
+
+    def __init__(self, token_defs):
+        # the NFA is stored as parallel lists indexed by node, where
+        # node_args holds a character set for CHAR nodes, a list of
+        # nodes in priority order for SPLIT nodes and a token definition
+        # index for MATCH nodes
+        self.node_kinds = []
+        self.node_args = []
+        self.node_next = []
+        self.fallback_indices = []
+
+        starts = []
+        for index, token_def in enumerate(token_defs):
+            parsed = sre_parse.parse(token_def[0])
+            flags = (getattr(parsed, "state", None) or parsed.pattern).flags
+            node_count = len(self.node_kinds)
+            try:
+                if flags & (re.IGNORECASE | re.LOCALE):
+                    raise TokenDFA.NotRegular()
+                match = self._add_node(TokenDFA.MATCH, index, None)
+                starts.append(self._compile(list(parsed), match, flags))
+            except TokenDFA.NotRegular:
+                del self.node_kinds[node_count:]
+                del self.node_args[node_count:]
+                del self.node_next[node_count:]
+                self.fallback_indices.append(index)
+
+        self.fallback_regexp = None
+        if self.fallback_indices:
+            self.fallback_regexp = re.compile("|".join(
+                "(%s)" % token_defs[index][0]
+                for index in self.fallback_indices))
+
+        self._build_classes()
+        start = self._add_node(TokenDFA.SPLIT, starts, None)
+
+        self.state_numbers = { (): 0 }
+        self.states = [()]
+        self.accepts = [-1]
+        self.transitions = [{}]
+        self.skips = [None]
+        self.class_transitions = [None]
+        threads = []
+        self._closure([start], threads, set())
+        self.start_state = self._add_state(tuple(threads))
+        self._expand(self.start_state)
+
+    class NotRegular(Exception):
+        """
+        Internal - raised when a regexp can't be compiled.
+        """
+
+    ##################################################################
+    # Internal implementation - building the NFA
+    ##################################################################
+
+    """Largest repeat count that is expanded when compiling"""
+    max_repeat = 64
+
+    def _add_node(self, kind, arg, next):
+        self.node_kinds.append(kind)
+        self.node_args.append(arg)
+        self.node_next.append(next)
+        return len(self.node_kinds) - 1
+
+    def _compile(self, items, next, flags):
+        """
+        Internal - compile a parsed regexp into NFA nodes followed by
+        next, returning the first node.
+        """
+        for op, av in reversed(items):
+            next = self._compile_item(op, av, next, flags)
+        return next
+
+    def _compile_item(self, op, av, next, flags):
+        if op in (sre_constants.LITERAL, sre_constants.NOT_LITERAL,
+                  sre_constants.ANY, sre_constants.IN):
+            return self._add_node(TokenDFA.CHAR,
+                                  self._charset(op, av, flags), next)
+        elif op == sre_constants.BRANCH:
+            branches = [self._compile(list(branch), next, flags)
+                        for branch in av[1]]
+            return self._add_node(TokenDFA.SPLIT, branches, None)
+        elif op == sre_constants.SUBPATTERN:
+            if len(av) > 2 and (av[1] or av[2]):
+                # flags set within the group
+                raise TokenDFA.NotRegular()
+            return self._compile(list(av[-1]), next, flags)
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            min_count, max_count, item = av
+            unbounded = max_count == sre_constants.MAXREPEAT
+            if min_count > TokenDFA.max_repeat or \
+               (not unbounded and max_count > TokenDFA.max_repeat) or \
+               _nullable(list(item)):
+                raise TokenDFA.NotRegular()
+            greedy = op == sre_constants.MAX_REPEAT
+            if unbounded:
+                loop = self._add_node(TokenDFA.SPLIT, None, None)
+                body = self._compile(list(item), loop, flags)
+                self.node_args[loop] = [body, next] if greedy else [next, body]
+                next_item = loop
+            else:
+                next_item = next
+                for i in range(max_count - min_count):
+                    body = self._compile(list(item), next_item, flags)
+                    choices = [body, next] if greedy else [next, body]
+                    next_item = self._add_node(TokenDFA.SPLIT, choices, None)
+            for i in range(min_count):
+                next_item = self._compile(list(item), next_item, flags)
+            return next_item
+        else:
+            raise TokenDFA.NotRegular()
+
+    def _charset(self, op, av, flags):
+        """
+        Internal - return the characters matched by a parsed regexp item
+        as a tuple of a frozenset of character codes below 256 and
+        whether all characters above that are matched, which is None if
+        only some of them are.
+        """
+        all_codes = frozenset(range(256))
+        if op == sre_constants.LITERAL:
+            if av > 255:
+                raise TokenDFA.NotRegular()
+            return frozenset([av]), False
+        elif op == sre_constants.NOT_LITERAL:
+            if av > 255:
+                raise TokenDFA.NotRegular()
+            return all_codes - frozenset([av]), True
+        elif op == sre_constants.ANY:
+            if flags & re.DOTALL:
+                return all_codes, True
+            return all_codes - frozenset([ord("\n")]), True
+
+        codes = set()
+        high = False
+        negate = False
+        for class_op, class_av in av:
+            if class_op == sre_constants.NEGATE:
+                negate = True
+            elif class_op == sre_constants.LITERAL and class_av < 256:
+                codes.add(class_av)
+            elif class_op == sre_constants.RANGE and class_av[1] < 256:
+                codes.update(range(class_av[0], class_av[1] + 1))
+            elif class_op == sre_constants.CATEGORY and flags & re.UNICODE:
+                if class_av not in _category_patterns:
+                    raise TokenDFA.NotRegular()
+                codes.update(_unicode_codes(class_av))
+                if high is False:
+                    high = None
+            elif class_op == sre_constants.CATEGORY:
+                category = _negated_categories.get(class_av, class_av)
+                if category not in _category_chars:
+                    raise TokenDFA.NotRegular()
+                category_codes = set(ord(c) for c in _category_chars[category])
+                if category == class_av:
+                    codes.update(category_codes)
+                else:
+                    codes.update(all_codes - category_codes)
+                    high = True
+            else:
+                raise TokenDFA.NotRegular()
+        if negate:
+            return all_codes - codes, None if high is None else not high
+        return frozenset(codes), high
+
+    def _build_classes(self):
+        """
+        Internal - divide characters into classes which are matched by
+        the same CHAR nodes, and replace the character set of each CHAR
+        node with the set of classes it matches.
+        """
+        charsets = list(set(self.node_args[node]
+                            for node in range(len(self.node_kinds))
+                            if self.node_kinds[node] == TokenDFA.CHAR))
+        class_numbers = {}
+        def class_number(signature):
+            return class_numbers.setdefault(signature, len(class_numbers))
+
+        # keyed by character code, as on Python 2 byte and unicode
+        # characters above 127 don't compare equal
+        self.class_map = {}
+        for code in range(256):
+            signature = tuple(code in codes for codes, high in charsets)
+            self.class_map[code] = class_number(signature)
+        self.high_class = class_number(tuple(high for codes, high in charsets))
+
+        # nodes that match only some of the characters in the high class
+        self.uncertain_nodes = frozenset(
+            node for node in range(len(self.node_kinds))
+            if self.node_kinds[node] == TokenDFA.CHAR and
+               self.node_args[node][1] is None)
+
+        class_sets = {}
+        for i, charset in enumerate(charsets):
+            class_sets[charset] = frozenset(
+                number for signature, number in class_numbers.items()
+                if signature[i])
+        for node in range(len(self.node_kinds)):
+            if self.node_kinds[node] == TokenDFA.CHAR:
+                self.node_args[node] = class_sets[self.node_args[node]]
+        self.class_count = len(class_numbers)
+
+    ##################################################################
+    # Internal implementation - building the DFA
+    ##################################################################
+
+    def _closure(self, nodes, threads, seen):
+        """
+        Internal - add the CHAR and MATCH nodes reachable from nodes
+        without consuming input to threads, in priority order and
+        stopping at the first MATCH node.  Returns whether a MATCH node
+        was found.
+        """
+        node_kinds = self.node_kinds
+        node_args = self.node_args
+        stack = list(reversed(nodes))
+        while stack:
+            node = stack.pop()
+            if node in seen:
+                continue
+            seen.add(node)
+            kind = node_kinds[node]
+            if kind == TokenDFA.SPLIT:
+                stack.extend(reversed(node_args[node]))
+            else:
+                threads.append(node)
+                if kind == TokenDFA.MATCH:
+                    return True
+        return False
+
+    def _add_state(self, threads):
+        """
+        Internal - return the number of the state for a tuple of threads,
+        adding it if necessary.
+        """
+        state = self.state_numbers.get(threads)
+        if state is None:
+            state = len(self.states)
+            self.state_numbers[threads] = state
+            self.states.append(threads)
+            accept = -1
+            if threads and self.node_kinds[threads[-1]] == TokenDFA.MATCH:
+                accept = self.node_args[threads[-1]]
+            self.accepts.append(accept)
+            self.transitions.append({})
+            self.skips.append(None)
+            self.class_transitions.append(None)
+        return state
+
+    def _expand(self, state):
+        """
+        Internal - work out the next state for each character class from
+        a state, and the regexp used to skip over runs of characters that
+        lead back to it.
+        """
+        node_kinds = self.node_kinds
+        node_args = self.node_args
+        node_next = self.node_next
+        next_states = []
+        for char_class in range(self.class_count):
+            threads = []
+            seen = set()
+            next_state = None
+            for node in self.states[state]:
+                if node_kinds[node] != TokenDFA.CHAR:
+                    continue
+                if char_class == self.high_class and \
+                   node in self.uncertain_nodes:
+                    next_state = TokenDFA.UNKNOWN
+                    break
+                if char_class in node_args[node] and \
+                   self._closure([node_next[node]], threads, seen):
+                    break
+            if next_state is None:
+                next_state = self._add_state(tuple(threads))
+            next_states.append(next_state)
+        self.class_transitions[state] = next_states
+
+        loop_classes = set(char_class for char_class in range(self.class_count)
+                           if next_states[char_class] == state)
+        if loop_classes:
+            chars = [_unichr(code) for code in self.class_map
+                     if self.class_map[code] in loop_classes]
+            if self.high_class in loop_classes:
+                others = [_unichr(code) for code in self.class_map
+                          if self.class_map[code] not in loop_classes]
+                pattern = "[^%s]*" % "".join(re.escape(c) for c in others)
+                if not others:
+                    pattern = "(?s).*"
+            else:
+                pattern = "[%s]*" % "".join(re.escape(c) for c in chars)
+            self.skips[state] = re.compile(pattern).match
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["skips"] = [skip and skip.__self__.pattern for skip in self.skips]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.skips = [pattern and re.compile(pattern).match
+                      for pattern in self.skips]
+
+    def add_transition(self, state, c):
+        """
+        Return the state following state on character c, and add it to
+        the transition table.
+        """
+        next_state = self.class_transitions[state][
+            self.class_map.get(ord(c), self.high_class)]
+        if next_state > 0 and self.class_transitions[next_state] is None:
+            self._expand(next_state)
+        self.transitions[state][c] = next_state
+        return next_state
+
+class TokenColumns(object):
+    """
+    A tokenized buffer, as returned by Tokenizer.tokenize_columns().  The
+    tokens are stored as parallel arrays:
+
+    types -- the index of the token definition matched for each token, or
+    -1 for the final Token.END_TOKEN
+
+    starts -- the offset of the start of each token in the buffer
+
+    ends -- the offset of the end of each token in the buffer
+
+    Tokens are accessed by index.  To parse them, pass a cursor to the
+    parser, for example: Parser(expr_spec, columns.cursor())
+
+    On Python 3, token content in a buffer that is not a str is decoded
+    with the given encoding, and offsets and columns count bytes.
+    """
+
+    def __init__(self, buffer, filename, token_types, types, starts, ends,
+                 encoding = "utf-8"):
+        self.buffer = buffer
+        self.filename = filename
+        self.token_types = token_types
+        self.types = types
+        self.starts = starts
+        self.ends = ends
+        self.lines = LineIndex(filename, buffer)
+        self.encoding = None
+        if _is_bytes_buffer(buffer):
+            self.encoding = encoding
+
+    def __len__(self):
+        return len(self.types)
+
+    def type(self, index):
+        """
+        Return the type of the token at index.
+        """
+        type_index = self.types[index]
+        if type_index < 0:
+            return Token.END_TOKEN
+        token_type = self.token_types[type_index]
+        if token_type == None:
+            token_type = self.content(index)
+        return token_type
+
+    def content(self, index):
+        """
+        Return the content of the token at index, copied from the buffer.
+        """
+        content = self.buffer[self.starts[index]:self.ends[index]]
+        if self.encoding is not None:
+            content = content.decode(self.encoding)
+        return content
+
+    def view(self, index):
+        """
+        Return a memoryview of the content of the token at index without
+        copying it.  The buffer must support the buffer protocol, which
+        on Python 3 means it must be bytes, an mmap or similar rather
+        than a str.
+        """
+        return memoryview(self.buffer)[self.starts[index]:self.ends[index]]
+
+    def position(self, index):
+        """
+        Return the (line, column) position of the token at index, as
+        reported by the line_pos and column_pos attributes of Token.
+        """
+        if self.types[index] < 0:
+            # the end token follows the last line, which may be
+            # unterminated
+            line_pos, column_pos = self.position_at(self.ends[index])
+            if column_pos > 0:
+                line_pos += 1
+            return line_pos, 0
+        return self.position_at(self.ends[index])
+
+    def position_at(self, offset):
+        """
+        Return the (line, column) position of an offset into the buffer.
+
+        The first time this is called an index of the offsets of the
+        start of each line is built.
+        """
+        return self.lines.position(offset)
+
+    def token(self, index):
+        """
+        Return a ColumnToken object for the token at index.
+        """
+        return ColumnToken(self, index, self.type(index))
+
+    def cursor(self, index = 0):
+        """
+        Return an iterator yielding ColumnToken objects for each token
+        starting from index.  This can be passed to the Parser in place
+        of a token generator.
+        """
+        return TokenCursor(self, index)
+
+class ColumnToken(object):
+    """
+    A lightweight view of a token stored in a TokenColumns object.  It
+    has the same attributes as Token.  Apart from the type, these are
+    looked up in the TokenColumns object when accessed.
+    """
+
+    __slots__ = ("columns", "index", "type")
+
+    def __init__(self, columns, index, type):
+        self.columns = columns
+        self.index = index
+        self.type = type
+
+    @property
+    def content(self):
+        return self.columns.content(self.index)
+
+    @property
+    def filename(self):
+        return self.columns.filename
+
+    @property
+    def line_pos(self):
+        return self.columns.position(self.index)[0]
+
+    @property
+    def column_pos(self):
+        return self.columns.position(self.index)[1]
+
+    def __repr__(self):
+        if self.type == Token.END_TOKEN:
+            tt = "Token.END_TOKEN"
+        else:
+            tt = repr(self.type)
+        return "ColumnToken(%s, %s)" % (tt, repr(self.content))
+
+class TokenCursor(object):
+    """
+    An iterator over the tokens in a TokenColumns object, returned by
+    TokenColumns.cursor().
+
+    index -- the index of the next token to be returned
+    """
+
+    def __init__(self, columns, index = 0):
+        self.columns = columns
+        self.index = index
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        index = self.index
+        columns = self.columns
+        if index >= len(columns.types):
+            raise StopIteration
+        self.index = index + 1
+        return ColumnToken(columns, index, columns.type(index))
+
+    next = __next__
+
+def _compile_cached(source, filename, cache_dir):
+    """
+    Internal - compile generated source to a code object, caching it in
+    cache_dir if that is specified.
+    """
+    if cache_dir is None:
+        return compile(source, filename, "exec")
+    key = hashlib.sha1((sys.version + source).encode("utf-8")).hexdigest()
+    path = os.path.join(cache_dir, "varas_%s.code" % key)
+    try:
+        with open(path, "rb") as f:
+            return marshal.load(f)
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        pass
+    code = compile(source, filename, "exec")
+    temp_path = "%s.%d" % (path, os.getpid())
+    with open(temp_path, "wb") as f:
+        marshal.dump(code, f)
+    os.rename(temp_path, path)
+    return code
 
 class ExprSpec:
     """
@@ -190,17 +1825,83 @@ class ExprSpec:
     include -- optional, if specified then initialise the new object by
     by including all the actions defined by this one
 
-    Initialised by the client by calling the add_* methods.
+    Initialised by the client by calling the add_* methods.  Once
+    initialised it can be frozen by calling freeze(), which makes
+    parsing faster.
+    """
+
     """
+    Largest number of token types that code generated by compile()
+    dispatches on with a chain of comparisons rather than dictionaries
+    """
+    max_compared_types = 8
 
     def __init__(self, name = "this", include = None):
         self.name = name
+        self.frozen = False
+        self.fast_expression = None
         if include:
             self.prefix_actions = dict(include.prefix_actions)
             self.infix_actions = dict(include.infix_actions)
+            self.word_funcs = dict(include.word_funcs)
+            self.unary_funcs = dict(include.unary_funcs)
+            self.binary_funcs = dict(include.binary_funcs)
+            self.parens = dict(include.parens)
+            self.lists = dict(include.lists)
+            self.brackets = dict(include.brackets)
         else:
             self.prefix_actions = {}
             self.infix_actions = {}
+            self.word_funcs = {}
+            self.unary_funcs = {}
+            self.binary_funcs = {}
+            self.parens = {}
+            self.lists = {}
+            self.brackets = {}
+
+    def freeze(self, iterative = False):
+        """
+        Prevent further changes to the expression spec and make the
+        parser use a faster implementation of Parser.expression() for
+        it, which dispatches each token with a single table lookup.
+
+        iterative -- optional, if true then operators added with
+        add_unary_op() and add_binary_op(), and parens and lists added
+        with add_parens() and add_list(), are parsed using an explicit
+        stack rather than by recursion, so they can be nested to any
+        depth
+        """
+        if self.frozen:
+            return
+        self.frozen = True
+        if iterative:
+            self.fast_expression = self._make_iterative_expression()
+        else:
+            self.fast_expression = self._make_frozen_expression()
+
+    def generate_source(self):
+        """
+        Return the Python source of a parse function specialised for this
+        expression spec, as used by compile().
+        """
+        return self._generate_expression()[0]
+
+    def compile(self, cache_dir = None):
+        """
+        Freeze the expression spec and make the parser use a parse function
+        generated from it.  Binding powers are written into the generated
+        code as constants, and handlers added with add_word(),
+        add_unary_op() and add_binary_op() are called directly.
+
+        cache_dir -- optional, a directory in which to cache the compiled
+        code between runs
+        """
+        source, args = self._generate_expression()
+        code = _compile_cached(source, "<varas %s>" % self.name, cache_dir)
+        namespace = {}
+        exec(code, namespace)
+        self.frozen = True
+        self.fast_expression = namespace["make_expression"](*args)
 
     ##################################################################
     # Internal implementation
@@ -243,98 +1944,1072 @@ class ExprSpec:
         handler_func = self.infix_actions[token_type][1]
         return handler_func(parser, self, token, left_value)
 
+    def _make_frozen_expression(self):
+        """
+        Internal - return a function implementing Parser.expression() for
+        this expression spec, with the dispatch tables and other values
+        it needs bound to local variables.
+        """
+        expr_spec = self
+        name = self.name
+        prefix_lookup = dict(self.prefix_actions).get
+        infix_lookup = dict(self.infix_actions).get
+        END_TOKEN = Token.END_TOKEN
+
+        def frozen_expression(parser, bind_right):
+            token = parser.token
+            token_type = token.type
+            if token_type == END_TOKEN:
+                raise ParseError(token, "Unexpected end of input")
+            lookahead = parser.lookahead
+            if lookahead:
+                parser.token = lookahead.popleft()
+            else:
+                parser.token = next(parser.token_generator)
+            handler = prefix_lookup(token_type)
+            if handler is None:
+                raise ParseError(token, "Unexpected '%s' in %s context" %
+                                 (str(token_type), name))
+            left = handler(parser, expr_spec, token)
+
+            while True:
+                token = parser.token
+                infix_action = infix_lookup(token.type)
+                if infix_action is None:
+                    if bind_right >= 0:
+                        return left
+                    parser.next_token()
+                    raise ParseError(token, "Unexpected '%s' in %s context" %
+                                     (str(token.type), name))
+                if bind_right >= infix_action[0]:
+                    return left
+                parser.next_token()
+                left = infix_action[1](parser, expr_spec, token, left)
+
+        return frozen_expression
+
+    def _make_iterative_expression(self):
+        """
+        Internal - return a function implementing Parser.expression() for
+        this expression spec which keeps a stack of partly parsed
+        expressions rather than recursing for each operand.
+        """
+        expr_spec = self
+        name = self.name
+        END_TOKEN = Token.END_TOKEN
+        WORD, UNARY, BINARY, PARENS, LIST, HANDLER = range(6)
+
+        prefix_table = {}
+        for token_type, handler in self.prefix_actions.items():
+            if token_type in self.word_funcs:
+                prefix_table[token_type] = (WORD, self.word_funcs[token_type])
+            elif token_type in self.unary_funcs:
+                prefix_table[token_type] = (UNARY, self.unary_funcs[token_type])
+            elif token_type in self.parens:
+                prefix_table[token_type] = (PARENS, self.parens[token_type])
+            elif token_type in self.lists:
+                prefix_table[token_type] = (LIST, self.lists[token_type])
+            else:
+                prefix_table[token_type] = (HANDLER, handler)
+        prefix_lookup = prefix_table.get
+
+        infix_table = {}
+        for token_type, (bind_left, handler) in self.infix_actions.items():
+            if token_type in self.binary_funcs:
+                bind_right, func = self.binary_funcs[token_type]
+                infix_table[token_type] = (bind_left, bind_right, func)
+            else:
+                infix_table[token_type] = (bind_left, None, handler)
+        infix_lookup = infix_table.get
+
+        def iterative_expression(parser, bind_right):
+            # each entry is a tuple of the kind of expression, the binding
+            # power to restore when it is complete and its state so far
+            stack = []
+            while True:
+                token = parser.token
+                if token.type == END_TOKEN:
+                    raise ParseError(token, "Unexpected end of input")
+                if parser.lookahead:
+                    parser.token = parser.lookahead.popleft()
+                else:
+                    parser.token = next(parser.token_generator)
+                action = prefix_lookup(token.type)
+                if action is None:
+                    raise ParseError(token, "Unexpected '%s' in %s context" %
+                                     (str(token.type), name))
+                kind, arg = action
+                if kind == WORD:
+                    left = arg(token)
+                elif kind == UNARY:
+                    stack.append((UNARY, bind_right, token, arg))
+                    bind_right = 100
+                    continue
+                elif kind == PARENS:
+                    stack.append((PARENS, bind_right, arg))
+                    bind_right = 0
+                    continue
+                elif kind == LIST:
+                    if parser.opt(arg[0]):
+                        left = arg[2](token, [])
+                    else:
+                        stack.append((LIST, bind_right, token, [], arg))
+                        bind_right = 0
+                        continue
+                else:
+                    left = arg(parser, expr_spec, token)
+
+                while True:
+                    token = parser.token
+                    action = infix_lookup(token.type)
+                    if action is not None and bind_right < action[0]:
+                        parser.next_token()
+                        if action[1] is None:
+                            left = action[2](parser, expr_spec, token, left)
+                            continue
+                        stack.append((BINARY, bind_right, token, left,
+                                      action[2]))
+                        bind_right = action[1]
+                        break
+                    if action is None and bind_right < 0:
+                        parser.next_token()
+                        raise ParseError(token, "Unexpected '%s' in %s context" %
+                                         (str(token.type), name))
+                    if not stack:
+                        return left
+                    entry = stack.pop()
+                    kind = entry[0]
+                    bind_right = entry[1]
+                    if kind == BINARY:
+                        left = entry[4](entry[2], entry[3], left)
+                    elif kind == UNARY:
+                        left = entry[3](entry[2], left)
+                    elif kind == PARENS:
+                        parser.match(entry[2])
+                    else:
+                        items = entry[3]
+                        items.append(left)
+                        close_type, separator, handler_func = entry[4]
+                        if parser.opt(close_type):
+                            left = handler_func(entry[2], items)
+                        else:
+                            parser.match(separator)
+                            stack.append(entry)
+                            bind_right = 0
+                            break
+
+        return iterative_expression
+
+    def _generate_expression(self):
+        """
+        Internal - generate the source of a function that returns a
+        specialised implementation of Parser.expression() for this
+        expression spec.  Returns the source and the arguments to call
+        that function with.
+        """
+        params = ["expr_spec", "name", "ParseError", "next"]
+        args = [self, self.name, ParseError, next]
+
+        def constant(value):
+            if type(value) in (int, str):
+                return repr(value)
+            params.append("c%d" % (len(params) - 4))
+            args.append(value)
+            return params[-1]
+
+        def function(func):
+            params.append("f%d" % (len(params) - 4))
+            args.append(func)
+            return params[-1]
+
+        def advance(indent):
+            return [indent + "if parser.lookahead:",
+                    indent + "    parser.token = parser.lookahead.popleft()",
+                    indent + "else:",
+                    indent + "    parser.token = next(parser.token_generator)"]
+
+        error = ("raise ParseError(token, \"Unexpected '%s' in %s context\" % "
+                 "(str(token_type), name))")
+
+        body = ["    def expression(parser, bind_right):",
+                "        token = parser.token",
+                "        token_type = token.type",
+                "        if token_type == %s:" % constant(Token.END_TOKEN),
+                "            raise ParseError(token, \"Unexpected end of input\")"]
+        body.extend(advance("        "))
+        if len(self.prefix_actions) > self.max_compared_types:
+            # look the token type up in a table for each kind of handler
+            word_table = {}
+            unary_table = {}
+            handler_table = {}
+            for token_type, handler in self.prefix_actions.items():
+                if token_type in self.word_funcs:
+                    word_table[token_type] = self.word_funcs[token_type]
+                elif token_type in self.unary_funcs:
+                    unary_table[token_type] = self.unary_funcs[token_type]
+                else:
+                    handler_table[token_type] = handler
+            kinds = [(word_table, ["left = func(token)"]),
+                     (unary_table, ["left = func(token, expression(parser, 100))"]),
+                     (handler_table, ["left = func(parser, expr_spec, token)"])]
+            body.extend(self._generate_lookups("        ", "func", kinds,
+                                               [error], constant))
+        else:
+            keyword = "if"
+            for token_type in self.prefix_actions:
+                body.append("        %s token_type == %s:" % (keyword,
+                                                              constant(token_type)))
+                if token_type in self.word_funcs:
+                    func = function(self.word_funcs[token_type])
+                    body.append("            left = %s(token)" % func)
+                elif token_type in self.unary_funcs:
+                    func = function(self.unary_funcs[token_type])
+                    body.append("            left = %s(token, expression(parser, 100))"
+                                % func)
+                else:
+                    func = function(self.prefix_actions[token_type])
+                    body.append("            left = %s(parser, expr_spec, token)" % func)
+                keyword = "elif"
+            if self.prefix_actions:
+                body.append("        else:")
+                body.append("            " + error)
+            else:
+                body.append("        " + error)
+
+        body.append("        while True:")
+        body.append("            token = parser.token")
+        body.append("            token_type = token.type")
+        unmatched = ["if bind_right >= 0:",
+                     "    return left",
+                     "parser.next_token()",
+                     error]
+        if len(self.infix_actions) > self.max_compared_types:
+            binary_table = {}
+            handler_table = {}
+            for token_type, (bind_left, handler) in self.infix_actions.items():
+                if token_type in self.binary_funcs:
+                    bind_right, func = self.binary_funcs[token_type]
+                    binary_table[token_type] = (bind_left, bind_right, func)
+                else:
+                    handler_table[token_type] = (bind_left, handler)
+            binary = (["if bind_right >= action[0]:",
+                       "    return left"] + advance("") +
+                      ["left = action[2](token, left, "
+                       "expression(parser, action[1]))"])
+            handler = (["if bind_right >= action[0]:",
+                        "    return left"] + advance("") +
+                       ["left = action[1](parser, expr_spec, token, left)"])
+            kinds = [(binary_table, binary), (handler_table, handler)]
+            body.extend(self._generate_lookups("            ", "action", kinds,
+                                               unmatched, constant))
+        else:
+            keyword = "if"
+            for token_type in self.infix_actions:
+                bind_left = self.infix_actions[token_type][0]
+                body.append("            %s token_type == %s:" % (keyword,
+                                                                  constant(token_type)))
+                body.append("                if bind_right >= %d:" % bind_left)
+                body.append("                    return left")
+                body.extend(advance("                "))
+                if token_type in self.binary_funcs:
+                    bind_right, func = self.binary_funcs[token_type]
+                    body.append("                left = %s(token, left, "
+                                "expression(parser, %d))" % (function(func), bind_right))
+                else:
+                    func = function(self.infix_actions[token_type][1])
+                    body.append("                left = %s(parser, expr_spec, token, left)"
+                                % func)
+                keyword = "elif"
+            indent = "            "
+            if self.infix_actions:
+                body.append("            else:")
+                indent += "    "
+            body.extend(indent + line for line in unmatched)
+        body.append("    return expression")
+
+        lines = ["def make_expression(%s):" % ", ".join(params)] + body
+        return "\n".join(lines) + "\n", args
+
+    def _generate_lookups(self, indent, name, kinds, otherwise, constant):
+        """
+        Internal - generate code that looks token_type up in a series of
+        dictionaries, running the lines given for the first one that
+        contains it, or the otherwise lines if none do.
+
+        kinds -- a list of (dictionary, lines) tuples, where the lines
+        refer to the value found as name
+        """
+        body = []
+        for table, lines in kinds:
+            if not table:
+                continue
+            body.append(indent + "%s = %s(token_type)" % (name, constant(table.get)))
+            body.append(indent + "if %s is not None:" % name)
+            body.extend(indent + "    " + line for line in lines)
+            body.append(indent + "else:")
+            indent += "    "
+        body.extend(indent + line for line in otherwise)
+        return body
+
+    def _derive(self, word = None, unary = None, binary = None, lists = None):
+        """
+        Internal - return a new expression spec that parses the same
+        expressions as this one, with the functions passed to add_word(),
+        add_unary_op(), add_binary_op() and add_list() replaced.  Each
+        argument is optional, and is called with a token type and the
+        original function and returns the replacement.  Other handlers
+        are added unchanged.
+        """
+        spec = ExprSpec(self.name)
+        for token_type, func in self.word_funcs.items():
+            if word is not None:
+                func = word(token_type, func)
+            spec.add_word(token_type, func)
+        for token_type, func in self.unary_funcs.items():
+            if unary is not None:
+                func = unary(token_type, func)
+            spec.add_unary_op(token_type, func)
+        for token_type, (bind_right, func) in self.binary_funcs.items():
+            bind_left = self.infix_actions[token_type][0]
+            if binary is not None:
+                func = binary(token_type, func)
+            spec.add_binary_op(token_type, bind_left, bind_right - bind_left,
+                               func)
+        for open_type, close_type in self.parens.items():
+            spec.add_parens(open_type, close_type)
+        for open_type, (close_type, separator, func) in self.lists.items():
+            if lists is not None:
+                func = lists(open_type, func)
+            spec.add_list(open_type, close_type, separator, func)
+        for token_type, handler in self.prefix_actions.items():
+            if token_type not in spec.prefix_actions:
+                spec.add_prefix_handler(token_type, handler)
+        for token_type, (bind_left, handler) in self.infix_actions.items():
+            if token_type not in spec.infix_actions:
+                spec.add_infix_handler(token_type, bind_left, handler)
+        spec.brackets.update(self.brackets)
+        return spec
+
     ##################################################################
     # Low level initialisation methods for use by client
     ##################################################################
 
     def add_prefix_handler(self, token_type, handler_func):
         """
-        Add a handler to be called when a specified token type is found
-        in prefix position.
+        Add a handler to be called when a specified token type is found
+        in prefix position.
+
+        token_type -- the token type to be handled
+
+        handler_func -- a function called when the token is found, with
+        the following arguments: parser, expression spec, token.
+        """
+        assert not self.frozen, "Can't change a frozen ExprSpec"
+        assert token_type not in self.prefix_actions
+        self.prefix_actions[token_type] = handler_func
+
+    def add_infix_handler(self, token_type, bind_left, handler_func):
+        """
+        Add a handler to be called when a specified token type is found
+        in infix position.
+
+        token_type -- the token type to be handled
+
+        bind_left -- the left binding power of the token, must be a
+        multiple of two
+
+        handler_func -- a function called when the token is found,with
+        the following arguments: parser, expression spec, token, value of the
+        left hand side of the expression.
+        """
+        assert not self.frozen, "Can't change a frozen ExprSpec"
+        assert token_type not in self.infix_actions
+        assert bind_left % 2 == 0
+        self.infix_actions[token_type] = (bind_left, handler_func)
+
+    ##################################################################
+    # More convenient initialisation methods for use by client
+    ##################################################################
+
+    def add_word(self, token_type, handler_func):
+        """
+        Add a handler for tokens that represent words of the grammar,
+        for example literal tokens or identifiers.
+
+        token_type -- the token type to be handled
+
+        handler_func -- a function which is called with token object,
+        and that returns the literal value.
+        """
+        def word_handler(parser, expr_spec, token):
+            return handler_func(token)
+        self.add_prefix_handler(token_type, word_handler)
+        self.word_funcs[token_type] = handler_func
+
+    def add_binary_op(self, token_type, bind_left, assoc, handler_func):
+        """
+        Add a handler for a binary operator.
+
+        token_type -- the token type to be handled
+
+        bind_left -- the left binding power of the token, must be a
+        multiple of two
+
+        assoc -- the associativity of the opeator, one of Assoc.LEFT or
+        Assoc.RIGHT
+
+        handler_func -- a function that returns the value of the whole
+        expression.  It is called with the following arguments: token,
+        value of left subexpression, value of right subexpression.
+        """
+        # calculate right binding power by addng left binding power and
+        # associativity, hence why left binding power must be a multiple
+        # of two
+        bind_right = bind_left + assoc
+        def binary_handler(parser, expr_spec, token, left_value):
+            right_value = parser.expression(expr_spec, bind_right)
+            return handler_func(token, left_value, right_value)
+        self.add_infix_handler(token_type, bind_left, binary_handler)
+        self.binary_funcs[token_type] = (bind_right, handler_func)
+
+    def add_unary_op(self, token_type, handler_func):
+        """
+        Add a handler for a unary prefix operator.
+
+        token_type -- the token type to be handled
+
+        handler_func -- a function that returns the value of the whole
+        expression.  It is called with the following arguments: token,
+        value of right subexpression.
+        """
+        def unary_handler(parser, expr_spec, token):
+            right_value = parser.expression(expr_spec, 100)
+            return handler_func(token, right_value)
+        self.add_prefix_handler(token_type, unary_handler)
+        self.unary_funcs[token_type] = handler_func
+
+    def add_parens(self, open_type, close_type):
+        """
+        Add a handler for an expression in parentheses or other brackets,
+        whose value is that of the expression inside them.
+
+        open_type -- the token type of the opening bracket
+
+        close_type -- the token type of the closing bracket
+        """
+        def parens_handler(parser, expr_spec, token):
+            value = parser.expression(expr_spec)
+            parser.match(close_type)
+            return value
+        self.add_prefix_handler(open_type, parens_handler)
+        self.parens[open_type] = close_type
+        self.brackets[open_type] = close_type
+
+    def add_list(self, open_type, close_type, separator, handler_func):
+        """
+        Add a handler for a list of expressions between brackets and
+        separated by a separator token, such as '[1, 2, 3]'.
+
+        open_type -- the token type of the opening bracket
+
+        close_type -- the token type of the closing bracket
+
+        separator -- the token type of the separator
+
+        handler_func -- a function that returns the value of the list.
+        It is called with the following arguments: the opening token, a
+        list of the values of the expressions in the list.
+        """
+        def list_handler(parser, expr_spec, token):
+            items = []
+            while not parser.opt(close_type):
+                if items:
+                    parser.match(separator)
+                items.append(parser.expression(expr_spec))
+            return handler_func(token, items)
+        self.add_prefix_handler(open_type, list_handler)
+        self.lists[open_type] = (close_type, separator, handler_func)
+        self.brackets[open_type] = close_type
+
+    def add_brackets(self, open_type, close_type):
+        """
+        Declare that the prefix handler for a token type parses everything
+        up to a matching closing token, so that Parser.skip_expression()
+        can skip over what it parses.  This is done automatically by
+        add_parens() and add_list().
+
+        open_type -- the token type of the opening bracket, which must
+        have a prefix handler
+
+        close_type -- the token type of the closing bracket
+        """
+        assert not self.frozen, "Can't change a frozen ExprSpec"
+        assert open_type in self.prefix_actions
+        self.brackets[open_type] = close_type
+
+class ASTArena(object):
+    """
+    Stores syntax trees in flat arrays rather than as a Python object per
+    node.  spec() returns an expression spec whose handlers add nodes to
+    the arena and return their indexes, and node() returns a view of a
+    node for walking the tree.
+
+    Each node has an operation, which is a kind and the token type that
+    produced the node, two integers whose meaning depends on the kind,
+    and the offset of the end of its token in the input.  Offsets are
+    only known for tokens produced with positions="lazy", and are -1
+    otherwise.
+    The kinds are:
+
+    WORD -- a word.  If the value returned by its handler is an int
+    that fits in 32 bits then the first integer is the value and the
+    second is 1, otherwise the first is the index of the value in values
+    and the second is 0
+
+    UNARY -- a unary operator, the first integer is the index of its
+    operand
+
+    BINARY -- a binary operator, the integers are the indexes of its left
+    and right operands
+
+    LIST -- a list, the integers are the position and number of the
+    indexes of its items in the items array
+
+    Parentheses don't produce nodes.
+    """
+
+    WORD = 0
+    UNARY = 1
+    BINARY = 2
+    LIST = 3
+
+    kind_names = ("word", "unary", "binary", "list")
+
+    def __init__(self):
+        self.operations = []
+        self.ops = array.array("i")
+        self.first = array.array("i")
+        self.second = array.array("i")
+        self.offsets = array.array("l")
+        self.items = array.array("i")
+        self.values = []
+
+    def __len__(self):
+        return len(self.ops)
+
+    def clear(self):
+        """
+        Discard all the nodes, so the arena can be reused for another
+        parse.
+        """
+        del self.ops[:], self.first[:], self.second[:], self.offsets[:]
+        del self.items[:], self.values[:]
+
+    def _operation(self, kind, token_type):
+        """
+        Internal - return the code stored for an operation.
+        """
+        operation = (kind, token_type)
+        if operation not in self.operations:
+            self.operations.append(operation)
+        return self.operations.index(operation)
+
+    def _adder(self):
+        """
+        Internal - return a function that adds a node and returns its
+        index.
+        """
+        ops = self.ops
+        add_op = ops.append
+        add_first = self.first.append
+        add_second = self.second.append
+        add_offset = self.offsets.append
+        def add(op, first, second, token):
+            add_op(op)
+            add_first(first)
+            add_second(second)
+            add_offset(getattr(token, "offset", -1))
+            return len(ops) - 1
+        return add
+
+    def spec(self, expr_spec):
+        """
+        Return a new expression spec that parses the same expressions as
+        expr_spec, but whose words, unary and binary operators and lists
+        add nodes to this arena and return their indexes instead of
+        calling expr_spec's handlers.  Parentheses return the index of the
+        expression inside them, and other handlers are called as before.
+        The new spec can be frozen or compiled.
+        """
+        add = self._adder()
+        values = self.values
+        arena_items = self.items
+        def word(token_type, func):
+            op = self._operation(ASTArena.WORD, token_type)
+            def word_handler(token):
+                value = func(token)
+                if type(value) is int and -0x80000000 <= value <= 0x7fffffff:
+                    return add(op, value, 1, token)
+                values.append(value)
+                return add(op, len(values) - 1, 0, token)
+            return word_handler
+        def unary(token_type, func):
+            op = self._operation(ASTArena.UNARY, token_type)
+            def unary_handler(token, operand):
+                return add(op, operand, -1, token)
+            return unary_handler
+        def binary(token_type, func):
+            op = self._operation(ASTArena.BINARY, token_type)
+            def binary_handler(token, left, right):
+                return add(op, left, right, token)
+            return binary_handler
+        def lists(open_type, func):
+            op = self._operation(ASTArena.LIST, open_type)
+            def list_handler(token, items):
+                start = len(arena_items)
+                arena_items.extend(items)
+                return add(op, start, len(items), token)
+            return list_handler
+        return expr_spec._derive(word, unary, binary, lists)
+
+    def node(self, index):
+        """
+        Return an ASTNode viewing the node at index.
+        """
+        return ASTNode(self, index)
+
+class ASTNode(object):
+    """
+    A view of a node stored in an ASTArena.  Its attributes are looked up
+    in the arena when they are accessed:
+
+    kind -- the name of the kind of node: "word", "unary", "binary" or
+    "list"
+
+    type -- the token type that produced the node
+
+    value -- for words, the value returned by the word's handler
+
+    children -- a list of ASTNode objects for the node's operands or
+    items
+
+    offset -- the offset of the end of the node's token in the input,
+    or -1
+    """
+
+    __slots__ = ("arena", "index")
+
+    def __init__(self, arena, index):
+        self.arena = arena
+        self.index = index
+
+    @property
+    def kind(self):
+        arena = self.arena
+        return ASTArena.kind_names[arena.operations[arena.ops[self.index]][0]]
+
+    @property
+    def type(self):
+        arena = self.arena
+        return arena.operations[arena.ops[self.index]][1]
+
+    @property
+    def value(self):
+        arena = self.arena
+        index = self.index
+        if arena.operations[arena.ops[index]][0] != ASTArena.WORD:
+            return None
+        if arena.second[index]:
+            return arena.first[index]
+        return arena.values[arena.first[index]]
+
+    @property
+    def children(self):
+        arena = self.arena
+        index = self.index
+        kind = arena.operations[arena.ops[index]][0]
+        first = arena.first[index]
+        if kind == ASTArena.UNARY:
+            return [ASTNode(arena, first)]
+        if kind == ASTArena.BINARY:
+            return [ASTNode(arena, first),
+                    ASTNode(arena, arena.second[index])]
+        if kind == ASTArena.LIST:
+            return [ASTNode(arena, item) for item in
+                    arena.items[first:first + arena.second[index]]]
+        return []
+
+    @property
+    def offset(self):
+        return self.arena.offsets[self.index]
+
+    def __repr__(self):
+        return "ASTNode(%s, %s)" % (self.kind, repr(self.type))
+
+class InternedNode(object):
+    """
+    A tuple shared by an InternTable, wrapped so that it can be weakly
+    referenced.  It can be indexed and iterated over, and compares equal
+    to a plain tuple or other node with the same items.
+
+    items -- the tuple
+    """
+
+    __slots__ = ("items", "__weakref__")
+
+    def __init__(self, items):
+        self.items = items
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, index):
+        return self.items[index]
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if type(other) is InternedNode:
+            other = other.items
+        elif type(other) is not tuple:
+            return NotImplemented
+        return self.items == other
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __hash__(self):
+        return hash(self.items)
+
+    def __repr__(self):
+        return repr(self.items)
+
+class InternTable(object):
+    """
+    Shares the structurally identical results of unary and binary
+    operators, so that each distinct subtree is stored once and
+    identical subtrees are the same object.  Comparing trees is then
+    fast where they share subtrees, and can be done by identity.
+
+    spec() returns an expression spec whose operators look up the
+    operator token and their operands in the table before calling their
+    handler, and return the result stored for them if there is one.
+    Operands are matched by identity if they are shared results and by
+    type and value otherwise, so that for example 1 and 1.0 are different
+    operands.  Handlers must return the same value for the same token and
+    operands.  Results that are tuples are wrapped in InternedNode objects,
+    so operators return InternedNode objects rather than tuples, and are
+    stored if they contain the operands that are shared results, or if
+    they are one of them.  Other results are not shared.
+
+    The table holds weak references to the results, so entries are
+    dropped when the trees that use them are.  clear() drops them all, so
+    that later parses don't share results with earlier ones.
+    """
+
+    def __init__(self):
+        self.nodes = weakref.WeakValueDictionary()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def clear(self):
+        """
+        Forget all the shared results.
+        """
+        self.nodes.clear()
+
+    def _intern(self, key, make, operands):
+        """
+        Internal - return the result stored for key, or call make() to
+        create it and store it if possible.  Shared operands are part of
+        the key by identity, so the result is only stored if it keeps
+        them alive.
+        """
+        nodes = self.nodes
+        try:
+            node = nodes[key]
+            self.hits += 1
+            return node
+        except KeyError:
+            pass
+        except TypeError:
+            # an operand is unhashable
+            return make()
+        self.misses += 1
+        node = make()
+        if type(node) is tuple:
+            node = InternedNode(node)
+        elif type(node) is not InternedNode:
+            return node
+        for operand in operands:
+            if type(operand) is InternedNode and operand is not node and \
+               not any(item is operand for item in node):
+                return node
+        nodes[key] = node
+        return node
+
+    def spec(self, expr_spec):
+        """
+        Return a new expression spec that parses the same expressions as
+        expr_spec, but whose unary and binary operators share their
+        results through this table.  The new spec can be frozen or
+        compiled.
+        """
+        intern = self._intern
+        def value_key(value):
+            # values that compare equal but have different types, such as
+            # 1 and 1.0 or True, must not share results
+            value_type = type(value)
+            if value_type is tuple:
+                return (tuple, tuple(value_key(item) for item in value))
+            return (value_type, value)
+        def operand_key(value):
+            if type(value) is InternedNode:
+                return id(value)
+            return value_key(value)
+        def unary(token_type, func):
+            def unary_handler(token, operand):
+                key = (token.type, token.content, operand_key(operand))
+                return intern(key, lambda: func(token, operand), (operand,))
+            return unary_handler
+        def binary(token_type, func):
+            def binary_handler(token, left, right):
+                key = (token.type, token.content, operand_key(left),
+                       operand_key(right))
+                return intern(key, lambda: func(token, left, right),
+                              (left, right))
+            return binary_handler
+        return expr_spec._derive(unary = unary, binary = binary)
+
+class LRUCache(object):
+    """
+    A mapping of limited size that discards its least recently used
+    entries when it is full, and counts how often lookups find an entry.
+
+    max_size -- the largest number of entries kept
+
+    max_cost -- optional, the largest total cost of the entries kept, where
+    each entry's cost is given when it is added
+    """
+
+    def __init__(self, max_size = 1000, max_cost = None):
+        assert max_size > 0, "LRUCache size must be positive"
+        self.max_size = max_size
+        self.max_cost = max_cost
+        self.entries = OrderedDict()
+        self.costs = {}
+        self.cost = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default = None):
+        """
+        Return the value for a key and mark it as the most recently used,
+        or return default if it is not present.
+        """
+        entries = self.entries
+        try:
+            value = entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        entries[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value, cost = 0):
+        """
+        Add or replace the value for a key, discarding the least recently
+        used entries while the cache holds too many entries or their total
+        cost is too high.  An entry that costs more than max_cost on its
+        own is not kept.
+        """
+        entries = self.entries
+        costs = self.costs
+        entries.pop(key, None)
+        self.cost -= costs.pop(key, 0)
+        entries[key] = value
+        if cost:
+            costs[key] = cost
+            self.cost += cost
+        max_cost = self.max_cost
+        while (len(entries) > self.max_size or
+               (max_cost is not None and self.cost > max_cost)):
+            old_key = entries.popitem(last = False)[0]
+            self.cost -= costs.pop(old_key, 0)
+            self.evictions += 1
+
+    def clear(self):
+        """
+        Discard all entries.  The counts are kept.
+        """
+        self.entries.clear()
+        self.costs.clear()
+        self.cost = 0
+
+    def stats(self):
+        """
+        Return a dict of the number of entries, hits, misses and
+        evictions, and the proportion of lookups that were hits.
+        """
+        lookups = self.hits + self.misses
+        return {"size": len(self.entries),
+                "cost": self.cost,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / float(lookups) if lookups else 0.0}
+
+class ParseCache(object):
+    """
+    A front end for a tokenizer and expression spec that caches the results
+    of parsing input strings, so that parsing text that has been seen
+    before returns the earlier results without tokenizing or parsing it
+    again.  A ParseError raised while parsing is cached too, and raised
+    again for the same text.
 
-        token_type -- the token type to be handled
+    tokenizer -- the Tokenizer used to tokenize input
 
-        handler_func -- a function called when the token is found, with
-        the following arguments: parser, expression spec, token.
-        """
-        assert token_type not in self.prefix_actions
-        self.prefix_actions[token_type] = handler_func
+    expr_spec -- the ExprSpec used to parse input, unless another is given
 
-    def add_infix_handler(self, token_type, bind_left, handler_func):
-        """
-        Add a handler to be called when a specified token type is found
-        in infix position.
+    max_size -- the largest number of inputs whose results are kept
 
-        token_type -- the token type to be handled
+    max_bytes -- optional, the largest total length of the inputs whose
+    results are kept
 
-        bind_left -- the left binding power of the token, must be a
-        multiple of two
+    copy_results -- if true, return a deep copy of the cached results each
+    time, so that callers may modify them
+    """
 
-        handler_func -- a function called when the token is found,with
-        the following arguments: parser, expression spec, token, value of the
-        left hand side of the expression.
+    def __init__(self, tokenizer, expr_spec, max_size = 1000, max_bytes = None,
+                 copy_results = False):
+        self.tokenizer = tokenizer
+        self.expr_spec = expr_spec
+        self.copy_results = copy_results
+        self.cache = LRUCache(max_size, max_bytes)
+
+    def parse_list(self, text, expr_spec = None):
         """
-        assert token_type not in self.infix_actions
-        assert bind_left % 2 == 0
-        self.infix_actions[token_type] = (bind_left, handler_func)
+        Return a list of the expressions parsed from text, or raise
+        ParseError if it can't be parsed.  Unlike Parser.parse_all(), the
+        whole input is parsed before this returns.
+        """
+        if expr_spec is None:
+            expr_spec = self.expr_spec
+        key = (text, expr_spec)
+        entry = self.cache.get(key)
+        if entry is None:
+            try:
+                parser = Parser(expr_spec, self.tokenizer.tokenize(text))
+                entry = (list(parser.parse_all()), None)
+            except ParseError as e:
+                entry = (None, e)
+            self.cache.put(key, entry, len(text))
+        result, error = entry
+        if error is not None:
+            raise error.copy()
+        if self.copy_results:
+            result = copy.deepcopy(result)
+        return result
 
-    ##################################################################
-    # More convenient initialisation methods for use by client
-    ##################################################################
+    def clear(self):
+        """
+        Discard all cached results.  The statistics are kept.
+        """
+        self.cache.clear()
 
-    def add_word(self, token_type, handler_func):
+    def stats(self):
         """
-        Add a handler for tokens that represent words of the grammar,
-        for example literal tokens or identifiers.
+        Return a dict of the number of cached inputs, their total length,
+        and the number of hits, misses and evictions, and the proportion
+        of lookups that were hits.
+        """
+        return self.cache.stats()
 
-        token_type -- the token type to be handled
+def _recorded_tokens(pending, source, history):
+    """
+    Internal - generator yielding the tokens in pending followed by those
+    from source, appending each one to history.
+    """
+    while pending:
+        token = pending.popleft()
+        history.append(token)
+        yield token
+    for token in source:
+        history.append(token)
+        yield token
+
+class Mark(object):
+    """
+    A saved position in a parser's token stream, returned by
+    Parser.mark().
+    """
 
-        handler_func -- a function which is called with token object,
-        and that returns the literal value.
-        """
-        def word_handler(parser, expr_spec, token):
-            return handler_func(token)
-        self.add_prefix_handler(token_type, word_handler)
+    def __init__(self, parser, token, position):
+        self.parser = parser
+        self.token = token
+        self.position = position
+        self.active = True
 
-    def add_binary_op(self, token_type, bind_left, assoc, handler_func):
-        """
-        Add a handler for a binary operator.
+    def __enter__(self):
+        return self
 
-        token_type -- the token type to be handled
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.active:
+            if exc_type is not None:
+                self.parser.rewind(self)
+            else:
+                self.parser.commit(self)
 
-        bind_left -- the left binding power of the token, must be a
-        multiple of two
+    def rewind(self):
+        """Return the parser to this position, see Parser.rewind()"""
+        self.parser.rewind(self)
 
-        assoc -- the associativity of the opeator, one of Assoc.LEFT or
-        Assoc.RIGHT
+    def commit(self):
+        """Discard this mark, see Parser.commit()"""
+        self.parser.commit(self)
 
-        handler_func -- a function that returns the value of the whole
-        expression.  It is called with the following arguments: token,
-        value of left subexpression, value of right subexpression.
-        """
-        # calculate right binding power by addng left binding power and
-        # associativity, hence why left binding power must be a multiple
-        # of two
-        bind_right = bind_left + assoc
-        def binary_handler(parser, expr_spec, token, left_value):
-            right_value = parser.expression(expr_spec, bind_right)
-            return handler_func(token, left_value, right_value)
-        self.add_infix_handler(token_type, bind_left, binary_handler)
+class _TokenStack(object):
+    """
+    Internal - a parser's lookahead buffer presented as the stack of
+    tokens that Parser.token_stack used to be, see Parser.token_stack.
+    """
 
-    def add_unary_op(self, token_type, handler_func):
-        """
-        Add a handler for a unary prefix operator.
+    def __init__(self, lookahead):
+        self.lookahead = lookahead
 
-        token_type -- the token type to be handled
+    def __len__(self):
+        return len(self.lookahead)
 
-        handler_func -- a function that returns the value of the whole
-        expression.  It is called with the following arguments: token,
-        value of right subexpression.
-        """
-        def unary_handler(parser, expr_spec, token):
-            right_value = parser.expression(expr_spec, 100)
-            return handler_func(token, right_value)
-        self.add_prefix_handler(token_type, unary_handler)
+    def __iter__(self):
+        return reversed(self.lookahead)
+
+    def __getitem__(self, index):
+        return list(self)[index]
+
+    def append(self, token):
+        self.lookahead.appendleft(token)
+
+    def pop(self, index = -1):
+        assert index in (-1, len(self.lookahead) - 1), \
+            "Only the next token can be popped from the token stack"
+        return self.lookahead.popleft()
 
 class Parser:
     """
@@ -349,16 +3024,147 @@ class Parser:
         """Interal - consume a token from the input stream"""
         if self.at_end():
             raise ParseError(self.token, "Unexpected end of input")
-        if self.token_stack:
-            self.token = self.token_stack.pop(-1)
+        if self.lookahead:
+            self.token = self.lookahead.popleft()
         else:
             self.token = next(self.token_generator)
 
+    def _start_recording(self):
+        """
+        Internal - start keeping a history of the tokens read from the
+        token generator, so that the parser can be rewound to a mark.
+        Tokens already in the lookahead buffer are read again through
+        the recording generator.
+        """
+        self.history = []
+        self.pending = deque(self.lookahead)
+        self.lookahead.clear()
+        self.source = self.token_generator
+        self.token_generator = _recorded_tokens(self.pending, self.source,
+                                                self.history)
+
+    def _stop_recording(self):
+        """
+        Internal - stop keeping a history of tokens once there are no
+        marks left, and read from the original token generator again.
+        If the parser has a memo then recording continues, but tokens
+        that have been consumed are discarded.
+        """
+        if self.memo is not None:
+            self._trim_history()
+            return
+        self.lookahead.extend(self.pending)
+        self.token_generator = self.source
+        self.history = self.pending = self.source = None
+
+    def _trim_history(self):
+        """
+        Internal - discard recorded tokens before the current one, which
+        can't be returned to once there are no marks.
+        """
+        consumed = len(self.history) - len(self.lookahead)
+        if consumed:
+            del self.history[:consumed]
+            self.history_start += consumed
+
+    def _memo_expression(self, expr_spec, bind_right):
+        """
+        Internal - parse an expression, or replay the result or error of
+        parsing it from the same position before.  The memo is keyed on
+        the position of the current token in the whole input, the
+        expression spec and the binding power, and stores the value and
+        the position parsing finished at, or the ParseError raised.
+        """
+        if not self.marks:
+            self._trim_history()
+        history = self.history
+        lookahead = self.lookahead
+        start = self.history_start + len(history) - len(lookahead)
+        key = (start, expr_spec, bind_right)
+        entry = self.memo.get(key)
+        if entry is not None:
+            value, end = entry
+            if end is None:
+                raise value.copy()
+            for i in range(end - start):
+                self.token = lookahead.popleft()
+            return value
+        try:
+            if expr_spec.fast_expression is not None:
+                value = expr_spec.fast_expression(self, bind_right)
+            else:
+                value = self._expression(expr_spec, bind_right)
+        except ParseError as e:
+            self.memo.put(key, (e, None))
+            raise
+        end = self.history_start + len(history) - len(lookahead)
+        self.memo.put(key, (value, end))
+        return value
+
+    def _expression(self, expr_spec, bind_right):
+        """
+        Internal - parse an expression using the expression spec's
+        prefix and infix handlers.
+        """
+        t = self.token
+        self.next_token()
+        left = expr_spec.prefix(self, t)
+        while bind_right < expr_spec.get_bind_left(self.token):
+            t = self.token
+            self.next_token()
+            left = expr_spec.infix(self, t, left)
+        return left
+
+    def _skip_brackets(self, brackets):
+        """
+        Internal - move from the current token, which is an opening
+        bracket, past its matching closing bracket.  Brackets of all the
+        types in brackets, which maps opening types to closing ones, must
+        be nested correctly in between.
+        """
+        close_types = set(brackets.values())
+        closers = [brackets[self.token.type]]
+        lookahead = self.lookahead
+        token_generator = self.token_generator
+        END_TOKEN = Token.END_TOKEN
+        while closers:
+            if lookahead:
+                token = lookahead.popleft()
+            else:
+                token = next(token_generator)
+            token_type = token.type
+            if token_type in brackets:
+                closers.append(brackets[token_type])
+            elif token_type in close_types:
+                if token_type != closers[-1]:
+                    raise ParseError(token, 'Expected %s but found %s' %
+                                     (str(closers[-1]), str(token_type)))
+                closers.pop()
+            elif token_type == END_TOKEN:
+                self.token = token
+                raise ParseError(token, "Unexpected end of input")
+        if lookahead:
+            self.token = lookahead.popleft()
+        else:
+            self.token = next(token_generator)
+
+    def _release(self, mark):
+        """
+        Internal - remove a mark and any marks made after it.
+        """
+        assert mark.active, "Mark has already been committed or rewound"
+        index = len(self.marks) - 1
+        while self.marks[index] is not mark:
+            index -= 1
+        for released in self.marks[index:]:
+            released.active = False
+        del self.marks[index:]
+
     ##################################################################
     # Public interface
     ##################################################################
 
-    def __init__(self, expr_spec, token_generator):
+    def __init__(self, expr_spec, token_generator, memo_size = None):
         """
         Create a parser object.
 
@@ -367,11 +3173,40 @@ class Parser:
 
         token_generator -- a generator yielding tokens, i.e. (token_type,
         token_content, token_line, token_column) tuples.
+
+        memo_size -- optional, if specified then the results of calls to
+        expression() are remembered, along with any ParseError raised,
+        and reused when the same expression is parsed again from the same
+        position after rewinding to a mark.  This stops speculative
+        parsing taking exponential time when alternatives are tried
+        within each other.  At most this many results are kept, and the
+        least recently used are discarded first.  Handlers must not
+        depend on state other than the tokens they parse.
         """
         self.main_expr_spec = expr_spec
         self.token_generator = token_generator
-        self.token_stack = []
+        self.lookahead = deque()
+        self.marks = []
+        self.history = None
+        self.pending = None
+        self.source = None
+        self.memo = None
         self.token = next(token_generator)
+        if memo_size is not None:
+            self.memo = LRUCache(memo_size)
+            self.history_start = 0
+            self._start_recording()
+
+    @property
+    def token_stack(self):
+        """
+        Deprecated - the tokens read ahead of the current token as a
+        stack, with the next token last.  This is a view of the lookahead
+        buffer kept for handlers written for earlier versions, which used
+        append() to push back the token just read.  Use peek() and mark()
+        instead.
+        """
+        return _TokenStack(self.lookahead)
 
     def at_end(self):
         """
@@ -433,18 +3268,81 @@ class Parser:
         Return a tuple of the content of the two tokens matched, or None
         if they were not matched.
         """
-        if self.token.type != tok1:
+        if self.token.type != tok1 or self.peek(1).type != tok2:
             return None
         token1 = self.token
         self.next_token()
-        if self.token.type != tok2:
-            self.token_stack.append(self.token)
-            self.token = token1
-            return None
         token2 = self.token
         self.next_token()
         return (token1, token2)
 
+    def peek(self, n = 1):
+        """
+        Call from token handlers to look at a token ahead of the current
+        one without consuming anything.  Tokens read ahead are buffered
+        until the parser reaches them.
+
+        n -- optional, how far ahead to look: 0 for the current token, 1
+        for the one after it and so on
+
+        Returns the token, or the end token if the input ends before it.
+        """
+        lookahead = self.lookahead
+        while len(lookahead) < n:
+            last = lookahead[-1] if lookahead else self.token
+            if last.type == Token.END_TOKEN:
+                return last
+            lookahead.append(next(self.token_generator))
+        if n == 0:
+            return self.token
+        return lookahead[n - 1]
+
+    def mark(self):
+        """
+        Call from token handlers to save the current position in the
+        token stream so that the parser can return to it later, for
+        speculatively parsing something that may turn out not to match.
+
+        Returns a Mark, which is passed to rewind() to return to the
+        position or to commit() to keep the tokens parsed since.  Tokens
+        are kept for as long as any mark is outstanding.
+
+        The mark can also be used as a context manager, in which case it
+        is committed when the block exits normally and rewound if it
+        raises an exception, which is not caught.
+        """
+        if self.history is None:
+            self._start_recording()
+        mark = Mark(self, self.token, len(self.history) - len(self.lookahead))
+        self.marks.append(mark)
+        return mark
+
+    def rewind(self, mark):
+        """
+        Call from token handlers to return to a position saved by mark().
+        Any marks made after it are discarded.
+
+        mark -- the Mark to return to
+        """
+        self._release(mark)
+        self.token = mark.token
+        self.lookahead.clear()
+        self.lookahead.extend(self.history[mark.position:])
+        if not self.marks:
+            self._stop_recording()
+
+    def commit(self, mark):
+        """
+        Call from token handlers to discard a mark without moving, once
+        the tokens parsed since it was made have been accepted.  Any
+        marks made after it are also discarded.
+
+        mark -- the Mark to discard
+        """
+        self._release(mark)
+        if not self.marks:
+            self._stop_recording()
+
     def match(self, tok):
         """
         Call from token handlers to consume a token from the input stream.
@@ -458,6 +3356,66 @@ class Parser:
             raise ParseError(self.token, 'Expected %s but found %s' % (str(tok), str(self.token.type)))
         return result
 
+    def skip_balanced(self, open_type, close_type):
+        """
+        Call from token handlers to move past the tokens from an opening
+        bracket to its matching closing bracket, without parsing them.
+        Only brackets of these types are counted.
+
+        open_type -- the token type of the opening bracket, which must be
+        the current token
+
+        close_type -- the token type of the closing bracket
+        """
+        if self.token.type != open_type:
+            raise ParseError(self.token, 'Expected %s but found %s' %
+                             (str(open_type), str(self.token.type)))
+        self._skip_brackets({open_type: close_type})
+
+    def skip_expression(self, expr_spec, bind_right = 0):
+        """
+        Call from token handlers to move past an expression without
+        calling any handlers or building its value, for example to
+        ignore parts of the input that aren't needed.
+
+        Words, unary and binary operators and the brackets added with
+        add_parens(), add_list() and add_brackets() are recognised from
+        the expression spec.  Brackets are skipped by matching them at the
+        token level, so errors in the tokens between them are not found.
+        Other prefix and infix handlers can't be skipped and cause a
+        ParseError.
+
+        expr_spec - the expression spec to use
+
+        bind_right -- right binding power used to resolve operator precedence
+        """
+        brackets = expr_spec.brackets
+        while True:
+            token = self.token
+            token_type = token.type
+            if token_type in expr_spec.unary_funcs:
+                self.next_token()
+                continue
+            if token_type in brackets:
+                self._skip_brackets(brackets)
+            elif token_type in expr_spec.word_funcs:
+                self.next_token()
+            elif token_type == Token.END_TOKEN:
+                raise ParseError(token, "Unexpected end of input")
+            elif token_type in expr_spec.prefix_actions:
+                raise ParseError(token, "Can't skip '%s' in %s context" %
+                                 (str(token_type), expr_spec.name))
+            else:
+                raise ParseError(token, "Unexpected '%s' in %s context" %
+                                 (str(token_type), expr_spec.name))
+            token = self.token
+            if bind_right >= expr_spec.get_bind_left(token):
+                return
+            if token.type not in expr_spec.binary_funcs:
+                raise ParseError(token, "Can't skip '%s' in %s context" %
+                                 (str(token.type), expr_spec.name))
+            self.next_token()
+
     def expression(self, expr_spec, bind_right = 0):
         """
         Call from token handlers to parse an expression from the input stream.
@@ -468,11 +3426,604 @@ class Parser:
 
         Returns the value of the expression.
         """
-        t = self.token
-        self.next_token()
-        left = expr_spec.prefix(self, t)
-        while bind_right < expr_spec.get_bind_left(self.token):
+        if self.memo is not None:
+            return self._memo_expression(expr_spec, bind_right)
+        if expr_spec.fast_expression is not None:
+            return expr_spec.fast_expression(self, bind_right)
+        return self._expression(expr_spec, bind_right)
+
+class ProfilingParser(Parser):
+    """
+    A parser that records where time is spent while parsing, for finding
+    out why a grammar is slow.  It is used in the same way as Parser, and
+    report() returns what was recorded.  Parser itself is not affected.
+
+    Expressions are parsed with the generic implementation of
+    Parser.expression(), so frozen and compiled expression specs run the
+    same handlers as they would without being frozen.
+    """
+
+    def __init__(self, expr_spec, token_generator):
+        self.token_counts = {}
+        self.handler_stats = {}
+        self.frames = []
+        self.depth = 0
+        self.max_depth = 0
+        self.tokenize_time = 0.0
+        self.parse_time = 0.0
+        Parser.__init__(self, expr_spec, self._timed_tokens(token_generator))
+
+    def _timed_tokens(self, token_generator):
+        """
+        Internal - wrap a token generator to count the tokens of each type
+        and the time spent producing them.
+        """
+        token_generator = iter(token_generator)
+        token_counts = self.token_counts
+        frames = self.frames
+        while True:
+            start = _timer()
+            try:
+                token = next(token_generator)
+            except StopIteration:
+                return
+            elapsed = _timer() - start
+            self.tokenize_time += elapsed
+            if frames:
+                frames[-1][0] += elapsed
+            token_counts[token.type] = token_counts.get(token.type, 0) + 1
+            yield token
+
+    def _call_handler(self, key, handler, *args):
+        """
+        Internal - call a handler, recording its total time and its self
+        time, which excludes the time spent in handlers it calls and in
+        the tokenizer.
+        """
+        frame = [0.0]
+        self.frames.append(frame)
+        start = _timer()
+        try:
+            return handler(*args)
+        finally:
+            elapsed = _timer() - start
+            self.frames.pop()
+            if self.frames:
+                self.frames[-1][0] += elapsed
+            stats = self.handler_stats.get(key)
+            if stats is None:
+                stats = self.handler_stats[key] = [0, 0.0, 0.0]
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] += elapsed - frame[0]
+
+    def expression(self, expr_spec, bind_right = 0):
+        self.depth += 1
+        if self.depth > self.max_depth:
+            self.max_depth = self.depth
+        if self.depth == 1:
+            start = _timer()
+            tokenize_start = self.tokenize_time
+        try:
             t = self.token
             self.next_token()
-            left = expr_spec.infix(self, t, left)
-        return left
+            handler = expr_spec.prefix_actions.get(t.type)
+            if handler is None:
+                expr_spec.prefix(self, t)  # raises ParseError
+            left = self._call_handler((expr_spec.name, "prefix", t.type),
+                                      handler, self, expr_spec, t)
+            while bind_right < expr_spec.get_bind_left(self.token):
+                t = self.token
+                self.next_token()
+                handler = expr_spec.infix_actions.get(t.type, (0, None))[1]
+                if handler is None:
+                    expr_spec.infix(self, t, left)  # raises ParseError
+                left = self._call_handler((expr_spec.name, "infix", t.type),
+                                          handler, self, expr_spec, t, left)
+            return left
+        finally:
+            if self.depth == 1:
+                self.parse_time += (_timer() - start -
+                                    (self.tokenize_time - tokenize_start))
+            self.depth -= 1
+
+    def report(self):
+        """
+        Return a dict describing what has been recorded so far:
+
+        token_counts -- a dict mapping token types to the number of tokens
+        of that type read from the tokenizer
+
+        handlers -- a list of dicts, one per handler called, with the keys
+        spec, position ('prefix' or 'infix'), token_type, calls,
+        total_time and self_time, sorted by decreasing self time.  Total
+        time includes time spent in nested calls to the same handler.
+
+        max_depth -- the maximum depth of nested calls to expression()
+
+        tokenize_time -- the time spent in the tokenizer
+
+        parse_time -- the time spent parsing, excluding the tokenizer
+        """
+        handlers = [{ "spec": spec,
+                      "position": position,
+                      "token_type": token_type,
+                      "calls": stats[0],
+                      "total_time": stats[1],
+                      "self_time": stats[2] }
+                    for (spec, position, token_type), stats
+                    in self.handler_stats.items()]
+        handlers.sort(key = lambda handler: -handler["self_time"])
+        return { "token_counts": dict(self.token_counts),
+                 "handlers": handlers,
+                 "max_depth": self.max_depth,
+                 "tokenize_time": self.tokenize_time,
+                 "parse_time": self.parse_time }
+
+class _AbortParse(Exception):
+    """Internal - raised in a PushParser's thread to stop it parsing"""
+
+class _ParserThread(object):
+    """
+    Internal - the state shared between a PushParser and the thread that
+    runs its Parser.  The thread refers to this rather than to the
+    PushParser, so that a PushParser which is dropped without being
+    closed can be garbage collected, which stops the thread.
+    """
+
+    def __init__(self, expr_spec):
+        self.expr_spec = expr_spec
+        self.tokens = deque()
+        self.results = []
+        self.error = None
+        self.closed = False
+        self.aborted = False
+        self.condition = threading.Condition()
+        self.parser_running = False
+        self.thread = None
+
+    def abort(self):
+        """
+        Internal - stop the thread without waiting for the end of the
+        input.
+        """
+        if not self.closed:
+            self.closed = self.aborted = True
+            if self.thread is not None and self.thread.is_alive():
+                self.run()
+
+    def run(self):
+        """
+        Internal - let the parser thread run until it needs more input or
+        finishes, and return the results it produced.
+        """
+        if self.error is not None:
+            raise self.error
+        if self.thread is None:
+            if not self.tokens:
+                return []
+            self.thread = threading.Thread(target = self._parse_thread)
+            self.thread.daemon = True
+            with self.condition:
+                self.parser_running = True
+                self.thread.start()
+                while self.parser_running:
+                    self.condition.wait()
+        elif self.thread.is_alive():
+            with self.condition:
+                self.parser_running = True
+                self.condition.notify()
+                while self.parser_running:
+                    self.condition.wait()
+        if self.closed:
+            self.thread.join()
+        results = self.results
+        self.results = []
+        if self.error is not None:
+            raise self.error
+        return results
+
+    def _next_tokens(self):
+        """
+        Internal - generator yielding tokens to the parser thread, which
+        waits for more input when there are none.
+        """
+        tokens = self.tokens
+        condition = self.condition
+        while True:
+            while tokens and not self.aborted:
+                yield tokens.popleft()
+            if self.aborted:
+                raise _AbortParse()
+            with condition:
+                self.parser_running = False
+                condition.notify()
+                while not self.parser_running:
+                    condition.wait()
+
+    def _parse_thread(self):
+        """
+        Internal - the parser thread's main function.
+        """
+        try:
+            parser = Parser(self.expr_spec, self._next_tokens())
+            while not parser.at_end():
+                result = parser.parse()
+                self.results.append(result)
+        except _AbortParse:
+            pass
+        except Exception as e:
+            self.error = e
+        with self.condition:
+            self.parser_running = False
+            self.condition.notify()
+
+class PushParser(object):
+    """
+    A parser for input that arrives in chunks, for example from a socket
+    or pipe.  Input is passed to feed() as it arrives, and each top level
+    expression is returned as soon as it is complete.  The results are the
+    same as parsing the whole input with Parser.parse_all().
+
+    Token handlers are called by a Parser running in a separate thread,
+    which waits while there is no more input.  Only one of the threads
+    runs at a time, so handlers don't need to be thread safe.  Only
+    the tokens of the expression being parsed are kept, so memory use
+    is bounded by the largest expression rather than the whole input.
+
+    close() should be called when the input ends, or abort() if it won't
+    be parsed to the end, to finish the thread.  A PushParser can be used
+    as a context manager which does this.  Otherwise the thread is
+    stopped when the PushParser is garbage collected.
+
+    expr_spec -- the ExprSpec used to parse the input
+
+    tokenizer -- the Tokenizer used to tokenize the input
+
+    filename -- optional, the name reported by the tokens and errors
+    """
+
+    def __init__(self, expr_spec, tokenizer, filename = None):
+        self.state = _ParserThread(expr_spec)
+        self.tokenizer = IncrementalTokenizer(tokenizer, filename)
+
+    def __del__(self):
+        # stop the parser thread if the input was never closed
+        state = getattr(self, "state", None)
+        if state is not None:
+            state.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        elif not self.state.closed:
+            self.close()
+
+    def feed(self, chunk):
+        """
+        Add a chunk of input, and return a list of the values of the top
+        level expressions that it completes.
+        """
+        self.state.tokens.extend(self.tokenizer.feed(chunk))
+        return self.state.run()
+
+    def close(self):
+        """
+        Mark the end of the input and return a list of the values of the
+        remaining top level expressions.  Raises ParseError if the input
+        ends within an expression.
+        """
+        self.state.tokens.extend(self.tokenizer.close())
+        self.state.closed = True
+        return self.state.run()
+
+    def abort(self):
+        """
+        Stop parsing without waiting for the end of the input.
+        """
+        self.state.abort()
+
+    def parse_all(self, chunks):
+        """
+        Return a generator that feeds each of a sequence of chunks to the
+        parser and yields the value of each top level expression as soon
+        as it is complete.
+        """
+        try:
+            for chunk in chunks:
+                for result in self.feed(chunk):
+                    yield result
+        except:
+            self.abort()
+            raise
+        for result in self.close():
+            yield result
+
+_worker_expr_spec = None
+_worker_tokenizer = None
+
+def _init_worker(expr_spec, tokenizer, setup):
+    """
+    Internal - initialise a parse_many() worker process.
+    """
+    global _worker_expr_spec, _worker_tokenizer
+    if setup is not None:
+        expr_spec, tokenizer = setup()
+    _worker_expr_spec = expr_spec
+    _worker_tokenizer = tokenizer
+
+def _worker_pool(workers, expr_spec, tokenizer, setup, context):
+    """
+    Internal - start a pool of worker processes for parse_many() or
+    parse_file_parallel().  Without a setup function the expression
+    spec and tokenizer are inherited by forking, which is used if the
+    default start method is something else and fork is available and
+    safe.
+    """
+    if hasattr(multiprocessing, "get_context"):
+        if context is None:
+            # the first start method is the platform's default, and
+            # asking for the default context would fix it
+            context = multiprocessing.get_context(
+                multiprocessing.get_start_method(allow_none = True) or
+                multiprocessing.get_all_start_methods()[0])
+            if setup is None and context.get_start_method() != "fork" and \
+               "fork" in multiprocessing.get_all_start_methods() and \
+               sys.platform != "darwin":
+                context = multiprocessing.get_context("fork")
+        start_method = context.get_start_method()
+    else:
+        context = multiprocessing
+        start_method = "spawn" if sys.platform == "win32" else "fork"
+    if setup is not None:
+        expr_spec = tokenizer = None
+    else:
+        assert start_method == "fork", \
+            "A setup function is needed where worker processes are not forked"
+    return context.Pool(workers, _init_worker, (expr_spec, tokenizer, setup))
+
+def _parse_batch(batch):
+    """
+    Internal - parse a batch of inputs in a parse_many() worker process.
+    """
+    return _parse_inputs(_worker_expr_spec, _worker_tokenizer, batch)
+
+def _parse_inputs(expr_spec, tokenizer, inputs):
+    """
+    Internal - parse a list of inputs, returning a list containing the
+    values parsed from each input or the ParseError raised.
+    """
+    results = []
+    for input in inputs:
+        try:
+            results.append(list(Parser(expr_spec,
+                                       tokenizer.tokenize(input)).parse_all()))
+        except ParseError as e:
+            results.append(e)
+    return results
+
+def _parse_indexed_batch(indexed_batch):
+    """
+    Internal - parse a batch of inputs with the index of its first input.
+    """
+    start, batch = indexed_batch
+    return start, _parse_batch(batch)
+
+def _batches(inputs, batch_size):
+    """
+    Internal - split an iterable of inputs into lists of batch_size inputs.
+    """
+    batch = []
+    for input in inputs:
+        batch.append(input)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _indexed_batches(batches):
+    """
+    Internal - pair each batch with the index of its first input.
+    """
+    start = 0
+    for batch in batches:
+        yield start, batch
+        start += len(batch)
+
+def parse_many(expr_spec, tokenizer, inputs, workers = None, batch_size = 100,
+               ordered = True, setup = None, context = None):
+    """
+    Parse many independent inputs using a pool of worker processes.
+    Returns a generator which yields, for each input, either a list of
+    the values of the expressions it contains or the ParseError raised
+    parsing it.
+
+    expr_spec -- the ExprSpec used to parse each input
+
+    tokenizer -- the Tokenizer used to tokenize each input
+
+    inputs -- an iterable of strings to parse
+
+    workers -- optional, the number of worker processes, by default the
+    number of CPUs.  If this is 1 the inputs are parsed in this process.
+
+    batch_size -- optional, the number of inputs sent to a worker at a
+    time
+
+    ordered -- optional, if false then results are yielded as they
+    are completed, as (index, result) tuples
+
+    setup -- optional, a function called in each worker that returns an
+    (expr_spec, tokenizer) tuple to use in place of those passed.
+    Expression specs are not picklable, so this is required where
+    worker processes are not forked, and must be picklable itself, for
+    example a module level function.
+
+    context -- optional, the multiprocessing context used to start the
+    workers.  By default this is multiprocessing's default, except that
+    fork is used if it is available and safe and setup is not given, as
+    it is not on Windows and macOS.
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    assert workers > 0, "Need at least one worker"
+    batches = _batches(inputs, batch_size)
+
+    if workers == 1:
+        if setup is not None:
+            expr_spec, tokenizer = setup()
+        start = 0
+        for batch in batches:
+            for index, result in enumerate(_parse_inputs(expr_spec, tokenizer,
+                                                         batch)):
+                yield result if ordered else (start + index, result)
+            start += len(batch)
+        return
+
+    pool = _worker_pool(workers, expr_spec, tokenizer, setup, context)
+    try:
+        if ordered:
+            for results in pool.imap(_parse_batch, batches):
+                for result in results:
+                    yield result
+        else:
+            indexed_batches = _indexed_batches(batches)
+            for start, results in pool.imap_unordered(_parse_indexed_batch,
+                                                      indexed_batches):
+                for index, result in enumerate(results):
+                    yield start + index, result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def _parse_range(task):
+    """
+    Internal - parse a range of a file in a parse_file_parallel() worker
+    process.
+    """
+    return _parse_file_range(_worker_expr_spec, _worker_tokenizer, task)
+
+def _parse_file_range(expr_spec, tokenizer, task):
+    """
+    Internal - parse a range of a file, returning a list of the values
+    parsed.
+    """
+    filename, start, end, first_line, encoding = task
+    with open(filename, "rb") as f:
+        buffer = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        try:
+            text = buffer[start:end]
+        finally:
+            buffer.close()
+    if not isinstance(text, str):
+        text = text.decode(encoding)
+    tokens = tokenizer.tokenize_buffer(text, filename, first_line = first_line)
+    return list(Parser(expr_spec, tokens).parse_all())
+
+def _split_file(buffer, chunk_size, boundary):
+    """
+    Internal - split a mapped file into ranges of at least chunk_size
+    bytes that start at the beginning of a line matching boundary.
+    Returns a list of (start, end, first_line) tuples.
+    """
+    ranges = []
+    length = len(buffer)
+    start = 0
+    first_line = 1
+    while start < length:
+        end = length
+        search = start + chunk_size - 1
+        while search < length:
+            newline = buffer.find(b"\n", search)
+            if newline < 0:
+                break
+            if boundary is None or boundary.match(buffer, newline + 1):
+                end = newline + 1
+                break
+            search = newline + 1
+        ranges.append((start, end, first_line))
+        first_line += buffer[start:end].count(b"\n")
+        start = end
+    return ranges
+
+def parse_file_parallel(expr_spec, tokenizer, filename, workers = None,
+                        chunk_size = 1 << 24, boundary = None, setup = None,
+                        encoding = "utf-8", context = None):
+    """
+    Parse a large file using a pool of worker processes, and return a
+    generator which yields the value of each expression in the file in
+    order, as Parser.parse_all() would.
+
+    The file is split into ranges at the start of lines, which must be
+    places where one top level expression ends and the next begins, for
+    example in a file of newline delimited JSON values.  Each range is
+    tokenized with tokenize_buffer() and parsed by a worker.  Tokens and
+    errors report their positions in the whole file.  If parsing a range
+    raises a ParseError, the values of the ranges before it are yielded
+    and then the error is raised.
+
+    expr_spec -- the ExprSpec used to parse the file
+
+    tokenizer -- the Tokenizer used to tokenize the file
+
+    filename -- the name of the file to parse
+
+    workers -- optional, the number of worker processes, by default the
+    number of CPUs
+
+    chunk_size -- optional, the approximate size in bytes of the range
+    parsed by each worker at a time
+
+    boundary -- optional, a regexp which must match at the start of a
+    line for the file to be split there, for files where not every line
+    starts a new expression
+
+    setup -- optional, a function called in each worker that returns an
+    (expr_spec, tokenizer) tuple to use, as for parse_many()
+
+    encoding -- optional, the encoding of the file, by default UTF-8
+
+    context -- optional, the multiprocessing context used to start the
+    workers, as for parse_many()
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    assert workers > 0, "Need at least one worker"
+    if isinstance(boundary, str) and bytes is not str:
+        boundary = boundary.encode(encoding)
+    if boundary is not None and not hasattr(boundary, "match"):
+        boundary = re.compile(boundary)
+
+    with open(filename, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        buffer = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        try:
+            ranges = _split_file(buffer, chunk_size, boundary)
+        finally:
+            buffer.close()
+    tasks = [(filename, start, end, first_line, encoding)
+             for start, end, first_line in ranges]
+
+    if workers == 1 or len(tasks) == 1:
+        if setup is not None:
+            expr_spec, tokenizer = setup()
+        for task in tasks:
+            for result in _parse_file_range(expr_spec, tokenizer, task):
+                yield result
+        return
+
+    pool = _worker_pool(workers, expr_spec, tokenizer, setup, context)
+    try:
+        for results in pool.imap(_parse_range, tasks):
+            for result in results:
+                yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
@@ -0,0 +1,108 @@
+# Copyright (c) 2012 Jon Coppeard
+# See the file LICENSE for copying permission.
+
+"""
+asyncio support for the varas parser library.  Requires Python 3.6 or
+later.
+
+These functions read input from an asyncio.StreamReader and return
+asynchronous generators for use with 'async for'.  Input is read and
+processed one chunk at a time, and control is given back to the event
+loop after each chunk so that a large input doesn't block the loop for
+long.  More input is only read when the consumer asks for the next
+result, so a slow consumer applies backpressure to the stream.
+"""
+
+import asyncio
+import codecs
+
+from varas import IncrementalTokenizer, PushParser
+
+"""Number of bytes read from the stream at a time"""
+DEFAULT_CHUNK_SIZE = 4096
+
+async def _read_text(reader, encoding, chunk_size):
+    """
+    Internal - asynchronous generator yielding decoded chunks of text read
+    from a stream, giving control back to the event loop before each one.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)()
+    while True:
+        await asyncio.sleep(0)
+        data = await reader.read(chunk_size)
+        if not data:
+            break
+        text = decoder.decode(data)
+        if text:
+            yield text
+    text = decoder.decode(b"", True)
+    if text:
+        yield text
+
+async def tokenize_stream(tokenizer, reader, filename = None, compact = False,
+                          encoding = "utf-8", chunk_size = DEFAULT_CHUNK_SIZE):
+    """
+    Asynchronous version of Tokenizer.tokenize_file() that reads from an
+    asyncio.StreamReader.  Returns an asynchronous generator that yields
+    the same sequence of Token objects.
+
+    tokenizer -- the Tokenizer to use
+
+    reader -- the stream to read from
+
+    filename -- optional, the name reported by the tokens
+
+    compact -- optional, if true then yield CompactToken objects
+    instead of Token objects
+
+    encoding -- optional, the encoding of the stream, by default UTF-8
+
+    chunk_size -- optional, the number of bytes to read at a time
+    """
+    incremental = IncrementalTokenizer(tokenizer, filename, compact)
+    texts = _read_text(reader, encoding, chunk_size)
+    try:
+        async for text in texts:
+            for token in incremental.feed(text):
+                yield token
+    finally:
+        await texts.aclose()
+    for token in incremental.close():
+        yield token
+
+async def parse_stream(expr_spec, tokenizer, reader, filename = None,
+                       encoding = "utf-8", chunk_size = DEFAULT_CHUNK_SIZE):
+    """
+    Asynchronous version of Parser.parse_all() that reads from an
+    asyncio.StreamReader.  Returns an asynchronous generator that yields
+    the value of each top level expression as soon as it has been read.
+
+    Parsing is done by a PushParser, so handlers are called from its
+    thread while the event loop's thread waits.  The parser is stopped if
+    the generator is closed before reaching the end of the stream.
+
+    expr_spec -- the ExprSpec to parse the input with
+
+    tokenizer -- the Tokenizer to use
+
+    reader -- the stream to read from
+
+    filename -- optional, the name reported by the tokens and errors
+
+    encoding -- optional, the encoding of the stream, by default UTF-8
+
+    chunk_size -- optional, the number of bytes to read at a time
+    """
+    parser = PushParser(expr_spec, tokenizer, filename)
+    texts = _read_text(reader, encoding, chunk_size)
+    try:
+        async for text in texts:
+            for result in parser.feed(text):
+                yield result
+    except BaseException:
+        parser.abort()
+        raise
+    finally:
+        await texts.aclose()
+    for result in parser.close():
+        yield result